@@ -77,11 +77,13 @@ dfs1_BGR0508 = ahf.Data_Filters(min_press=this_min_press, date_range=['2005/08/1
 dfs1_BGR0511 = ahf.Data_Filters(min_press=this_min_press, date_range=['2005/08/15 00:00:00','2011/08/15 00:00:00'])
 
 # Build a clustering dictionary
-def build_clustering_dict(file_prefix, BGR_name, pfs_object=pfs_BGR_test, cl_x_var='SA', cl_y_var='la_CT', cl_z_var='None', m_pts='auto', m_cls='auto', relab_these={}):
+def build_clustering_dict(file_prefix, BGR_name, pfs_object=pfs_BGR_test, cl_x_var='SA', cl_y_var='la_CT', cl_z_var='None', m_pts='auto', m_cls='auto', relab_these={}, re_run_clstr=True):
     """
     Build a dictionary for the BGR_name to cluster that data
 
     BGR_name    : str, name of the BGR to cluster, ex: 'BGR0506'
+    re_run_clstr: True, or 'incremental' to only add new profiles to the
+                    clustering already in the netcdf, see ahf.incr_HDBSCAN()
     """
     clstr_dict = {'netcdf_file':'netcdfs/'+file_prefix+BGR_name+'_clstrd.nc',
                    'name':BGR_name,
@@ -93,8 +95,25 @@ def build_clustering_dict(file_prefix, BGR_name, pfs_object=pfs_BGR_test, cl_x_v
                    'cl_z_var':cl_z_var,
                    'm_pts':m_pts,
                    'm_cls':m_cls, 
-                   'relab_these':relab_these
+                   'relab_these':relab_these,
+                   're_run_clstr':re_run_clstr
                    }
     return clstr_dict
 
+# Find the value of m_pts with the highest DBCV for a BGR period
+def find_best_m_pts(BGR_name, pfs_object=pfs_BGR_test, cl_x_var='SA', cl_y_var='la_CT', m_pts_range=[30,2400], m_cls='auto', DBCV_method='relative_validity', resume=True):
+    """
+    Returns the value of m_pts with the highest DBCV for the BGR_name, found
+    with an adaptive search, to pass to build_clustering_dict(). Each point is
+    recorded in `outputs/<BGR_name>_ps.csv` and, with resume, any already in
+    that file from an earlier sweep aren't run again
 
+    BGR_name    : str, name of the BGR to cluster, ex: 'BGR0506'
+    m_pts_range : list, the smallest and largest values of m_pts to try
+    """
+    ds = ahf.Data_Set(bps.BGRITPs_dict[BGR_name], dfs1_BGR_dict[BGR_name])
+    pp = ahf.Plot_Parameters(x_vars=[cl_x_var], y_vars=[cl_y_var], clr_map='clr_all_same')
+    df = ahf.pd.concat(ahf.Analysis_Group(ds, pfs_object, pp).data_frames)
+    sweep_results = ahf.Sweep_Results('outputs/'+BGR_name+'_ps.csv', BGR_name, resume=resume)
+    best_m_pts, scores = ahf.search_m_pts(df[[cl_x_var, cl_y_var]], m_pts_range, m_cls=m_cls, DBCV_method=DBCV_method, sweep_results=sweep_results, ell_size=ahf.find_ell_size(ds.arr_of_ds))
+    return best_m_pts
@@ -3,10 +3,15 @@ Author: Mikhail Schee
 Created: 2023-10-03
 
 Usage:
-    HPC_param_sweep.py SWEEP_NAME
+    HPC_param_sweep.py SWEEP_NAME [--mem_per_rank=<GB>] [--n_local=<N>] [--n_retries=<N>] [--resume] [--n_lhs=<N>]
 
 Options:
-    SWEEP_NAME        # string of the BGR time period to sweep over (ex: 'BGR0506')
+    SWEEP_NAME            # string of the BGR time period(s) to sweep over, separated by commas (ex: 'BGR0506' or 'BGR0506,BGR0607')
+    --mem_per_rank=<GB>   # memory in GB each working process may use, 0 for no limit [default: 0]
+    --n_local=<N>         # run on a local pool of N processes instead of MPI [default: 0]
+    --n_retries=<N>       # number of times to retry a parameter point that fails [default: 1]
+    --resume              # skip the points already in the output file from an earlier run
+    --n_lhs=<N>           # choose N points by Latin hypercube sampling instead of running them all [default: 0]
 
 This script is set up to run parameter sweeps on the Niagara HPC cluster
 
@@ -27,8 +32,27 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS "AS IS" AND ANY EXPRESSED OR
 NOTE: Run in parallel with 
 $ mpirun -np 2 python3 HPC_param_sweep.py
 where the `-np` flag denotes the number of processes
+
+The points of the sweep are set by `sweep_vals` below, which can sweep any of
+m_pts, m_cls, ell_size, n_pfs, and the BGR period. ahf.plan_clstr_sweep() puts
+them in order and the points with the same BGR period, ell_size, n_pfs, and
+m_pts are run together, as one task, so the single linkage tree is reused for
+each value of m_cls. The BGR periods are run one after the other, each writing
+to its own output file. For each, rank 0 loads and filters the data once,
+takes the moving average for each value of ell_size, and shares just the
+clustering variables read-only with the workers on each node.
+Rank 0 hands out the tasks one at a time, in order, to the other ranks as they
+become free. Only as many ranks per node as fit in the node's memory with
+`--mem_per_rank` work, the rest sit idle.
+A task that fails is retried up to `--n_retries` times, then skipped.
+Each point is written to the output file as soon as it finishes, so a sweep
+that runs out of time can be continued in another job with `--resume`.
+To run without MPI on a single machine, use
+$ python3 HPC_param_sweep.py BGR0506 --n_local=4
 """
 
+import os
+import copy
 import numpy as np
 # For formatting data into dataframes
 import pandas as pd
@@ -38,10 +62,15 @@ import analysis_helper_functions as ahf
 import BGR_params as bps
 # For common BGR objects
 import BGR_objects as bob
-# For running in parallel
-from mpi4py import MPI
-# For formatting date objects
-from datetime import datetime
+# For running in parallel on a local machine
+import multiprocessing
+from multiprocessing import shared_memory
+# For passing the dataset attributes to the workers
+import xarray as xr
+# For keeping the queue of tasks
+from collections import deque
+# For timing each parameter point
+import time
 # 
 # # Change the matplotlib configure directory to somewhere writable to avoid warnings
 # import os
@@ -51,26 +80,96 @@ from datetime import datetime
 from docopt import docopt
 args = docopt(__doc__)
 sweep_name    = str(args['SWEEP_NAME'])       # relative filepath
+mem_per_rank  = float(args['--mem_per_rank'])
+n_local       = int(args['--n_local'])
+n_retries     = int(args['--n_retries'])
+resume        = args['--resume']
+n_lhs         = int(args['--n_lhs'])
 print('Sweep name:', sweep_name)
 
 # Get MPI variables set up
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
-size = comm.Get_size()
+if n_local > 0:
+    rank = 0
+    size = 1
+else:
+    # For running in parallel
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+# Message tags between the master and the workers
+tag_ready = 1
+tag_task = 2
+tag_stop = 3
+
+################################################################################
+# Make the plot parameters, which set the clustering variables
+################################################################################
+
+test_mpts = 360
+# Make the Plot Parameters
+pp = ahf.Plot_Parameters(x_vars=['m_pts'], y_vars=['n_clusters','DBCV'], clr_map='clr_all_same', extra_args={'cl_x_var':'SA', 'cl_y_var':'la_CT', 'm_pts':test_mpts, 'm_cls':'auto', 'cl_ps_tuple':[30,2401,30], 'mpi_run':True}) #[10,801,5]
+# Build the array for the x_var axis
+cl_ps_tuple = pp.extra_args['cl_ps_tuple']
+
+################################################################################
+# Set up the points of the sweep
+################################################################################
+
+# Give a list of values for any of 'BGR', 'ell_size', 'n_pfs', 'm_pts', and 'm_cls'
+sweep_vals = {'BGR':sweep_name.split(','),
+              'm_pts':np.arange(cl_ps_tuple[0], cl_ps_tuple[1], cl_ps_tuple[2]),
+              'm_cls':[pp.extra_args['m_cls']],
+              # 'ell_size':[5,10,20],
+              # 'n_pfs':[100,200,400,'all'],
+              }
+if n_lhs > 0:
+    sweep_plan = ahf.plan_clstr_sweep(sweep_vals, n_lhs=n_lhs)
+else:
+    sweep_plan = ahf.plan_clstr_sweep(sweep_vals)
+
+################################################################################
+
+def make_tasks(sweep_plan):
+    """
+    Returns a list of the tasks to hand out, in order, each a dictionary of a
+    group of points in the plan which share the BGR period, ell_size, n_pfs,
+    and m_pts, and differ only in m_cls
+
+    sweep_plan      A list of points returned by ahf.plan_clstr_sweep()
+    """
+    tasks = []
+    m_pts_lists = {}
+    for pt in sweep_plan:
+        data_key = (pt['BGR'], pt['ell_size'], pt['n_pfs'])
+        # Find the core distances once for every m_pts run on the same data
+        if data_key not in m_pts_lists:
+            m_pts_lists[data_key] = []
+        if pt['m_pts'] not in m_pts_lists[data_key]:
+            m_pts_lists[data_key].append(pt['m_pts'])
+        if len(tasks) > 0 and tasks[-1]['key'] == data_key+(pt['m_pts'],):
+            tasks[-1]['m_cls_list'].append(pt['m_cls'])
+        else:
+            tasks.append({'key':data_key+(pt['m_pts'],),
+                          'BGR':pt['BGR'],
+                          'ell_size':pt['ell_size'],
+                          'n_pfs':pt['n_pfs'],
+                          'm_pts':pt['m_pts'],
+                          'm_cls_list':[pt['m_cls']],
+                          'm_pts_list':m_pts_lists[data_key]})
+    return tasks
+
+################################################################################
 
-# Only handle file I/O on the root process
-if rank == 0:
-    # Open a text file to record values from the parameter sweep
-    sweep_txt_file = 'outputs/'+sweep_name+'_ps.csv'
-    f = open(sweep_txt_file,'w')
-    f.write('Parameter Sweep for '+sweep_name+'\n')
-    f.write(datetime.now().strftime("%I:%M%p on %B %d, %Y")+'\n')
-    f.write('m_pts,ell_size,n_clusters,DBCV,m_cls\n')
-    f.close()
+def load_sweep_data(BGR, ell_list):
+    """
+    Loads the data set to sweep over and returns a dictionary with a data frame
+    and a list of the datasets for each value of ell_size
 
-# Reduce the number of active processes
-rf = 8
-if rank%rf == 0:
+    BGR             A string of the BGR period to load
+    ell_list        A list of the values of ell_size, None for the window already
+                        in the data
+    """
 
 ################################################################################
 # Make dictionaries for what data to load in and analyze
@@ -96,110 +195,382 @@ if rank%rf == 0:
 
     # ds_this_BGR = ahf.Data_Set(BGR0508, dfs_all)
     # ds_this_BGR = ahf.Data_Set(ITP2, dfs0)
-    ds_this_BGR = ahf.Data_Set(bps.BGRITPs_dict[sweep_name], bob.dfs1_BGR_dict[sweep_name])
+    ds_this_BGR = ahf.Data_Set(bps.BGRITPs_dict[BGR], bob.dfs1_BGR_dict[BGR])
 
 ################################################################################
 # Create profile filtering objects
 ################################################################################
 
-    pfs_this_BGR = bob.pfs_BGR_test
+    pfs_this_BGR = copy.copy(bob.pfs_BGR_test)
 
 ################################################################################
 ### Figures
 
     ## Clustering parameter sweeps
     # ## Parameter sweep for BGR ITP data
-    if True:
-        print('')
-        print('- Creating clustering parameter sweep for BGR ITP data')
-        test_mpts = 360
-        # Make the Plot Parameters
-        pp = ahf.Plot_Parameters(x_vars=['m_pts'], y_vars=['n_clusters','DBCV'], clr_map='clr_all_same', extra_args={'cl_x_var':'SA', 'cl_y_var':'la_CT', 'm_pts':test_mpts, 'm_cls':'auto', 'cl_ps_tuple':[30,2401,30], 'mpi_run':True}) #[10,801,5]
+    print('')
+    print('- Creating clustering parameter sweep for BGR ITP data')
+    sweep_data = {'dfs':{}, 'arr_of_ds':{}}
+    if None in ell_list:
         # Make the subplot groups
-        group_mpts_param_sweep = ahf.Analysis_Group(ds_this_BGR, pfs_this_BGR, pp, plot_title=sweep_name)
+        group_mpts_param_sweep = ahf.Analysis_Group(ds_this_BGR, pfs_this_BGR, pp, plot_title=BGR)
         # Run the parameter sweep
-        df = ahf.make_subplot(None, group_mpts_param_sweep, None, None)
-        if rank == 0:
-            print(df)
-        # Grab just the datasets from the analysis group
-        arr_of_ds = group_mpts_param_sweep.data_set.arr_of_ds
-    # Build the array for the x_var axis
-    cl_ps_tuple = pp.extra_args['cl_ps_tuple']
-    x_var_array = np.arange(cl_ps_tuple[0], cl_ps_tuple[1], cl_ps_tuple[2])
+        sweep_data['dfs'][None] = ahf.make_subplot(None, group_mpts_param_sweep, None, None)
+        sweep_data['arr_of_ds'][None] = [xr.Dataset(attrs=dict(ds.attrs)) for ds in group_mpts_param_sweep.data_set.arr_of_ds]
+    # If sweeping ell_size, make the data frames once with the smallest window
+    #   and switch in the moving averages for the other windows from the cache
+    ell_sizes = [ell for ell in ell_list if not isinstance(ell, type(None))]
+    if len(ell_sizes) > 0:
+        ell_pfs = copy.copy(pfs_this_BGR)
+        ell_pfs.m_avg_win = min(ell_sizes)
+        ell_group = ahf.Analysis_Group(ds_this_BGR, ell_pfs, pp, plot_title=BGR)
+        for ell in ell_sizes:
+            # Need to apply moving average window to original data, before
+            #   the data filters were applied
+            sweep_data['dfs'][ell] = pd.concat(ahf.apply_m_avg_win(ell_group, ell))
+            sweep_data['arr_of_ds'][ell] = [xr.Dataset(attrs=dict(ds.attrs)) for ds in ell_group.data_set.arr_of_ds]
+    return sweep_data
+
+################################################################################
 
-    # Divide the runs among the processes
-    x_var_array = x_var_array[int(rank/rf)::int(size/rf)]
+def split_sweep_data(sweep_data, use_pfs):
+    """
+    Returns a dictionary of the small things each task needs and an array of
+    the clustering variables, with one column per variable and the rows for
+    each value of ell_size one after the other, which is the only large thing
+    and can be shared between processes
+
+    sweep_data      The dictionary returned by load_sweep_data()
+    use_pfs         True/False whether any task limits the number of profiles
+    """
+    m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = ahf.get_cluster_args(pp)
+    columns = [var for var in [cl_x_var, cl_y_var, cl_z_var] if not isinstance(var, type(None))]
+    if use_pfs:
+        columns.append('prof_no')
+    Xs = []
+    rows = {}
+    pf_nos = {}
+    n_rows = 0
+    for ell, df in sweep_data['dfs'].items():
+        Xs.append(df[columns].to_numpy(dtype=float))
+        rows[ell] = (n_rows, n_rows+len(df))
+        n_rows += len(df)
+        # For limiting the number of pfs, find the profile numbers in order
+        if use_pfs:
+            pf_nos[ell] = np.unique(df['prof_no'].values)
+    X = np.ascontiguousarray(np.concatenate(Xs))
+    # HDBSCAN_() only needs the attributes of the datasets
+    meta = {'columns':columns,
+            'shape':X.shape,
+            'rows':rows,
+            'pf_nos':pf_nos,
+            'arr_of_ds':sweep_data['arr_of_ds']}
+    return meta, X
 
 ################################################################################
-# Start the parameter sweeps
 
-    # Set the main x and y data keys
-    x_key = pp.x_vars[0]
-    y_key = pp.y_vars[0]
-    print('\trank',rank,'plotting these x values of',x_key,':',x_var_array)
+def join_sweep_data(meta, X):
+    """
+    Returns the dictionary that run_task() takes from the output of
+    split_sweep_data(), with the array of clustering variables set read-only
+
+    meta            The dictionary returned by split_sweep_data()
+    X               The array of clustering variables, or a shared copy of it
+    """
+    X.flags.writeable = False
+    sweep_data = dict(meta)
+    sweep_data['X'] = X
+    return sweep_data
+
+################################################################################
+
+def attach_shared_local(shm_name, meta):
+    """
+    Sets up a process of the local pool to read the clustering variables from
+    the parent's shared memory block
+
+    shm_name        A string of the name of the shared memory block
+    meta            The dictionary returned by split_sweep_data()
+    """
+    global sweep_data, local_shm
+    local_shm = shared_memory.SharedMemory(name=shm_name)
+    sweep_data = join_sweep_data(meta, np.ndarray(meta['shape'], dtype=float, buffer=local_shm.buf))
+
+################################################################################
+
+def share_mpi(X, shape):
+    """
+    Returns a read-only array of the clustering variables in a shared memory
+    window on each node, which rank 0 fills and copies to one rank on each of
+    the other nodes, along with the window, which must be kept to keep the array
+
+    X               The array of clustering variables on rank 0, None elsewhere
+    shape           A tuple of the shape of the array
+    """
+    itemsize = MPI.DOUBLE.Get_size()
+    if node_rank == 0:
+        n_bytes = int(np.prod(shape)) * itemsize
+    else:
+        n_bytes = 0
+    win = MPI.Win.Allocate_shared(n_bytes, itemsize, comm=node_comm)
+    buf, itemsize = win.Shared_query(0)
+    X_shared = np.ndarray(buffer=buf, dtype='d', shape=shape)
+    leader_comm = comm.Split(0 if node_rank == 0 else MPI.UNDEFINED, rank)
+    if node_rank == 0:
+        if rank == 0:
+            X_shared[:] = X
+        leader_comm.Bcast(X_shared, root=0)
+        leader_comm.Free()
+    node_comm.Barrier()
+    return X_shared, win
+
+################################################################################
+
+def run_task(sweep_data, task):
+    """
+    Runs HDBSCAN for each value of m_cls in the task and returns a list of
+    dictionaries of the values to record in the output file for each point
+    that ran and a list of the values of m_cls that failed
+
+    sweep_data      The dictionary returned by join_sweep_data()
+    task            A dictionary returned by make_tasks()
+    """
     # Get cluster arguments
     m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = ahf.get_cluster_args(pp)
-    # If limiting the number of pfs, find total number of pfs in the given df
-    #   In the multi-index of df, level 0 is 'Time'
-    if x_key == 'n_pfs':
-        pf_nos = np.unique(np.array(df['prof_no'].values, dtype=type('')))
-        number_of_pfs = len(pf_nos)
-        print('\tNumber of profiles:',number_of_pfs)
-        x_var_array = x_var_array[x_var_array <= number_of_pfs]
-    #
-    x_len = len(x_var_array)
-    lines = []
-    for x in x_var_array:
-        # Set initial values for some variables
-        zlabel = None
-        this_df = df.copy()
-        # Set parameters based on variables selected
-        #   NOTE: need to run `ell_size` BEFORE `n_pfs`
-        if x_key == 'ell_size':
-            # Need to apply moving average window to original data, before
-            #   the data filters were applied, so make a new Analysis_Group
-            a_group.profile_filters.m_avg_win = x
-            new_a_group = Analysis_Group(a_group.data_set, a_group.profile_filters, a_group.plt_params)
-            this_df = pd.concat(new_a_group.data_frames)
-            xlabel = r'$\ell$ (dbar)'
-        if x_key == 'n_pfs':
-            this_df = this_df[this_df['prof_no'] <= pf_nos[x-1]].copy()
-            xlabel = 'Number of profiles included'
-        if x_key == 'm_pts':
-            # min_samples must be an integer
-            m_pts = int(x)
-            xlabel = r'$m_{pts}$'
-        elif x_key == 'm_cls':
-            # min_cluster_size must be an integer, or None
-            if not isinstance(x, type(None)):
-                m_cls = int(x)
-            else:
-                m_cls = x
-            xlabel = r'$m_{cls}$'
-        # Run the HDBSCAN algorithm on the provided dataframe
+    ell = task['ell_size']
+    start, stop = sweep_data['rows'][ell]
+    X = sweep_data['X'][start:stop]
+    if task['n_pfs'] != 'all':
+        pf_nos = sweep_data['pf_nos'][ell]
+        if task['n_pfs'] > len(pf_nos):
+            return [], []
+        X = X[X[:, sweep_data['columns'].index('prof_no')] <= pf_nos[task['n_pfs']-1]]
+    rows = []
+    failed = []
+    for m_cls in task['m_cls_list']:
+        ahf.reset_peak_RSS()
+        tic = time.perf_counter()
         try:
-            new_df, rel_val, m_pts_out, m_cls_out, ell = ahf.HDBSCAN_(arr_of_ds, this_df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, param_sweep=True)
-        except:
-            print('rank',rank,'failed to run HDBSCAN for',x_key,'=',x)
-            break
+            # Wrap the shared clustering variables without copying them
+            this_df = pd.DataFrame(X, columns=sweep_data['columns'], copy=False)
+            # Run the HDBSCAN algorithm on the provided dataframe
+            new_df, rel_val, m_pts_out, m_cls_out, ell_out = ahf.HDBSCAN_(sweep_data['arr_of_ds'][ell], this_df, cl_x_var, cl_y_var, cl_z_var, task['m_pts'], m_cls=m_cls, param_sweep=True, m_pts_list=task['m_pts_list'], DBCV_method=ahf.get_DBCV_method(pp), ell_size=ell)
+        except Exception as e:
+            print('rank',rank,'failed to run HDBSCAN for',task['key'],'m_cls =',m_cls,':',e)
+            failed.append(m_cls)
+            continue
         # Record outputs to output object
-        output_str = str(m_pts_out)+','+str(ell)+','+str(new_df['cluster'].max()+1)+','+str(rel_val)+','+str(m_cls_out)+'\n'
-        print(output_str)
-        lines.append(output_str)
-        # lines.append(str(m_pts_out)+','+str(ell)+','+str(new_df['cluster'].max()+1)+','+str(rel_val)+','+str(m_cls_out)+'\n')
-else:
-    lines = ''
+        row = {'m_pts':m_pts_out, 'ell_size':ell_out, 'n_clusters':new_df['cluster'].max()+1, 'DBCV':rel_val, 'm_cls':m_cls_out,
+               'n_pfs':task['n_pfs'],
+               'wall_time':round(time.perf_counter()-tic, 3),
+               'peak_RSS':ahf.find_peak_RSS()}
+        print(row)
+        rows.append(row)
+    return rows, failed
+
+################################################################################
+
+def try_task(task):
+    """
+    Runs one task, returning a tuple of the task, the list of values to record
+    for each point that ran, and the list of values of m_cls that failed
+
+    task            A dictionary returned by make_tasks()
+    """
+    try:
+        rows, failed = run_task(sweep_data, task)
+    except Exception as e:
+        print('rank',rank,'failed to run',task['key'],':',e)
+        rows, failed = [], list(task['m_cls_list'])
+    return task, rows, failed
+
+################################################################################
+
+def find_todo(tasks, arr_of_ds):
+    """
+    Returns the tasks with only the values of m_cls that aren't already in the
+    output file, leaving out any tasks with none left
+
+    tasks           A list of tasks returned by make_tasks()
+    arr_of_ds       A dictionary of the lists of datasets for each ell_size
+    """
+    todo = []
+    n_done = 0
+    for task in tasks:
+        ell = task['ell_size']
+        if isinstance(ell, type(None)):
+            ell = ahf.find_ell_size(arr_of_ds[None])
+        m_cls_list = [m_cls for m_cls in task['m_cls_list'] if isinstance(sweep_results.get_point(task['m_pts'], m_cls, ell, task['n_pfs']), type(None))]
+        n_done += len(task['m_cls_list']) - len(m_cls_list)
+        if len(m_cls_list) > 0:
+            todo.append(dict(task, m_cls_list=m_cls_list))
+    if n_done > 0:
+        print('Skipping',n_done,'points already in',sweep_results.csv_file)
+    return todo
+
 ################################################################################
 
-# Gather the data from all the processes
-lines = comm.gather(lines, root=0)
-if rank == 0:
-    output_lines = []
-    for entry in lines:
-        output_lines.append(''.join(entry))
-    print(output_lines)
-    f = open(sweep_txt_file,'a')
-    f.write(''.join(output_lines))
-    f.close()
+def schedule_tasks(tasks, run_batch, n_retries):
+    """
+    Hands out the tasks to workers on demand and records each point in the
+    output file as soon as it comes back. The values of m_cls that fail in a
+    task are put at the back of the queue as a new task until they have been
+    tried n_retries more times
 
+    tasks           A list of tasks returned by make_tasks()
+    run_batch       A function that takes a list of tasks and yields the
+                        results of try_task() as each one finishes
+    n_retries       An integer of the number of times to retry a failed point
+    """
+    n_tries = {}
+    queue = tasks
+    while len(queue) > 0:
+        retry = []
+        for task, rows, failed in run_batch(queue):
+            for row in rows:
+                sweep_results.add_point(**row)
+            m_cls_list = []
+            for m_cls in failed:
+                pt_key = task['key']+(m_cls,)
+                n_tries[pt_key] = n_tries.get(pt_key, 0) + 1
+                if n_tries[pt_key] <= n_retries:
+                    m_cls_list.append(m_cls)
+                else:
+                    print('Skipping',pt_key,'after',n_tries[pt_key],'tries')
+            if len(m_cls_list) > 0:
+                retry.append(dict(task, m_cls_list=m_cls_list))
+        queue = retry
 
+################################################################################
+
+def run_batch_local(queue):
+    """
+    Yields the results of each task in the queue from a local pool of processes,
+    which each take the next task as soon as they finish their last one
+
+    queue           A list of tasks to run
+    """
+    for result in local_pool.imap_unordered(try_task, queue, chunksize=1):
+        yield result
+
+################################################################################
+
+def run_batch_mpi(queue):
+    """
+    Yields the results of each task in the queue from the MPI worker ranks,
+    sending each free worker the next task until the queue is empty
+
+    queue           A list of tasks to run
+    """
+    queue = deque(queue)
+    n_busy = 0
+    status = MPI.Status()
+    # Hand out tasks to the idle workers, then as each result comes back
+    while len(queue) > 0 or n_busy > 0:
+        if len(idle_workers) > 0 and len(queue) > 0:
+            comm.send(queue.popleft(), dest=idle_workers.pop(), tag=tag_task)
+            n_busy += 1
+            continue
+        result = comm.recv(source=MPI.ANY_SOURCE, tag=tag_ready, status=status)
+        idle_workers.append(status.Get_source())
+        if not isinstance(result, type(None)):
+            n_busy -= 1
+            yield result
+
+################################################################################
+
+def find_n_fit():
+    """
+    Returns the number of working processes that fit in the memory of this node
+    with `mem_per_rank`, or None if there is no limit
+    """
+    if mem_per_rank <= 0:
+        return None
+    node_mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9
+    return max(1, int(node_mem / mem_per_rank))
+
+################################################################################
+# Start the parameter sweeps
+
+all_tasks = make_tasks(sweep_plan)
+print('\trank',rank,'running',len(sweep_plan),'points in',len(all_tasks),'tasks')
+if n_local == 0 and size > 1:
+    # Only use as many ranks on each node as fit in its memory. Rank 0 only
+    #   loads the data and hands out tasks, so it doesn't count against the
+    #   memory of its node
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    node_rank = node_comm.Get_rank()
+    has_master = node_comm.allreduce(rank == 0, op=MPI.LOR)
+    n_fit = find_n_fit()
+    is_worker = rank != 0 and (isinstance(n_fit, type(None)) or node_rank < n_fit + int(has_master))
+    n_workers = comm.allreduce(int(is_worker), op=MPI.SUM)
+    if rank == 0:
+        print('Running the sweep on',n_workers,'of',size,'ranks')
+        idle_workers = []
+elif n_local > 0:
+    n_fit = find_n_fit()
+    if not isinstance(n_fit, type(None)) and n_fit < n_local:
+        print('Only',n_fit,'processes fit in memory, using',n_fit,'instead of',n_local)
+        n_local = n_fit
+# Run each BGR period in turn, all ranks go through the same periods
+for BGR in sweep_vals['BGR']:
+    tasks = [task for task in all_tasks if task['BGR'] == BGR]
+    ell_list = list(dict.fromkeys([task['ell_size'] for task in tasks]))
+    use_pfs = any([task['n_pfs'] != 'all' for task in tasks])
+    # Only handle file I/O on the root process
+    if rank == 0:
+        # Open a text file to record values from the parameter sweep
+        sweep_results = ahf.Sweep_Results('outputs/'+BGR+'_ps.csv', BGR, resume=resume)
+    if n_local > 0:
+        # Load the data once, put the clustering variables in shared memory,
+        #   and drop the rest
+        meta, X = split_sweep_data(load_sweep_data(BGR, ell_list), use_pfs)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, X.nbytes))
+        np.ndarray(X.shape, dtype=float, buffer=shm.buf)[:] = X
+        del X
+        local_pool = multiprocessing.get_context('fork').Pool(n_local, initializer=attach_shared_local, initargs=(shm.name, meta))
+        schedule_tasks(find_todo(tasks, meta['arr_of_ds']), run_batch_local, n_retries)
+        local_pool.close()
+        local_pool.join()
+        shm.close()
+        shm.unlink()
+    elif size == 1:
+        # No workers to hand tasks to, so run them all here
+        meta, X = split_sweep_data(load_sweep_data(BGR, ell_list), use_pfs)
+        sweep_data = join_sweep_data(meta, X)
+        schedule_tasks(find_todo(tasks, meta['arr_of_ds']), lambda queue: map(try_task, queue), n_retries)
+    else:
+        # Load the data on rank 0 and share the clustering variables on each node
+        meta = None
+        X = None
+        if rank == 0:
+            meta, X = split_sweep_data(load_sweep_data(BGR, ell_list), use_pfs)
+        meta = comm.bcast(meta, root=0)
+        X_shared, win = share_mpi(X, meta['shape'])
+        del X
+        sweep_data = join_sweep_data(meta, X_shared)
+        if rank == 0:
+            schedule_tasks(find_todo(tasks, meta['arr_of_ds']), run_batch_mpi, n_retries)
+            # Tell the workers there are no more tasks, including any that
+            #   haven't asked for one yet
+            status = MPI.Status()
+            while len(idle_workers) < n_workers:
+                comm.recv(source=MPI.ANY_SOURCE, tag=tag_ready, status=status)
+                idle_workers.append(status.Get_source())
+            for worker in idle_workers:
+                comm.send(None, dest=worker, tag=tag_stop)
+            idle_workers = []
+        elif is_worker:
+            # Ask for a task, then send back each result when asking for the next
+            comm.send(None, dest=0, tag=tag_ready)
+            while True:
+                status = MPI.Status()
+                task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+                if status.Get_tag() == tag_stop:
+                    break
+                comm.send(try_task(task), dest=0, tag=tag_ready)
+        # Free the shared window before the next period
+        del sweep_data, X_shared
+        win.Free()
+    if rank == 0:
+        print('Results written to',sweep_results.csv_file)
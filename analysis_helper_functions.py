@@ -34,6 +34,30 @@ import re
 from datetime import datetime
 # For reading netcdf files
 import xarray as xr
+# For checking cache files
+import os
+# For copying netcdfs before updating them
+import shutil
+# For the least recently used cache of moving averages
+from collections import OrderedDict
+# For lazily loading netcdfs in chunks
+try:
+    import dask
+except:
+    dask = None
+import hashlib
+# For recording the peak memory of parameter sweep runs
+import resource
+import time
+try:
+    import pyarrow.parquet as pq
+except:
+    pq = None
+# For writing just the changed variables of a netcdf
+try:
+    import netCDF4
+except:
+    netCDF4 = None
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
 # For finding alpha and beta values
 import gsw
@@ -45,8 +69,29 @@ import scipy.ndimage as ndimage
 from scipy import interpolate
 # For getting zscores to find outliers and for least squares
 from scipy import stats
+# For finding the minimum spanning trees of clusters for DBCV
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components
 # For making clusters
 import hdbscan
+# For reusing the trees of HDBSCAN between clusterings, which needs some of
+#   its private functions that may move between versions
+try:
+    from hdbscan.hdbscan_ import _tree_to_labels
+except:
+    print('Warning: could not import _tree_to_labels from the hdbscan package, not reusing trees between clusterings')
+    _tree_to_labels = None
+try:
+    from hdbscan._hdbscan_linkage import mst_linkage_core_vector, label
+    from hdbscan.dist_metrics import DistanceMetric
+except:
+    print('Warning: could not import the minimum spanning tree functions of the hdbscan package, not sharing core distances between clusterings')
+    mst_linkage_core_vector = None
+    label = None
+    DistanceMetric = None
+from sklearn.neighbors import KDTree
+import inspect
+import copy
 # For calculating the distance between pairs of (latitude, longitude)
 from geopy.distance import geodesic
 # For calculating Orthogonal Distance Regression for Total Least Squares
@@ -253,6 +298,58 @@ clstr_ps_ind_vars = ['m_pts', 'n_pfs', 'ell_size']
 #   Dependent variables
 clstr_ps_dep_vars = ['DBCV', 'n_clusters']
 clstr_ps_vars = clstr_ps_ind_vars + clstr_ps_dep_vars
+# For caching moving averages across parameter sweeps of ell_size
+#   The variables for which to take moving averages
+m_avg_vars = ['iT', 'CT', 'PT', 'SP', 'SA', 'sigma']
+#   In memory, keyed by (source, m_avg_win), least recently used at the front
+m_avg_cache = OrderedDict()
+#   The maximum number of entries to keep in memory
+m_avg_cache_max = 16
+#   On disk, next to the netcdfs
+m_avg_cache_dir = 'netcdfs/m_avg_cache/'
+# The number of profiles per chunk when lazily loading netcdfs
+lazy_chunk_size = 500
+# For writing netcdfs with write_netcdf(), compressed and chunked to read a few profiles at a time
+#   The zlib compression level, from 1 (fastest) to 9 (smallest)
+nc_complevel = 4
+#   The number of profiles per chunk along `Time`, and of measurements per chunk along `obs`
+nc_chunk_pfs = 64
+nc_chunk_obs = 65536
+#   The integer types to store some variables as, missing values become the smallest value of the type
+nc_int_vars = {'cluster':'int16', 'ss_mask':'int8', 'BL_yn':'int8', 'up_cast':'int8'}
+# A lookup of the `Time` indices of each profile number, keyed by (source, modified time)
+pf_index_cache = {}
+# For caching the flattened data frames of each source, partitioned by source
+#   into parquet files named by a hash of the profiles, filters, and window
+df_cache_dir = 'netcdfs/df_cache/'
+# For reusing the single linkage tree of HDBSCAN across parameter sweeps of m_cls
+#   In memory, keyed by (hash of the clustering data, m_pts), least recently used at the front
+hdbscan_cache = OrderedDict()
+#   The maximum number of entries to keep in memory
+hdbscan_cache_max = 4
+# For reusing core distances across parameter sweeps of m_pts
+#   In memory, keyed by hash of the clustering data, a dictionary of arrays keyed by m_pts
+core_dist_cache = OrderedDict()
+#   The maximum number of neighbour distances to hold at once when finding core distances
+core_dist_chunk_size = 20000000
+# The score and range of the subsample scores of the last clustering scored with
+#   DBCV_method 'subsample', see find_DBCV_subsample()
+last_DBCV_range = {'DBCV':None, 'range':None}
+# For clustering new profiles without refitting, with extra_args 're_run_clstr':'incremental'
+#   The model of the last clustering, with the pickle file it came from, to save next to the netcdf
+last_clstr_model = {'model':None, 'file':None}
+#   Refit if there are more new points than this fraction of the points the model was fit to
+incr_max_new_frac = 0.2
+#   Refit if more than this fraction of the new points have a membership probability below incr_min_prob
+incr_min_prob = 0.05
+incr_max_low_prob_frac = 0.3
+#   Refit if the mean of the new points has moved more than this many standard deviations
+incr_max_drift = 0.5
+#   The number of clustered points used to match the labels of the model to those in the netcdf
+incr_n_map_pts = 20000
+# For loading clustering results instead of refitting, keyed by a hash of the
+#   clustered points and all the clustering parameters, set to None to turn off
+clstr_store_dir = 'netcdfs/clstr_store/'
 
 ################################################################################
 # Declare classes for custom objects
@@ -269,12 +366,23 @@ class Data_Set:
                     where the keys are the netcdf filenames without the extension
                     and the values are lists of profiles to include or 'all'
     data_filters    A custom Data_Filters object that contains the filters to apply
+    lazy            True/False whether to open the netcdfs lazily, in chunks along
+                        `Time`, so that only the variables an Analysis_Group keeps
+                        are read from disk, when they are converted to data frames
+    df_cache        True/False whether Analysis_Groups read the data frames of
+                        these datasets from parquet files in `df_cache_dir`,
+                        making the files the first time they are needed
     """
-    def __init__(self, sources_dict, data_filters):
+    def __init__(self, sources_dict, data_filters, lazy=False, df_cache=False):
         # Load just the relevant profiles into the xarrays
         self.sources_dict = sources_dict
         self.data_filters = data_filters
-        self.xarrs, self.var_attr_dicts = list_xarrays(sources_dict)
+        self.lazy = lazy
+        if df_cache and isinstance(pq, type(None)):
+            print('Warning: could not import the pyarrow package, not caching data frames')
+            df_cache = False
+        self.df_cache = df_cache
+        self.xarrs, self.var_attr_dicts = list_xarrays(sources_dict, lazy=lazy)
         self.arr_of_ds = apply_data_filters(self.xarrs, data_filters)
 
 ################################################################################
@@ -333,7 +441,7 @@ class Analysis_Group:
         self.plot_title = plot_title
         self.vars_to_keep = find_vars_to_keep(plt_params, profile_filters, self.vars_available)
         # Load just the relevant profiles into the xarrays
-        self.data_frames = apply_profile_filters(data_set.arr_of_ds, self.vars_to_keep, profile_filters, plt_params)
+        self.data_frames = apply_profile_filters(data_set.arr_of_ds, self.vars_to_keep, profile_filters, plt_params, data_set=data_set)
     def __setitem__(self, key, value):
         setattr(self, key, value)
     def __getitem__(self, key):
@@ -504,11 +612,84 @@ class Plot_Parameters:
         else:
             self.extra_args = extra_args
 
+################################################################################
+
+class Sweep_Results:
+    """
+    Records the outcome of each point in a clustering parameter sweep to a csv
+    file, flushed to disk as soon as the point finishes, so that a sweep that
+    gets killed only loses the points that were still running. The first two
+    lines are a title and a date, so the file can be read with
+    `pd.read_csv(csv_file, header=2)`
+
+    csv_file        A string of the path of the csv file
+    title           A string of the title of the sweep, for the first line
+    resume          True/False whether to keep the points already in the file,
+                        so they can be skipped, or start a new file
+    """
+    columns = ['m_pts','ell_size','n_clusters','DBCV','m_cls','n_pfs','wall_time','peak_RSS']
+    def __init__(self, csv_file, title, resume=False):
+        self.csv_file = csv_file
+        self.rows = {}
+        if resume and os.path.isfile(csv_file):
+            try:
+                df = pd.read_csv(csv_file, header=2, dtype=str, on_bad_lines='skip')
+            except:
+                df = pd.DataFrame(columns=self.columns)
+            # Rows from before `n_pfs` was recorded included all profiles
+            if 'n_pfs' not in df.columns:
+                df['n_pfs'] = 'all'
+            df = df.reindex(columns=self.columns).dropna(subset=['m_pts','ell_size','m_cls'])
+            for row in df.fillna('').to_dict('records'):
+                self.rows[self.point_key(row['m_pts'], row['m_cls'], row['ell_size'], row['n_pfs'])] = row
+            print('\tResuming',csv_file,'with',len(self.rows),'points already done')
+        # Write the header and any rows to keep, replacing the file all at once
+        #   so a partly written last line from a crash is dropped
+        tmp_file = csv_file+'.tmp'
+        f = open(tmp_file,'w')
+        f.write('Parameter Sweep for '+title+'\n')
+        f.write(datetime.now().strftime("%I:%M%p on %B %d, %Y")+'\n')
+        f.write(','.join(self.columns)+'\n')
+        for row in self.rows.values():
+            f.write(','.join([str(row[col]) for col in self.columns])+'\n')
+        f.close()
+        os.replace(tmp_file, csv_file)
+    def point_key(self, m_pts, m_cls, ell_size, n_pfs='all'):
+        """
+        Returns a tuple of strings that identifies a point in the sweep
+        """
+        key = []
+        for val in [m_pts, m_cls, ell_size, n_pfs]:
+            try:
+                key.append(str(int(float(val))))
+            except:
+                key.append(str(val))
+        return tuple(key)
+    def get_point(self, m_pts, m_cls, ell_size, n_pfs='all'):
+        """
+        Returns the dictionary of the row recorded for the given point, or None
+        if it hasn't been recorded. If m_cls is 'auto', it's the same as m_pts
+        """
+        if m_cls == 'auto':
+            m_cls = m_pts
+        return self.rows.get(self.point_key(m_pts, m_cls, ell_size, n_pfs))
+    def add_point(self, m_pts, ell_size, n_clusters, DBCV, m_cls, n_pfs='all', wall_time='', peak_RSS=''):
+        """
+        Appends one row to the csv file and makes sure it reaches the disk
+        """
+        row = {'m_pts':m_pts, 'ell_size':ell_size, 'n_clusters':n_clusters, 'DBCV':DBCV, 'm_cls':m_cls, 'n_pfs':n_pfs, 'wall_time':wall_time, 'peak_RSS':peak_RSS}
+        f = open(self.csv_file,'a')
+        f.write(','.join([str(row[col]) for col in self.columns])+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.rows[self.point_key(m_pts, m_cls, ell_size, n_pfs)] = row
+
 ################################################################################
 # Define class functions #######################################################
 ################################################################################
 
-def list_xarrays(sources_dict):
+def list_xarrays(sources_dict, lazy=False):
     """
     Returns a list of xarrays, one for each data source as specified by the
     input dictionary
@@ -517,13 +698,28 @@ def list_xarrays(sources_dict):
                     {'ITP_1':[13,22,32],'ITP_2':'all'}
                     where the keys are the netcdf filenames without the extension
                     and the values are lists of profiles to include or 'all'
+    lazy            True/False whether to open the netcdfs lazily, in chunks of
+                        `lazy_chunk_size` profiles, instead of loading them into memory
+    Note: Netcdfs made with `make_netcdf.read_instrmt(..., ragged=True)` are kept
+        as contiguous ragged arrays, with the vertical data along `obs`
     """
+    if lazy and isinstance(dask, type(None)):
+        print('Warning: could not import the dask package, loading netcdfs into memory')
+        lazy = False
     # Make an empty list
     xarrays = []
     var_attr_dicts = []
     for source in sources_dict.keys():
-        print('Loading data from netcdfs/'+source+'.nc')
-        ds = xr.load_dataset('netcdfs/'+source+'.nc')
+        if lazy:
+            print('Opening data lazily from netcdfs/'+source+'.nc')
+            ds = xr.open_dataset('netcdfs/'+source+'.nc', chunks={'Time':lazy_chunk_size})
+            # Load the per profile variables, which are small and needed to filter profiles
+            for this_var in list(ds.keys()):
+                if ds[this_var].dims == ('Time',):
+                    ds[this_var].load()
+        else:
+            print('Loading data from netcdfs/'+source+'.nc')
+            ds = xr.load_dataset('netcdfs/'+source+'.nc')
         # Build the dictionary of netcdf attributes, variables, units, etc.
         var_attrs = {}
         for this_var in list(ds.keys()):
@@ -534,12 +730,9 @@ def list_xarrays(sources_dict):
         # Check whether to only take certain profiles
         pf_list = sources_dict[source]
         if isinstance(pf_list, list):
-            # Start a blank list for all the profile-specific xarrays
-            temp_list = []
-            for pf in pf_list:
-                temp_list.append(ds.where(ds.prof_no==pf, drop=True).squeeze())
-            # Concatonate all those xarrays together
-            ds1 = xr.concat(temp_list, 'Time')
+            # Select all the profiles at once by their indices along `Time`
+            pf_idx = find_pf_indices(source, ds, pf_list)
+            ds1 = select_pfs(ds, pf_idx)
             xarrays.append(ds1)
         # Take all profiles
         elif pf_list=='all':
@@ -553,6 +746,100 @@ def list_xarrays(sources_dict):
 
 ################################################################################
 
+def find_pf_indices(source, ds, pf_list):
+    """
+    Returns an array of the indices along `Time` of the given profiles in the
+    dataset, in the order of pf_list, using a lookup of the profile numbers that
+    is cached for each netcdf
+
+    source          The netcdf filename without the extension, as in sources_dict
+    ds              An xarray loaded from that netcdf
+    pf_list         A list of the profile numbers to find
+    """
+    nc_path = 'netcdfs/'+source+'.nc'
+    if os.path.isfile(nc_path):
+        key = (source, os.path.getmtime(nc_path))
+    else:
+        key = (source, None)
+    # Sort the profile numbers once, keeping profiles with the same number in order
+    if key not in pf_index_cache:
+        prof_nos = np.array(ds['prof_no'].values)
+        sort_idx = np.argsort(prof_nos, kind='stable')
+        pf_index_cache[key] = (prof_nos[sort_idx], sort_idx)
+    sorted_pfs, sort_idx = pf_index_cache[key]
+    # Find the range of sorted positions for each profile number
+    pf_arr = np.array(pd.unique(np.array(pf_list)))
+    lo = np.searchsorted(sorted_pfs, pf_arr, side='left')
+    hi = np.searchsorted(sorted_pfs, pf_arr, side='right')
+    counts = hi - lo
+    if any(counts == 0):
+        print('\t- Profiles not found in',source+':',pf_arr[counts == 0].tolist())
+    # Expand those ranges into one array of positions
+    offsets = np.cumsum(counts) - counts
+    positions = np.repeat(lo - offsets, counts) + np.arange(counts.sum())
+    return sort_idx[positions]
+
+################################################################################
+
+def find_obs_indices(row_size, pf_idx):
+    """
+    Returns an array of the indices along `obs` of all the points in the given
+    profiles of a dataset stored as contiguous ragged arrays, in order
+
+    row_size        An array of the number of points in each profile
+    pf_idx          An array of the indices of the profiles along `Time`
+    """
+    row_size = np.array(row_size, dtype=int)
+    starts = np.cumsum(row_size) - row_size
+    counts = row_size[pf_idx]
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts[pf_idx] - offsets, counts) + np.arange(counts.sum())
+
+################################################################################
+
+def select_pfs(ds, pf_idx):
+    """
+    Returns the dataset with just the profiles at the given indices along `Time`.
+    For datasets stored as contiguous ragged arrays, the points of those profiles
+    are selected along `obs` as well
+
+    ds              An xarray from list_xarrays()
+    pf_idx          An array of the indices of the profiles along `Time`, or a
+                        boolean array of which profiles to keep
+    """
+    pf_idx = np.array(pf_idx)
+    if pf_idx.dtype == bool:
+        pf_idx = np.flatnonzero(pf_idx)
+    if 'row_size' in ds.keys():
+        return ds.isel(Time=pf_idx, obs=find_obs_indices(ds['row_size'].values, pf_idx))
+    else:
+        return ds.isel(Time=pf_idx)
+
+################################################################################
+
+def find_pt_values(ds, var, pf_times, verts):
+    """
+    Returns an array of the values of a variable at the given points, where the
+    points are the (`Time`, `Vertical`) index pairs of rows in a data frame. For
+    datasets stored as contiguous ragged arrays, `Vertical` counts the points
+    from the start of each profile
+
+    ds              An xarray from list_xarrays()
+    var             A string of the name of the variable
+    pf_times        An array of the `Time` values of the points
+    verts           An array of the `Vertical` values of the points
+    """
+    t_idx = pd.Index(ds['Time'].values).get_indexer(pf_times)
+    if 'row_size' in ds.keys():
+        row_size = np.array(ds['row_size'].values, dtype=int)
+        starts = np.cumsum(row_size) - row_size
+        return ds[var].values[starts[t_idx] + np.array(verts)]
+    else:
+        v_idx = pd.Index(ds['Vertical'].values).get_indexer(verts)
+        return ds[var].transpose('Time', 'Vertical').values[t_idx, v_idx]
+
+################################################################################
+
 def apply_data_filters(xarrays, data_filters):
     """
     Returns a list of the same xarrays as provided, but with the filters applied
@@ -565,21 +852,24 @@ def apply_data_filters(xarrays, data_filters):
     i = 0
     for ds in xarrays:
         ## Filters on a per-profile basis
-        ##      I turned off squeezing because it drops the `Time` dimension if
-        ##      you only pass in one profile per dataset
+        ##      Each filter adds to one boolean mask along `Time`, then the
+        ##      profiles are selected with a single `isel` at the end, which
+        ##      avoids copying all the variables and upcasting ints and bools
+        ##      to floats for every filter
+        keep_pfs = np.ones(ds.sizes['Time'], dtype=bool)
         #   Filter to just every 10th odd profile
-        # ds = ds.where((ds.prof_no+1)%100==0, drop=True)
+        # keep_pfs &= (ds.prof_no.values+1)%100==0
         #   Filter based on the black list
         if data_filters.keep_black_list == False:
-            ds = ds.where(ds.BL_yn==False, drop=True)#.squeeze()
+            keep_pfs &= np.array(ds.BL_yn.values==False)
         #   Filter based on the cast direction
         if data_filters.cast_direction == 'up':
-            ds = ds.where(ds.up_cast==True, drop=True)#.squeeze()
+            keep_pfs &= np.array(ds.up_cast.values==True)
         elif data_filters.cast_direction == 'down':
-            ds = ds.where(ds.up_cast==False, drop=True)#.squeeze()
+            keep_pfs &= np.array(ds.up_cast.values==False)
         #   Filter based on the geographical region
         if data_filters.geo_extent == 'CB':
-            ds = ds.where(ds.region=='CB', drop=True)#.squeeze()
+            keep_pfs &= np.array(ds.region.values=='CB')
         #   Filter based on the date range
         if not isinstance(data_filters.date_range, type(None)):
             # Allow for date ranges that do or don't specify the time
@@ -591,50 +881,67 @@ def apply_data_filters(xarrays, data_filters):
                 end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d %H:%M:%S')
             except:
                 end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d')
-            try:
-                ds = ds.sel(Time=slice(start_date_range, end_date_range))
-                # print('\t- Filtering to the period',start_date_range,end_date_range)
-            except:
-                print('ERROR: cannot take time slice for')
-                print('\t',ds.attrs['Source'],ds.attrs['Instrument'])
-                # exit(0)
+            # Both ends of the range are inclusive, as with `sel(Time=slice())`
+            pf_times = ds['Time'].values
+            keep_pfs &= (pf_times >= np.datetime64(start_date_range)) & (pf_times <= np.datetime64(end_date_range))
+            # print('\t- Filtering to the period',start_date_range,end_date_range)
         #   Only keep profiles where press_max is deeper than min_press
         if not isinstance(data_filters.min_press, type(None)):
             if False:
-                pf_list = list(set(ds.prof_no.values))
-            ds = ds.where(ds.press_max>=data_filters.min_press, drop=True)#.squeeze()
+                pf_list = list(set(ds.prof_no.values[keep_pfs]))
+            keep_pfs &= np.array(ds.press_max.values>=data_filters.min_press)
             if False:
-                pf_list2 = list(set(ds.prof_no.values))
+                pf_list2 = list(set(ds.prof_no.values[keep_pfs]))
                 # Find the eliminated profiles
                 elim_list = [x for x in pf_list if x not in pf_list2]
                 print('p_max filter, # of profiles before:',len(pf_list),'after:',len(pf_list2),'difference:',len(pf_list)-len(pf_list2))#,'-',elim_list)
         #
         #   Only keep profiles with press_TC_min within the specified range
         if not isinstance(data_filters.press_TC_min_range, type(None)):
-            ds = ds.where(ds.press_TC_min>=min(data_filters.press_TC_min_range), drop=True)
-            ds = ds.where(ds.press_TC_min<=max(data_filters.press_TC_min_range), drop=True)
+            keep_pfs &= np.array(ds.press_TC_min.values>=min(data_filters.press_TC_min_range))
+            keep_pfs &= np.array(ds.press_TC_min.values<=max(data_filters.press_TC_min_range))
         #   Only keep profiles with press_TC_max within the specified range
         if not isinstance(data_filters.press_TC_max_range, type(None)):
-            ds = ds.where(ds.press_TC_max>=min(data_filters.press_TC_max_range), drop=True)
-            ds = ds.where(ds.press_TC_max<=max(data_filters.press_TC_max_range), drop=True)
+            keep_pfs &= np.array(ds.press_TC_max.values>=min(data_filters.press_TC_max_range))
+            keep_pfs &= np.array(ds.press_TC_max.values<=max(data_filters.press_TC_max_range))
         #
         #   Filter to just certain cluster labels
+        #       The cluster labels are per point, so these also mask the points
+        #       in other clusters within the profiles that are kept
+        keep_pts = None
         if isinstance(data_filters.clstr_labels, type(None)):
             foo = 2
         elif data_filters.clstr_labels == 'no_noise':
             # print('ds variables:')
             # print(list(ds.keys()))
             # print('')
-            ds = ds.where(ds.cluster != -1, drop=True)#.squeeze()
+            keep_pts = np.array(ds.cluster.values != -1)
         elif len(data_filters.clstr_labels) > 0:
-            list_of_ds_clstrs = []
             print('data_filters.clstr_labels:',data_filters.clstr_labels)
             these_clstr_labels = data_filters.clstr_labels[i]
             print('\t- Filtering to just these cluster labels:',these_clstr_labels)
-            for this_clstr_label in these_clstr_labels:
-                this_ds = ds.where(ds.cluster == this_clstr_label, drop=True)#.squeeze()
-                list_of_ds_clstrs.append(this_ds)
-            ds = xr.concat(list_of_ds_clstrs, dim='Time')
+            keep_pts = np.isin(ds.cluster.values, these_clstr_labels)
+        if isinstance(keep_pts, type(None)):
+            ds = select_pfs(ds, keep_pfs)
+        elif 'row_size' in ds.keys():
+            # Drop profiles without any points to keep
+            pf_of_obs = np.repeat(np.arange(ds.sizes['Time']), ds['row_size'].values)
+            keep_pts = keep_pts & keep_pfs[pf_of_obs]
+            keep_pfs = np.bincount(pf_of_obs[keep_pts], minlength=ds.sizes['Time']) > 0
+            keep_pts = keep_pts[find_obs_indices(ds['row_size'].values, np.flatnonzero(keep_pfs))]
+            ds = select_pfs(ds, keep_pfs)
+            keep_pts = xr.DataArray(keep_pts, dims=('obs',))
+        else:
+            # Drop profiles and vertical levels without any points to keep
+            keep_pts = keep_pts & keep_pfs[:,np.newaxis]
+            keep_verts = keep_pts.any(axis=0)
+            ds = ds.isel(Time=keep_pts.any(axis=1), Vertical=keep_verts)
+            keep_pts = xr.DataArray(keep_pts[keep_pts.any(axis=1)][:,keep_verts], dims=('Time','Vertical'))
+        if not isinstance(keep_pts, type(None)):
+            # Mask the other points, leaving the per-profile variables as they are
+            for var in list(ds.keys()):
+                if keep_pts.dims[-1] in ds[var].dims:
+                    ds[var] = ds[var].where(keep_pts)
         #
         i += 1
         output_arrs.append(ds)
@@ -830,7 +1137,8 @@ def find_vars_to_keep(pp, profile_filters, vars_available):
                     vars_to_keep.append(var_str)
             #
         # If re-running the clustering, remove 'cluster' from vars_to_keep
-        if re_run_clstr:
+        #   unless only adding new points to the clustering already in the file
+        if re_run_clstr and pp.extra_args.get('re_run_clstr') != 'incremental':
             try:
                 vars_to_keep.remove('cluster')
             except:
@@ -876,7 +1184,298 @@ def find_vars_to_keep(pp, profile_filters, vars_available):
 
 ################################################################################
 
-def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
+def find_df_cache_file(data_set, i, m_avg_win):
+    """
+    Returns the path of the parquet file in which to cache the data frame of the
+    ith dataset in a Data_Set, in a folder for its source, named by a hash of
+    its profiles, data filters, moving average window, and the time the netcdf
+    was last modified
+
+    data_set            A custom Data_Set object
+    i                   The index of the dataset in data_set.arr_of_ds
+    m_avg_win           The value of the moving average window in dbar, or None
+    """
+    source = list(data_set.sources_dict.keys())[i]
+    nc_path = 'netcdfs/'+source+'.nc'
+    if os.path.isfile(nc_path):
+        nc_mtime = os.path.getmtime(nc_path)
+    else:
+        nc_mtime = None
+    # The date range of a BGR period is one of the data filters
+    key_str = repr([nc_mtime, data_set.sources_dict[source], sorted(vars(data_set.data_filters).items()), m_avg_win])
+    key_hash = hashlib.md5(key_str.encode()).hexdigest()
+    return df_cache_dir+source+'/'+key_hash+'.parquet'
+
+################################################################################
+
+def flatten_ds(ds, vars_to_keep, m_avg_win=None, cache_file=None, keep_padding=False):
+    """
+    Returns a pandas data frame of the given variables of a dataset, without the
+    rows that are just padding from `make_netcdf`, where all the vertical
+    variables are null. If a cache file is given, reads the variables from it as
+    long as it has all of them, otherwise makes the data frame and writes it to
+    the cache file, so the same rows come back whether or not the cache is used
+
+    ds                  An xarray from a custom Data_Set object
+    vars_to_keep        A list of variables to keep for the analysis
+    m_avg_win           The value in dbar of the moving average window to take for ma_ variables
+    cache_file          The path to a parquet file, as from find_df_cache_file(), or None
+    keep_padding        True/False whether to keep the padding rows, which can't
+                            be used with a cache file
+    """
+    cached_vars = []
+    if not isinstance(cache_file, type(None)) and os.path.isfile(cache_file):
+        cached_vars = pq.read_schema(cache_file).names
+        if all(var in cached_vars for var in vars_to_keep):
+            # Only read the columns needed
+            return pd.read_parquet(cache_file, columns=vars_to_keep)
+    # Make the data frame, adding any other variables already in the cache
+    these_vars = list(vars_to_keep) + [var for var in cached_vars if var in ds.keys() and var not in vars_to_keep]
+    if not isinstance(m_avg_win, type(None)):
+        # Use a shallow copy so the `ma_` variables in the Data_Set are left as they were
+        ds = take_m_avg(ds.copy(), m_avg_win, these_vars)
+    if 'row_size' in ds.keys():
+        df = ragged_to_dataframe(ds, these_vars)
+    else:
+        df = ds[these_vars].to_dataframe()
+        if not keep_padding:
+            # Remove the rows that are just padding from `make_netcdf`
+            vert_vars = [var for var in these_vars if var in ds.data_vars and 'Vertical' in ds[var].dims]
+            if len(vert_vars) > 0:
+                df = df[df[vert_vars].notnull().any(axis=1)]
+    if isinstance(cache_file, type(None)):
+        return df
+    print('\t- Writing data frame to',cache_file)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    df.to_parquet(cache_file)
+    return df[vars_to_keep]
+
+################################################################################
+
+def ragged_to_dataframe(ds, these_vars):
+    """
+    Returns a pandas data frame of the given variables of a dataset stored as
+    contiguous ragged arrays, indexed by `Time` and `Vertical` like the data
+    frames of padded datasets, but without any padding rows
+
+    ds                  An xarray with vertical data along `obs` and `row_size`
+    these_vars          A list of the variables to put in the data frame
+    """
+    these_vars = [var for var in these_vars if var in ds.data_vars]
+    # With only per-profile variables, there is one row per profile
+    if not any('obs' in ds[var].dims for var in these_vars):
+        return ds[these_vars].to_dataframe()
+    row_size = np.array(ds['row_size'].values, dtype=int)
+    starts = np.cumsum(row_size) - row_size
+    pf_of_obs = np.repeat(np.arange(len(row_size)), row_size)
+    # `Vertical` counts the points from the start of each profile
+    df_index = pd.MultiIndex.from_arrays([ds['Time'].values[pf_of_obs], np.arange(len(pf_of_obs)) - starts[pf_of_obs]], names=['Time', 'Vertical'])
+    df_cols = {}
+    for var in these_vars:
+        if 'obs' in ds[var].dims:
+            df_cols[var] = ds[var].values
+        else:
+            # Repeat the per-profile values for every point in the profile
+            df_cols[var] = ds[var].values[pf_of_obs]
+    return pd.DataFrame(df_cols, index=df_index)
+
+################################################################################
+
+def dataframe_to_ds(df, pf_vars):
+    """
+    Returns an xarray of a data frame indexed by `Time` and `Vertical`, as
+    from Analysis_Group.data_frames, the reverse of ds.to_dataframe(), with the
+    per-profile variables, those in pf_vars, taking the first value in each
+    profile that isn't missing along `Time` only, and the rest scattered onto
+    (`Time`, `Vertical`) arrays, padded with NaN, all without going through the
+    full grid of every variable that df.to_xarray() makes
+
+    df                  A pandas data frame with a (`Time`, `Vertical`) index
+    pf_vars             A list of the variables that have one value per profile
+    """
+    index = df.index.remove_unused_levels()
+    time_name, vert_name = index.names
+    # The positions along each dimension, sorted like df.to_xarray() would
+    time_vals, vert_vals = index.levels
+    i_time, i_vert = index.codes
+    i_time = np.asarray(i_time)
+    i_vert = np.asarray(i_vert)
+    data_vars = {}
+    these_pf_vars = [var for var in df.columns if var in pf_vars]
+    if len(these_pf_vars) > 0:
+        # first() skips missing values within each profile
+        pf_df = df[these_pf_vars].groupby(i_time).first().reindex(np.arange(len(time_vals)))
+        for var in these_pf_vars:
+            data_vars[var] = ((time_name,), pf_df[var].to_numpy())
+    shape = (len(time_vals), len(vert_vals))
+    # Whether every (Time, Vertical) pair is in the data frame, otherwise some are padding
+    full_grid = (len(df) == shape[0]*shape[1])
+    for var in df.columns:
+        if var in these_pf_vars:
+            continue
+        these_vals = df[var].to_numpy()
+        if full_grid or these_vals.dtype.kind in 'fcmMO':
+            grid_dtype = these_vals.dtype
+        elif these_vals.dtype.kind in 'iu':
+            grid_dtype = np.dtype(float)
+        else:
+            grid_dtype = np.dtype(object)
+        if grid_dtype.kind == 'm':
+            fill = np.timedelta64('NaT')
+        elif grid_dtype.kind == 'M':
+            fill = np.datetime64('NaT')
+        else:
+            fill = np.nan
+        grid = np.full(shape, fill, dtype=grid_dtype)
+        grid[i_time, i_vert] = these_vals
+        data_vars[var] = ((time_name, vert_name), grid)
+    return xr.Dataset(data_vars, coords={time_name:np.asarray(time_vals), vert_name:np.asarray(vert_vals)})
+
+################################################################################
+
+def update_netcdf(nc_file, ds, these_vars, from_nc=None):
+    """
+    Writes the given variables and all the global attributes of a dataset to a
+    netcdf, only overwriting those variables in the file instead of rewriting
+    every variable. If the file doesn't have one of the variables with the same
+    dimensions and shape, or the values can't be written to the variable as it
+    is stored, loads the whole netcdf, puts in the given variables, and rewrites
+    it with write_netcdf(). Returns True if the file was updated in place
+
+    nc_file             The path of the netcdf to write to
+    ds                  An xarray loaded from that netcdf, or from from_nc, which
+                            may have only some of its variables
+    these_vars          A list of the numeric variables that were changed
+    from_nc             The path of a netcdf to copy to nc_file first, or None
+                            to update nc_file itself
+    """
+    if isinstance(from_nc, type(None)):
+        from_nc = nc_file
+    # Make changes to a copy when writing to a different file, so there is never a partial file
+    if from_nc != nc_file:
+        write_to = nc_file+'.tmp'
+        shutil.copyfile(from_nc, write_to)
+    else:
+        write_to = nc_file
+    in_place = not isinstance(netCDF4, type(None))
+    try:
+        if in_place:
+            with netCDF4.Dataset(write_to, 'a') as nc:
+                # Check the whole layout before writing anything
+                for var in these_vars:
+                    if var not in nc.variables or nc.variables[var].dimensions != ds[var].dims or nc.variables[var].shape != ds[var].shape:
+                        print('\t- Layout of',var,'has changed, rewriting',nc_file)
+                        in_place = False
+                        break
+                if in_place:
+                    try:
+                        for var in these_vars:
+                            these_vals = ds[var].values
+                            if these_vals.dtype.kind == 'O':
+                                these_vals = np.array(these_vals, dtype=float)
+                            if these_vals.dtype.kind == 'f':
+                                # Missing values become the fill value of the variable in the file
+                                is_nan = np.isnan(these_vals)
+                                these_vals = np.ma.array(np.where(is_nan, 0, these_vals), mask=is_nan)
+                            elif these_vals.dtype.kind in 'iu' and var in nc_int_vars:
+                                # As are the smallest values of the type, as in write_netcdf()
+                                is_fill = (these_vals == np.iinfo(nc_int_vars[var]).min)
+                                these_vals = np.ma.array(these_vals, mask=is_fill)
+                            nc.variables[var][:] = these_vals
+                            nc.variables[var].setncatts({k:v for k, v in ds[var].attrs.items() if not k.startswith('_')})
+                        for attr in ds.attrs:
+                            nc.setncattr(attr, str(ds.attrs[attr]))
+                    except (ValueError, TypeError) as err:
+                        # The values don't fit the type the variable is stored as
+                        print('\t- Could not update',nc_file,'in place, rewriting it:',err)
+                        in_place = False
+        if not in_place:
+            # Start from every variable in the netcdf, in case ds only has some of them
+            ds_full = xr.load_dataset(write_to)
+            if all(var in ds.variables for var in ds_full.data_vars):
+                ds_full = ds
+            else:
+                for var in these_vars:
+                    ds_full[var] = ds[var]
+                ds_full.attrs = dict(ds.attrs)
+            if write_to != nc_file:
+                os.remove(write_to)
+            write_netcdf(ds_full, nc_file)
+        elif write_to != nc_file:
+            os.replace(write_to, nc_file)
+    except:
+        # Don't leave the copy behind
+        if write_to != nc_file and os.path.isfile(write_to):
+            os.remove(write_to)
+        raise
+    return in_place
+
+################################################################################
+
+def read_netcdf_attrs(nc_file):
+    """
+    Returns a dictionary of the global attributes of a netcdf without loading
+    any of its variables
+
+    nc_file             The path of the netcdf
+    """
+    with xr.open_dataset(nc_file) as ds:
+        return dict(ds.attrs)
+
+################################################################################
+
+def write_netcdf(ds, nc_file):
+    """
+    Writes a dataset to a netcdf with the encoding all netcdfs share: zlib
+    compression with shuffle for every numeric variable, chunks of
+    `nc_chunk_pfs` profiles along `Time` or `nc_chunk_obs` measurements along
+    `obs`, the variables in `nc_int_vars` as small integers, and float32 for
+    variables whose `dtype` attribute says so. Writes to a temporary file and
+    renames it, so there is never a partial netcdf
+
+    ds                  An xarray dataset
+    nc_file             The path of the netcdf to write
+    """
+    ds = ds.copy()
+    encoding = {}
+    for var in ds.data_vars:
+        these_vals = ds[var].values
+        # Variables made from lists padded with None are stored as objects
+        if these_vals.dtype.kind == 'O':
+            # Leave strings as they are, even ones like '1', they can't be compressed
+            if pd.api.types.infer_dtype(these_vals.ravel(), skipna=True) not in ['floating', 'integer', 'mixed-integer-float', 'decimal', 'empty']:
+                continue
+            ds[var] = ds[var].astype(float)
+            these_vals = ds[var].values
+        if these_vals.dtype.kind not in 'biufmM':
+            continue
+        # Don't carry over the encoding the variable was read with
+        ds[var].encoding = {}
+        var_enc = {'zlib':True, 'complevel':nc_complevel, 'shuffle':True}
+        # Booleans are already stored as int8 and read back as booleans
+        if var in nc_int_vars and these_vals.dtype.kind != 'b':
+            var_enc['dtype'] = nc_int_vars[var]
+            var_enc['_FillValue'] = np.iinfo(nc_int_vars[var]).min
+        elif these_vals.dtype.kind == 'f' and ds[var].attrs.get('dtype') == 'float32':
+            var_enc['dtype'] = 'float32'
+        # Chunk along the profiles, keeping each profile whole
+        chunks = []
+        for dim in ds[var].dims:
+            if dim == 'Time':
+                chunks.append(min(nc_chunk_pfs, ds.sizes[dim]))
+            elif dim == 'obs':
+                chunks.append(min(nc_chunk_obs, ds.sizes[dim]))
+            else:
+                chunks.append(ds.sizes[dim])
+        if len(chunks) > 0 and min(chunks) > 0:
+            var_enc['chunksizes'] = tuple(chunks)
+        encoding[var] = var_enc
+    ds.to_netcdf(nc_file+'.tmp', 'w', encoding=encoding)
+    os.replace(nc_file+'.tmp', nc_file)
+
+################################################################################
+
+def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp, data_set=None):
     """
     Returns a list of pandas dataframes, one for each array in arr_of_ds with
     the filters applied to all individual profiles
@@ -885,6 +1484,8 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
     vars_to_keep        A list of variables to keep for the analysis
     profile_filters     A custom Profile_Filters object that contains the filters to apply
     pp                  A custom Plot_Parameters object that contains at least:
+    data_set            The custom Data_Set object arr_of_ds came from, used to find
+                            the parquet cache files if its df_cache is True
     """
     print('- Applying profile filters')
     plot_scale = pp.plot_scale
@@ -898,25 +1499,43 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
             sort_clstrs = pp.extra_args['sort_clstrs']
         else:
             sort_clstrs = False
+        # Keep the points with no cluster label, so they can be added to the clustering
+        incr_clstr = (pp.extra_args.get('re_run_clstr') == 'incremental')
+        if incr_clstr:
+            plot_vars = [var for var in plot_vars if var != 'cluster']
     else:
         sort_clstrs = False
+        incr_clstr = False
     # Make an empty list
     output_dfs = []
     # What's the plot scale?
     if plot_scale == 'by_vert':
-        for ds in arr_of_ds:
+        for i, ds in enumerate(arr_of_ds):
             # print('\t- Applying filters to',ds.Source,ds.Instrument)
+            m_avg_win = profile_filters.m_avg_win
+            # When adding new profiles to a clustering made with these same filters,
+            #   keep the moving averages saved with it, as taking them again from
+            #   profiles already cut to the pressure range would lose the points
+            #   near the ends
+            if incr_clstr and ds.attrs.get('Clustering model', 'None') != 'None' and ds.attrs.get('Clustering filters') == print_profile_filters(profile_filters):
+                m_avg_win = None
+            # Find the parquet cache file, if applicable
+            #   Keeping every nth row depends on the padding, so skip the cache then
+            if not isinstance(data_set, type(None)) and data_set.df_cache and profile_filters.every_nth_row <= 1:
+                cache_file = find_df_cache_file(data_set, i, m_avg_win)
+            else:
+                cache_file = None
             # Find extra variables, if applicable
             ds = calc_extra_vars(ds, vars_to_keep)
-            # Convert to a pandas data frame
-            df = ds[vars_to_keep].to_dataframe()
-            # Add a notes column
-            df['notes'] = ''
             #   If the m_avg_win is not None, take the moving average of the data
             if not isinstance(profile_filters.m_avg_win, type(None)):
                 # print('\t-Applying m_avg_win filter')
-                df = take_m_avg(df, profile_filters.m_avg_win, vars_to_keep)
                 ds.attrs['Moving average window'] = str(profile_filters.m_avg_win)+' dbar'
+            # Convert to a pandas data frame
+            #   Keeping every nth row counts the padding rows, as it always has
+            df = flatten_ds(ds, vars_to_keep, m_avg_win, cache_file, keep_padding=(profile_filters.every_nth_row > 1))
+            # Add a notes column
+            df['notes'] = ''
             #   True/False, apply the subsample mask to the profiles
             if profile_filters.subsample:
                 # print('\t-Applying subsample filter')
@@ -1164,7 +1783,7 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
             # Find extra variables, if applicable
             ds = calc_extra_vars(ds, vars_to_keep)
             # Convert to a pandas data frame
-            df = ds[vars_to_keep].to_dataframe()
+            df = flatten_ds(ds, vars_to_keep, keep_padding=True)
             # Add source and instrument columns if applicable
             if not 'source' in list(df):
                 df['source'] = ds.Source
@@ -1274,52 +1893,235 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
 
 ################################################################################
 
-def take_m_avg(df, m_avg_win, vars_available):
+def calc_m_avg(arr, m_avg_win):
     """
-    Returns the same pandas dataframe, but with the filters provided applied to
-    the data within
+    Returns the centered boxcar moving average along the last axis of an array.
+    Windows are taken within each profile so they never cross into the next one.
+    Any window that contains a NaN or runs off either end of the profile gives
+    NaN, matching what the pandas rolling mean returns
 
-    df                  A pandas dataframe
+    arr                 An array with dimensions (Time, Vertical) or (Vertical)
+    m_avg_win           The number of points in the moving average window
+    """
+    win = int(m_avg_win)
+    arr = np.array(arr, dtype=float)
+    n_vert = arr.shape[-1]
+    m_avg = np.full(arr.shape, np.nan)
+    if win < 1 or win > n_vert:
+        return m_avg
+    is_nan = np.isnan(arr)
+    filled = np.where(is_nan, 0.0, arr)
+    # Remove the mean of each profile to reduce round-off in the cumulative sums
+    n_valid = np.maximum((~is_nan).sum(axis=-1, keepdims=True), 1)
+    pf_mean = filled.sum(axis=-1, keepdims=True) / n_valid
+    filled = np.where(is_nan, 0.0, filled - pf_mean)
+    # Cumulative sums with a leading zero, so each window sum is a difference
+    lead_zero = [(0,0)]*(arr.ndim-1) + [(1,0)]
+    c_sum = np.pad(np.cumsum(filled, axis=-1), lead_zero)
+    c_nan = np.pad(np.cumsum(is_nan, axis=-1), lead_zero)
+    win_sums = c_sum[..., win:] - c_sum[..., :-win]
+    win_nans = c_nan[..., win:] - c_nan[..., :-win]
+    win_means = np.where(win_nans > 0, np.nan, win_sums / win + pf_mean)
+    # Put the mean of each window at its center point
+    ctr = win//2
+    m_avg[..., ctr:ctr+n_vert-win+1] = win_means
+    return m_avg
+
+################################################################################
+
+def calc_m_avg_ragged(values, row_size, m_avg_win):
+    """
+    Returns the centered boxcar moving average within each profile of a
+    contiguous ragged array, the same as calc_m_avg() returns for the padded
+    array, without padding the profiles
+
+    values              An array of the data of all the profiles, end to end
+    row_size            An array of the number of points in each profile
+    m_avg_win           The number of points in the moving average window
+    """
+    win = int(m_avg_win)
+    values = np.array(values, dtype=float)
+    row_size = np.array(row_size, dtype=int)
+    m_avg = np.full(values.shape, np.nan)
+    if win < 1 or len(values) == 0:
+        return m_avg
+    starts = np.cumsum(row_size) - row_size
+    pf_of_obs = np.repeat(np.arange(len(row_size)), row_size)
+    is_nan = np.isnan(values)
+    filled = np.where(is_nan, 0.0, values)
+    # Remove the mean of each profile to reduce round-off in the cumulative sums
+    n_valid = np.maximum(np.bincount(pf_of_obs, weights=~is_nan, minlength=len(row_size)), 1)
+    pf_mean = (np.bincount(pf_of_obs, weights=filled, minlength=len(row_size)) / n_valid)[pf_of_obs]
+    filled = np.where(is_nan, 0.0, filled - pf_mean)
+    # Cumulative sums with a leading zero, so each window sum is a difference
+    c_sum = np.concatenate([[0.0], np.cumsum(filled)])
+    c_nan = np.concatenate([[0], np.cumsum(is_nan)])
+    # Only take the windows that fit within their profile
+    ctr = win//2
+    pos = np.arange(len(values)) - starts[pf_of_obs]
+    in_pf = (pos >= ctr) & (pos - ctr + win <= row_size[pf_of_obs])
+    lo = np.flatnonzero(in_pf) - ctr
+    win_sums = c_sum[lo+win] - c_sum[lo]
+    win_nans = c_nan[lo+win] - c_nan[lo]
+    m_avg[in_pf] = np.where(win_nans > 0, np.nan, win_sums / win + pf_mean[in_pf])
+    return m_avg
+
+################################################################################
+
+def take_m_avg(ds, m_avg_win, vars_available):
+    """
+    Returns the same xarray, but with the moving average `ma_` and local anomaly
+    `la_` variables recalculated using the moving average window provided
+
+    ds                  An xarray from the arr_of_ds of a custom Data_Set object
     m_avg_win           The value of the moving average window in dbar
-    vars_available      A list of variables available in the dataframe
+    vars_available      A list of the variables to keep for the analysis
     """
     print('\tIn take_m_avg(), m_avg_win:',m_avg_win)
-    # Use the pandas `rolling` function to get the moving average
-    #   center=True makes the first and last window/2 of the profiles are masked
-    #   win_type='boxcar' uses a rectangular window shape
-    #   on='press' means it will take `press` as the index column
-    #   .mean() takes the average of the rolling
-    df1 = df.rolling(window=int(m_avg_win), center=True, win_type='boxcar', on='press').mean()
     # Put the moving average profiles for temperature, salinity, and density into the dataset
-    for var in vars_available:
-        if var in ['iT','ma_iT','la_iT']:
-            df['ma_iT'] = df1['iT']
-            if 'la_iT' in vars_available:
-                df['la_iT'] = df['iT'] - df['ma_iT']
-        if var in ['CT','ma_CT','la_CT']:
-            df['ma_CT'] = df1['CT']
-            if 'la_CT' in vars_available:
-                df['la_CT'] = df['CT'] - df['ma_CT']
-        if var in ['PT','ma_PT','la_PT']:
-            df['ma_PT'] = df1['PT']
-            if 'la_PT' in vars_available:
-                df['la_PT'] = df['PT'] - df['ma_PT']
-        if var in ['SP','ma_SP','la_SP']:
-            df['ma_SP'] = df1['SP']
-            if 'la_SP' in vars_available:
-                df['la_SP'] = df['SP'] - df['ma_SP']
-        if var in ['SA','ma_SA','la_SA']:
-            df['ma_SA'] = df1['SA']
-            if 'la_SA' in vars_available:
-                df['la_SA'] = df['SA'] - df['ma_SA']
-        if var in ['sigma','ma_sigma','la_sigma']:
-            df['ma_sigma'] = df1['sigma']
-            if 'la_sigma' in vars_available:
-                df['la_sigma'] = df['sigma'] - df['ma_sigma']
+    for var in m_avg_vars:
+        if var not in ds.keys():
+            continue
+        if var in vars_available or 'ma_'+var in vars_available or 'la_'+var in vars_available:
+            if 'obs' in ds[var].dims:
+                # Take the moving average within each profile of the ragged array
+                this_var = ds[var]
+                m_avg = calc_m_avg_ragged(this_var.values, ds['row_size'].values, m_avg_win)
+            else:
+                # Take the moving average along the `Vertical` dimension
+                this_var = ds[var].transpose(..., 'Vertical')
+                m_avg = calc_m_avg(this_var.values, m_avg_win)
+            if 'ma_'+var in ds.keys():
+                ma_attrs = ds['ma_'+var].attrs
+            else:
+                ma_attrs = {}
+            ds['ma_'+var] = (this_var.dims, m_avg, ma_attrs)
+            if 'la_'+var in vars_available:
+                ds['la_'+var] = ds[var] - ds['ma_'+var]
             #
         #
     #
-    return df
+    return ds
+
+################################################################################
+
+def get_cached_m_avg(source, ds, m_avg_win, use_disk=True):
+    """
+    Returns an xarray of the moving average `ma_` variables of the given dataset
+    with the given window, only taking the moving averages if they aren't already
+    cached in memory or on disk in `m_avg_cache_dir`
+
+    source              The netcdf filename without the extension, as in sources_dict
+    ds                  An xarray loaded from that netcdf, as from list_xarrays()
+    m_avg_win           The value of the moving average window in dbar
+    use_disk            True/False whether to read and write cache files on disk
+    """
+    key = (source, int(m_avg_win))
+    cache_file = m_avg_cache_dir+source+'_ell_'+str(int(m_avg_win))+'.nc'
+    ds_m_avg = None
+    # Check the cache in memory
+    if key in m_avg_cache:
+        ds_m_avg = m_avg_cache[key]
+    # Check the cache on disk, as long as it is newer than the netcdf
+    elif use_disk and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime('netcdfs/'+source+'.nc'):
+        print('\t- Loading moving averages from',cache_file)
+        ds_m_avg = xr.load_dataset(cache_file)
+    # Make sure the cached moving averages have all the profiles needed
+    if not isinstance(ds_m_avg, type(None)) and not np.isin(ds['Time'].values, ds_m_avg['Time'].values).all():
+        ds_m_avg = None
+    if isinstance(ds_m_avg, type(None)):
+        print('\t- Taking moving averages of',source,'with a',m_avg_win,'dbar window')
+        these_vars = [var for var in m_avg_vars if var in ds.keys()]
+        # Keep the number of points in each profile for ragged arrays
+        extra_vars = [var for var in ['row_size'] if var in ds.keys()]
+        ds_m_avg = take_m_avg(ds[these_vars+extra_vars].copy(), m_avg_win, these_vars)
+        ds_m_avg = ds_m_avg[['ma_'+var for var in these_vars]+extra_vars]
+        if use_disk:
+            os.makedirs(m_avg_cache_dir, exist_ok=True)
+            write_netcdf(ds_m_avg, cache_file)
+    # Mark as the most recently used and evict the least recently used
+    m_avg_cache[key] = ds_m_avg
+    m_avg_cache.move_to_end(key)
+    while len(m_avg_cache) > m_avg_cache_max:
+        m_avg_cache.popitem(last=False)
+    return ds_m_avg
+
+################################################################################
+
+def copy_data_set(data_set):
+    """
+    Returns a copy of a Data_Set object which shares the data of the original
+    but not the attributes of its datasets, so that making an Analysis_Group
+    with a different moving average window leaves the original unchanged
+
+    data_set            A custom Data_Set object
+    """
+    new_data_set = copy.copy(data_set)
+    new_data_set.arr_of_ds = [ds.copy(deep=False) for ds in data_set.arr_of_ds]
+    return new_data_set
+
+################################################################################
+
+def apply_m_avg_win(a_group, m_avg_win, use_disk=True):
+    """
+    Returns a list of the data frames of an Analysis_Group with the `ma_` and `la_`
+    variables switched to those for a different moving average window, taken from
+    the moving average cache, without re-applying the profile filters
+    Note: A larger window only ever masks more points, so this keeps the same rows
+        as making a new Analysis_Group as long as a_group was made with a window no
+        larger than m_avg_win. If a_group took differences or regridded, which depend
+        on the rows removed, or its data filters masked individual points, which
+        changes the moving averages, a new Analysis_Group is made instead
+    Note: Does not change a_group, its profile filters, or the attributes of its
+        datasets. Pass m_avg_win to HDBSCAN_() as `ell_size`
+
+    a_group             An Analysis_Group object made with the smallest window to use
+    m_avg_win           The value of the moving average window in dbar
+    use_disk            True/False whether to read and write cache files on disk
+    """
+    pp = a_group.plt_params
+    data_set = a_group.data_set
+    if any(pp.first_dfs) or any(pp.finit_dfs) or not isinstance(a_group.profile_filters.regrid_TS, type(None)) or not isinstance(data_set.data_filters.clstr_labels, type(None)):
+        pfs = copy.copy(a_group.profile_filters)
+        pfs.m_avg_win = m_avg_win
+        new_a_group = Analysis_Group(copy_data_set(data_set), pfs, pp)
+        return new_a_group.data_frames
+    # Find the moving average variables that were kept
+    m_avg_keys = [key for key in a_group.vars_to_keep if key in ['ma_'+var for var in m_avg_vars] + ['la_'+var for var in m_avg_vars]]
+    # Find the plotting variables, which can't have null values
+    plot_vars = pp.x_vars+pp.y_vars+[pp.clr_map]
+    if not isinstance(pp.extra_args, type(None)):
+        for key in ['cl_x_var', 'cl_y_var', 'cl_z_var']:
+            if key in pp.extra_args.keys():
+                plot_vars.append(pp.extra_args[key])
+    sources = list(data_set.sources_dict.keys())
+    output_dfs = []
+    for df in a_group.data_frames:
+        df = df.copy()
+        df_times = df.index.get_level_values('Time')
+        df_verts = df.index.get_level_values('Vertical')
+        # Find the source this data frame came from
+        for source, xarr in zip(sources, data_set.xarrs):
+            if np.isin(df_times, xarr['Time'].values).all():
+                break
+        else:
+            raise ValueError('Could not find the source of a data frame of the Analysis_Group')
+        ds_m_avg = get_cached_m_avg(source, xarr, m_avg_win, use_disk=use_disk)
+        for key in m_avg_keys:
+            var = key.split('_', 1)[1]
+            # Find the values at the rows of this data frame
+            m_avg = find_pt_values(ds_m_avg, 'ma_'+var, df_times, df_verts)
+            if key == 'ma_'+var:
+                df[key] = m_avg
+            else:
+                df[key] = find_pt_values(xarr, var, df_times, df_verts) - m_avg
+        # Remove rows where the plot variables are null
+        for var in plot_vars:
+            if var in m_avg_keys:
+                df = df[df[var].notnull()]
+        if len(df) > 0:
+            output_dfs.append(df)
+    return output_dfs
 
 ################################################################################
 
@@ -2762,7 +3564,7 @@ def make_subplot(ax, a_group, fig, ax_pos):
         if x_key in clstr_vars or y_key in clstr_vars or z_key in clstr_vars or tw_x_key in clstr_vars or tw_y_key in clstr_vars or clr_map in clstr_vars:
             print('\t- Checking for cluster-based variables')
             m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = get_cluster_args(pp)
-            df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=[x_key,y_key,z_key,tw_x_key,tw_y_key,clr_map], re_run_clstr=re_run_clstr)
+            df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=[x_key,y_key,z_key,tw_x_key,tw_y_key,clr_map], re_run_clstr=re_run_clstr, DBCV_method=get_DBCV_method(pp), clstr_filters=print_profile_filters(a_group.profile_filters))
         print('\t- Plot slopes:',plot_slopes)
         # Check whether to normalize by subtracting a polyfit2d
         if fit_vars:# and clr_map != 'cluster':
@@ -3560,7 +4362,7 @@ def make_subplot(ax, a_group, fig, ax_pos):
         # Check for cluster-based variables
         if clr_map in clstr_vars:
             m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = get_cluster_args(pp)
-            df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=[clr_map], re_run_clstr=re_run_clstr)
+            df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=[clr_map], re_run_clstr=re_run_clstr, DBCV_method=get_DBCV_method(pp), clstr_filters=print_profile_filters(a_group.profile_filters))
         print('\t- Plot slopes:',plot_slopes)
         # Drop dimensions, if needed
         if 'Vertical' in df.index.names:
@@ -4882,7 +5684,7 @@ def plot_profiles(ax, a_group, pp, clr_map=None):
         #
     if cluster_this:
         m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = get_cluster_args(pp)
-        df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=plot_vars, re_run_clstr=re_run_clstr)
+        df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=plot_vars, re_run_clstr=re_run_clstr, DBCV_method=get_DBCV_method(pp), clstr_filters=print_profile_filters(a_group.profile_filters))
         print('\t- Plot slopes:',plot_slopes)
     # Filter to specified range if applicable
     if not isinstance(a_group.plt_params.ax_lims, type(None)):
@@ -5571,7 +6373,7 @@ def plot_waterfall(ax, a_group, fig, ax_pos, pp, clr_map=None):
         #
     if cluster_this:
         m_pts, m_cls, cl_x_var, cl_y_var, cl_z_var, plot_slopes, b_a_w_plt = get_cluster_args(pp)
-        df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=plot_vars, re_run_clstr=re_run_clstr)
+        df, rel_val, m_pts, m_cls, ell = HDBSCAN_(a_group.data_set.arr_of_ds, df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, extra_cl_vars=plot_vars, re_run_clstr=re_run_clstr, DBCV_method=get_DBCV_method(pp), clstr_filters=print_profile_filters(a_group.profile_filters))
         print('\t- Plot slopes:',plot_slopes)
     # Filter to specified range if applicable
     if not isinstance(a_group.plt_params.ax_lims, type(None)):
@@ -6161,11 +6963,71 @@ def get_cluster_args(pp):
 
 ################################################################################
 
-def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_vars=[None], param_sweep=False, re_run_clstr=True):
+def get_DBCV_method(pp):
+    """
+    Finds how to score the clustering from the extra_args dictionary, one of
+        'relative_validity'  HDBSCAN's relative_validity_, needs the minimum spanning tree
+        'core_dists'         find_DBCV() from the labels and core distances
+        'subsample'          find_DBCV_subsample(), a score of random subsamples
+                                 that only ranks clusterings of the same data
+        None                 Don't score the clustering
+
+    pp              The Plot_Parameters object for a_group
+    """
+    try:
+        return pp.extra_args['DBCV_method']
+    except:
+        return 'relative_validity'
+
+################################################################################
+
+def reset_peak_RSS():
+    """
+    Resets the peak resident set size of this process, if the system allows it,
+    so that find_peak_RSS() gives the peak of just what runs after this
+    """
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except:
+        foo = 2
+
+################################################################################
+
+def find_peak_RSS():
+    """
+    Returns the peak resident set size of this process in MB, since the last
+    call to reset_peak_RSS() if the system allowed the reset
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except:
+        foo = 2
+    # ru_maxrss is in kB on Linux, the peak over the life of the process
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+################################################################################
+
+def find_ell_size(arr_of_ds):
+    """
+    Returns the moving average window of the first dataset, as HDBSCAN_() does
+
+    arr_of_ds       A list of xarray datasets
+    """
+    return int(re.sub("[^0-9^.]", "", arr_of_ds[0].attrs['Moving average window']))
+
+################################################################################
+
+def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_vars=[None], param_sweep=False, re_run_clstr=True, m_pts_list=None, DBCV_method='relative_validity', clstr_filters=None, ell_size=None):
     """
     Runs the HDBSCAN algorithm on the set of data specified. Returns a pandas
     dataframe with columns for x_key, y_key, 'cluster', and 'clst_prob', a
-    rough measure of the DBCV score from `relative_validity_`, and the ell_size
+    rough measure of the DBCV score from `relative_validity_`, and the ell_size.
+    With DBCV_method 'subsample', the range of the subsample scores is kept in
+    `last_DBCV_range`
 
     run_group   The Analysis_Group object to run HDBSCAN on
     df          A pandas data frame with x_key and y_key as equal length columns
@@ -6175,6 +7037,15 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
     m_pts       An integer, 'min_samples', number of points in neighborhood for a core point
     m_cls       An integer, 'min_cluster_size', the minimum number of points for a cluster
     extra_cl_vars   A list of extra variables to potentially calculate
+    m_pts_list  A list of all the values of m_pts in a parameter sweep, or None
+    re_run_clstr    True/False whether to re-run the clustering if the results in
+                    the file are usable, or 'incremental' to assign only the new
+                    points with the model saved with the netcdf, see incr_HDBSCAN()
+    DBCV_method A string of how to score the clustering, see get_DBCV_method()
+    clstr_filters   A string of the profile filters, from print_profile_filters(),
+                    to tell apart results in `clstr_store_dir`
+    ell_size    The moving average window in dbar of the data in df, or None to
+                    read it from the attributes of arr_of_ds
     """
     # print('-- in HDBSCAN')
     # print('-- m_pts:',m_pts)
@@ -6182,17 +7053,18 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
     # print('-- extra_cl_vars:',extra_cl_vars)
     # print('-- df columns:',df.columns.values.tolist())
     # Find the value of ell, the moving average window
-    ell_sizes = []
-    # for ds in run_group.data_set.arr_of_ds:
-    for ds in arr_of_ds:
-        this_ell = ds.attrs['Moving average window']
-        # Remove non-numeric characters from the string
-        this_ell = re.sub("[^0-9^.]", "", this_ell)
-        # Add to list as an integer
-        ell_sizes.append(int(this_ell))
-    if len(ell_sizes) > 1:
-        print('\t- ell_sizes:',np.unique(ell_sizes))
-    ell_size = ell_sizes[0]
+    if isinstance(ell_size, type(None)):
+        ell_sizes = []
+        # for ds in run_group.data_set.arr_of_ds:
+        for ds in arr_of_ds:
+            this_ell = ds.attrs['Moving average window']
+            # Remove non-numeric characters from the string
+            this_ell = re.sub("[^0-9^.]", "", this_ell)
+            # Add to list as an integer
+            ell_sizes.append(int(this_ell))
+        if len(ell_sizes) > 1:
+            print('\t- ell_sizes:',np.unique(ell_sizes))
+        ell_size = ell_sizes[0]
     # If I've manually set re_run_cluster to False, then don't re-run the clustering
     if re_run_clstr == False:
         re_run = False
@@ -6216,9 +7088,16 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
                        'Moving average window':[],
                        'Clustering filters':[],
                        'Clustering DBCV':[]}
+        # When adding new profiles incrementally, only the datasets that were
+        #   already clustered have clustering attributes to check
+        clstrd_arr_of_ds = arr_of_ds
+        if re_run_clstr == 'incremental':
+            clstrd_arr_of_ds = [ds for ds in arr_of_ds if ds.attrs.get('Clustering model', 'None') != 'None']
+            if len(clstrd_arr_of_ds) == 0:
+                clstrd_arr_of_ds = arr_of_ds
         # Get the global clustering attributes from each dataset
         # for ds in run_group.data_set.arr_of_ds:
-        for ds in arr_of_ds:
+        for ds in clstrd_arr_of_ds:
             for attr in gcattr_dict.keys():
                 gcattr_dict[attr].append(ds.attrs[attr])
         # If any attribute has multiple different values, need to re-run HDBSCAN
@@ -6231,6 +7110,10 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
         # if gcattr_dict['Last clustered'][0] == 'Never':
         #     re_run = True
         #     print('-- `Last clustered` attr is `Never`, re_run:',re_run)
+        # Try adding the new points to the saved clustering instead of re-running it
+        if re_run_clstr == 'incremental' and not re_run:
+            df, incr_done = incr_HDBSCAN(clstrd_arr_of_ds, df, [var for var in [x_key, y_key, z_key] if not isinstance(var, type(None))])
+            re_run = not incr_done
     print('\t- Re-run HDBSCAN:',re_run)
     if re_run:
         # print('in HDBSCAN_(), m_pts:',m_pts)
@@ -6250,15 +7133,8 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
         print('\t\tMoving average window:',ell_size)
         # Set the parameters of the HDBSCAN algorithm
         #   Note: must set gen_min_span_tree=True or you can't get `relative_validity_`
-        get_DBCV = True
+        get_DBCV = (DBCV_method == 'relative_validity')
         clst_sel_met = 'leaf'
-        hdbscan_1 = hdbscan.HDBSCAN(gen_min_span_tree=get_DBCV, min_cluster_size=m_cls, min_samples=m_pts, cluster_selection_method=clst_sel_met, leaf_size=m_pts)
-        print('\t\thdbscan_1.gen_min_span_tree:',hdbscan_1.gen_min_span_tree)
-        print('\t\thdbscan_1.cluster_selection_method:',hdbscan_1.cluster_selection_method)
-        try:
-            print('\t\thdbscan_1.leaf_size:',hdbscan_1.leaf_size)
-        except:
-            foo = 2
         # The datetime variables need to be scaled to match
         dt_scale_factor = 10000
         for var in [x_key, y_key, z_key]:
@@ -6271,25 +7147,69 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
         tic = time.perf_counter()
         if isinstance(z_key, type(None)):
             # Run in 2D
-            hdbscan_1.fit_predict(df[[x_key,y_key]])
+            cl_data = df[[x_key,y_key]]
         else:
             # Run in 3D
-            hdbscan_1.fit_predict(df[[x_key,y_key,z_key]])
+            cl_data = df[[x_key,y_key,z_key]]
+        # Check whether this exact clustering has been done before, outside of parameter sweeps
+        stored = None
+        if not param_sweep and not isinstance(clstr_store_dir, type(None)):
+            clstr_key = find_clstr_key(cl_data, m_pts, m_cls, ell_size, clstr_filters, clst_sel_met, DBCV_method)
+            stored = load_clstr_artifact(clstr_key, load_model=(re_run_clstr == 'incremental'))
+        if not isinstance(stored, type(None)):
+            hdbscan_1 = stored['model']
+            labels = stored['labels']
+            probabilities = stored['probabilities']
+        else:
+            # In a parameter sweep, reuse the tree from an earlier run with the same m_pts
+            hdbscan_1 = fit_HDBSCAN(cl_data, m_pts, m_cls, clst_sel_met, get_DBCV, use_cache=param_sweep, m_pts_list=m_pts_list)
+            labels = hdbscan_1.labels_
+            probabilities = hdbscan_1.probabilities_
+            print('\t\thdbscan_1.gen_min_span_tree:',hdbscan_1.gen_min_span_tree)
+            print('\t\thdbscan_1.cluster_selection_method:',hdbscan_1.cluster_selection_method)
+            try:
+                print('\t\thdbscan_1.leaf_size:',hdbscan_1.leaf_size)
+            except:
+                foo = 2
         toc = time.perf_counter()
         print(f'\t\tClustering took {toc - tic:0.4f} seconds')
+        # Keep the model to save with the netcdf, so new points can be added later
+        if re_run_clstr == 'incremental':
+            if not isinstance(hdbscan_1, type(None)) and np.isfinite(np.array(cl_data, dtype=float)).all():
+                if isinstance(getattr(hdbscan_1, '_prediction_data', None), type(None)):
+                    hdbscan_1.generate_prediction_data()
+                last_clstr_model['model'] = hdbscan_1
+                last_clstr_model['file'] = None
+            else:
+                print('\t\tNot all points are finite, not keeping the clustering model')
         # Undo the scaling
         for var in [x_key, y_key, z_key]:
             if var in ['dt_start','dt_end']:
                 print('\t\tUnscaling '+var+' variable after clustering')
                 df[var] = df[var] * dt_scale_factor
         # Add the cluster labels and probabilities to the dataframe
-        df['cluster']   = hdbscan_1.labels_
-        df['clst_prob'] = hdbscan_1.probabilities_
-        if get_DBCV:
+        df['cluster']   = labels
+        df['clst_prob'] = probabilities
+        if not isinstance(stored, type(None)):
+            rel_val = stored['DBCV']
+            print('\t\tDBCV:',rel_val)
+        elif get_DBCV:
             rel_val = hdbscan_1.relative_validity_
             print('\t\tDBCV:',rel_val)
+        elif DBCV_method in ['core_dists', 'subsample']:
+            if DBCV_method == 'subsample':
+                rel_val, lo, hi = find_DBCV_subsample(cl_data, hdbscan_1.labels_, m_pts)
+                last_DBCV_range['DBCV'] = rel_val
+                last_DBCV_range['range'] = (lo, hi)
+                print('\t\tDBCV of subsamples:',rel_val,'range: [',lo,',',hi,']')
+            else:
+                # Reuse the core distances the clustering was made with, if kept
+                rel_val = find_DBCV(cl_data, hdbscan_1.labels_, m_pts, core_dists=find_cached_core_dists(cl_data, m_pts))
+                print('\t\tDBCV:',rel_val)
         else:
             rel_val = -999
+        if isinstance(stored, type(None)) and not param_sweep and not isinstance(clstr_store_dir, type(None)):
+            save_clstr_artifact(clstr_key, hdbscan_1, rel_val)
         # Determine whether there are any new variables to calculate
         new_cl_vars = list(set(extra_cl_vars) & set(clstr_vars))
         # print('\t\t- new_cl_vars:',new_cl_vars)
@@ -6328,6 +7248,713 @@ def HDBSCAN_(arr_of_ds, df, x_key, y_key, z_key, m_pts, m_cls='auto', extra_cl_v
 
 ################################################################################
 
+def incr_HDBSCAN(arr_of_ds, df, cl_vars):
+    """
+    Returns the data frame with clusters assigned to the new points, the ones
+    with no `cluster` label, from the model saved with the netcdf, and whether
+    that worked. It doesn't if there's no model or it was fit on other
+    variables, or if the new points have drifted from what the model was fit
+    to, in which case the clustering should be re-run on all the points.
+    The labels of the model are matched to the sorted and relabeled ones in the
+    netcdf through the points already clustered. The DBCV score isn't
+    recalculated, it stays that of the saved model
+
+    arr_of_ds       A list of xarray datasets
+    df              A pandas data frame with cl_vars and `cluster` as columns
+    cl_vars         A list of the names of the columns to cluster on
+    """
+    # Check that every dataset points to the same model for the same variables
+    model_files = list(set([ds.attrs.get('Clustering model', 'None') for ds in arr_of_ds]))
+    if len(model_files) > 1 or model_files[0] == 'None':
+        print('\t- No single clustering model in the netcdf attributes')
+        return df, False
+    for attr, var in zip(['Clustering x-axis', 'Clustering y-axis', 'Clustering z-axis'], cl_vars+[None]*(3-len(cl_vars))):
+        if len(set([str(ds.attrs.get(attr)) for ds in arr_of_ds])) > 1 or str(arr_of_ds[0].attrs.get(attr)) != str(var):
+            print('\t- Clustering model was fit on different variables, found',attr,arr_of_ds[0].attrs.get(attr))
+            return df, False
+    model = load_clstr_model(model_files[0])
+    if isinstance(model, type(None)):
+        return df, False
+    # Find the points that haven't been clustered yet
+    cl_data = np.array(df[cl_vars], dtype=float)
+    is_new = np.array(pd.isna(df['cluster'])) & np.isfinite(cl_data).all(axis=1)
+    n_new = int(is_new.sum())
+    n_fit = len(model._raw_data)
+    print('\t- Found',n_new,'new points to add to the',n_fit,'in the clustering model')
+    if n_new == 0:
+        last_clstr_model['model'] = model
+        last_clstr_model['file'] = model_files[0]
+        return df, True
+    if n_new > incr_max_new_frac*n_fit:
+        print('\t- Too many new points for the clustering model, refitting')
+        return df, False
+    new_data = cl_data[is_new]
+    # Check whether the new points have moved away from the ones the model was fit to
+    drift = np.abs(new_data.mean(axis=0) - model._raw_data.mean(axis=0)) / model._raw_data.std(axis=0)
+    if drift.max() > incr_max_drift:
+        print('\t- New points have drifted',drift.max(),'standard deviations, refitting')
+        return df, False
+    new_labels, new_probs = hdbscan.approximate_predict(model, new_data)
+    low_prob_frac = np.mean(new_probs < incr_min_prob)
+    if low_prob_frac > incr_max_low_prob_frac:
+        print('\t- Fraction of new points with low membership probability',low_prob_frac,'too high, refitting')
+        return df, False
+    # The labels in the netcdf were sorted and relabeled after the model was fit,
+    #   so map each label of the model to the most common netcdf label of the
+    #   clustered points the model assigns to it
+    is_old = np.array(pd.notna(df['cluster'])) & np.isfinite(cl_data).all(axis=1)
+    old_idx = np.flatnonzero(is_old)
+    if len(old_idx) > incr_n_map_pts:
+        old_idx = np.random.default_rng(0).choice(old_idx, incr_n_map_pts, replace=False)
+    old_labels = np.array(df['cluster'].values[old_idx], dtype=int)
+    model_labels = hdbscan.approximate_predict(model, cl_data[old_idx])[0]
+    label_map = pd.crosstab(model_labels, old_labels).idxmax(axis=1)
+    # Noise stays noise and labels with no clustered points become noise
+    label_map[-1] = -1
+    new_labels = label_map.reindex(new_labels).fillna(-1).values
+    print('\t- Assigned the new points to clusters, fraction with low membership probability:',low_prob_frac)
+    df = df.copy()
+    df['cluster'] = np.array(df['cluster'], dtype=float)
+    df.loc[is_new, 'cluster'] = new_labels
+    df['cluster'] = df['cluster'].fillna(-1).astype(int)
+    df.loc[is_new, 'clst_prob'] = new_probs
+    last_clstr_model['model'] = model
+    last_clstr_model['file'] = model_files[0]
+    return df, True
+
+################################################################################
+
+def make_incr_data_set(nc_file, sources_dict, data_filters):
+    """
+    Returns a Data_Set for adding new profiles to the clustering in nc_file,
+    with the clustered netcdf first and then just the profiles of the sources
+    it doesn't have yet, with no `cluster` labels, or None if nc_file doesn't
+    exist or has no clustering model saved with it
+
+    nc_file         A string of the clustered netcdf, as written by cluster_data.py
+    sources_dict    A dictionary of the sources to cluster, as for Data_Set
+    data_filters    A custom Data_Filters object that contains the filters to apply
+    """
+    if not os.path.isfile(nc_file):
+        return None
+    if read_netcdf_attrs(nc_file).get('Clustering model', 'None') == 'None':
+        print('\t- No clustering model saved with',nc_file)
+        return None
+    # Find the profiles already clustered, by source, instrument, and profile number
+    with xr.open_dataset(nc_file) as ds:
+        done_pfs = set(zip(ds['source'].values.astype(str), ds['instrmt'].values.astype(str), ds['prof_no'].values.astype(int)))
+    new_sources_dict = {os.path.splitext(os.path.relpath(nc_file, 'netcdfs'))[0]:'all'}
+    for source, pf_list in sources_dict.items():
+        with xr.open_dataset('netcdfs/'+source+'.nc') as ds:
+            these_pfs = zip(ds['source'].values.astype(str), ds['instrmt'].values.astype(str), ds['prof_no'].values.astype(int))
+            new_pfs = [pf for src, instrmt, pf in these_pfs if (src, instrmt, pf) not in done_pfs and (pf_list == 'all' or pf in pf_list)]
+        if len(new_pfs) > 0:
+            print('\t- Adding',len(new_pfs),'new profiles from',source)
+            new_sources_dict[source] = list(np.unique(new_pfs))
+    data_set = Data_Set(new_sources_dict, data_filters)
+    # Mark the new profiles as not clustered yet
+    for ds in data_set.arr_of_ds[1:]:
+        for var in ['cluster', 'clst_prob']:
+            if var in ds.keys():
+                ds[var] = ds[var].where(False)
+        ds.attrs['Last clustered'] = 'Never'
+        ds.attrs['Clustering model'] = 'None'
+    return data_set
+
+################################################################################
+
+def save_clstr_model(nc_file):
+    """
+    Saves the model from the last clustering next to the given netcdf, so new
+    points can be clustered incrementally, and returns the name of the file
+    to record in the 'Clustering model' global attribute, or 'None'
+
+    nc_file         A string of the netcdf file the clustering is written to
+    """
+    model = last_clstr_model['model']
+    if isinstance(model, type(None)):
+        return 'None'
+    model_file = os.path.splitext(nc_file)[0]+'_model.pickle'
+    # Only write it out again if it's not already that file
+    if last_clstr_model['file'] != model_file:
+        print('Writing clustering model to',model_file)
+        with open(model_file+'.tmp', 'wb') as f:
+            pl.dump(model, f)
+        os.replace(model_file+'.tmp', model_file)
+        last_clstr_model['file'] = model_file
+    return model_file
+
+################################################################################
+
+def load_clstr_model(model_file):
+    """
+    Returns the HDBSCAN object saved by save_clstr_model(), or None if it can't
+    be read
+
+    model_file      A string of the file name, from the 'Clustering model' attribute
+    """
+    try:
+        with open(model_file, 'rb') as f:
+            model = pl.load(f)
+        print('\t- Loaded clustering model from',model_file)
+        return model
+    except:
+        print('\t- Could not load the clustering model from',model_file)
+        return None
+
+################################################################################
+
+def find_clstr_key(cl_data, m_pts, m_cls, ell_size, clstr_filters, clst_sel_met, DBCV_method):
+    """
+    Returns a string of the hash that identifies a clustering in `clstr_store_dir`,
+    from the values of the clustered points, which columns they came from, and
+    every setting that changes the result
+
+    cl_data         A pandas data frame of the data to cluster
+    m_pts           An integer, 'min_samples', number of points in neighborhood for a core point
+    m_cls           An integer, 'min_cluster_size', the minimum number of points for a cluster
+    ell_size        The moving average window of the data
+    clstr_filters   A string of the profile filters, from print_profile_filters()
+    clst_sel_met    A string of the cluster selection method, 'leaf' or 'eom'
+    DBCV_method     A string of how to score the clustering, see get_DBCV_method()
+    """
+    cl_arr = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    key_hash = hashlib.md5(cl_arr.tobytes())
+    key_str = repr([cl_arr.shape, list(cl_data.columns), int(m_pts), int(m_cls), ell_size, clstr_filters, clst_sel_met, DBCV_method])
+    key_hash.update(key_str.encode())
+    return key_hash.hexdigest()
+
+################################################################################
+
+def save_clstr_artifact(clstr_key, hdbscan_1, rel_val):
+    """
+    Saves the results of a clustering in `clstr_store_dir`, the labels,
+    probabilities, DBCV score, and condensed tree in one file, which is quick
+    to load, and the fitted HDBSCAN object in another
+
+    clstr_key       A string from find_clstr_key()
+    hdbscan_1       The fitted HDBSCAN object
+    rel_val         The DBCV score of the clustering
+    """
+    os.makedirs(clstr_store_dir, exist_ok=True)
+    npz_file = clstr_store_dir+clstr_key+'.npz'
+    model_file = clstr_store_dir+clstr_key+'_model.pickle'
+    print('\t\tSaving clustering results to',npz_file)
+    # Write to temporary files first so a crash can't leave a partial result behind
+    with open(model_file+'.tmp', 'wb') as f:
+        pl.dump(hdbscan_1, f)
+    os.replace(model_file+'.tmp', model_file)
+    with open(npz_file+'.tmp', 'wb') as f:
+        np.savez(f, labels=hdbscan_1.labels_, probabilities=hdbscan_1.probabilities_, DBCV=rel_val, condensed_tree=hdbscan_1.condensed_tree_.to_numpy())
+    os.replace(npz_file+'.tmp', npz_file)
+
+################################################################################
+
+def load_clstr_artifact(clstr_key, load_model=False):
+    """
+    Returns a dictionary of the results of a clustering saved in `clstr_store_dir`,
+    with 'labels', 'probabilities', 'DBCV', 'condensed_tree', and 'model', the
+    HDBSCAN object if load_model is True or None, or returns None if there are no
+    results saved for that key
+
+    clstr_key       A string from find_clstr_key()
+    load_model      True/False whether to also load the fitted HDBSCAN object
+    """
+    npz_file = clstr_store_dir+clstr_key+'.npz'
+    model_file = clstr_store_dir+clstr_key+'_model.pickle'
+    if not os.path.isfile(npz_file):
+        return None
+    try:
+        with np.load(npz_file) as npz:
+            stored = {'labels':npz['labels'], 'probabilities':npz['probabilities'], 'DBCV':float(npz['DBCV']), 'condensed_tree':npz['condensed_tree'], 'model':None}
+        if load_model:
+            with open(model_file, 'rb') as f:
+                stored['model'] = pl.load(f)
+    except:
+        print('\t\tCould not load clustering results from',npz_file)
+        return None
+    print('\t\tLoaded clustering results from',npz_file)
+    return stored
+
+################################################################################
+
+def fit_HDBSCAN(cl_data, m_pts, m_cls, clst_sel_met='leaf', get_DBCV=True, use_cache=False, m_pts_list=None):
+    """
+    Returns an HDBSCAN object fit to the given data. With use_cache=True, the
+    fit is kept in `hdbscan_cache` and, as long as the data and m_pts are the
+    same, a later call with a different m_cls reuses its single linkage tree and
+    minimum spanning tree, which don't depend on m_cls, and only re-condenses
+    the tree and selects new clusters. If m_pts_list is also given, the core
+    distances for all those values of m_pts are found with one nearest neighbours
+    query and the minimum spanning tree is built from them, as HDBSCAN does with
+    algorithm='prims_kdtree'
+
+    cl_data         A pandas data frame or array of the data to cluster
+    m_pts           An integer, 'min_samples', number of points in neighborhood for a core point
+    m_cls           An integer, 'min_cluster_size', the minimum number of points for a cluster
+    clst_sel_met    A string of the cluster selection method, 'leaf' or 'eom'
+    get_DBCV        True/False whether to make the minimum spanning tree, needed for DBCV
+    use_cache       True/False whether to check and add to `hdbscan_cache`, ignored
+                        if the internals of hdbscan could not be imported
+    m_pts_list      A list of all the values of m_pts in a parameter sweep, or None
+    """
+    cl_data = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    # Reusing the trees needs the internals of hdbscan, otherwise fit from scratch
+    if isinstance(_tree_to_labels, type(None)):
+        use_cache = False
+    if use_cache:
+        data_hash = hashlib.md5(cl_data.tobytes()).hexdigest()
+        key = (data_hash, cl_data.shape, m_pts, clst_sel_met, get_DBCV)
+        if key in hdbscan_cache:
+            print('\t\tReusing the single linkage tree for m_pts:',m_pts)
+            hdbscan_0 = hdbscan_cache[key]
+            hdbscan_cache.move_to_end(key)
+            labels, probabilities, stabilities, condensed_tree, sl_tree = _tree_to_labels(cl_data, hdbscan_0._single_linkage_tree, m_cls, clst_sel_met, **find_sel_kwargs(hdbscan_0))
+            # Copy the fit, sharing the trees, and switch in the new clusters
+            hdbscan_1 = copy.copy(hdbscan_0)
+            hdbscan_1.min_cluster_size = m_cls
+            hdbscan_1.labels_ = labels
+            hdbscan_1.probabilities_ = probabilities
+            hdbscan_1.cluster_persistence_ = stabilities
+            hdbscan_1._condensed_tree = condensed_tree
+            hdbscan_1._relative_validity = None
+            hdbscan_1._outlier_scores = None
+            return hdbscan_1
+    # The trees only line up with the data if all the points were finite
+    all_finite = np.isfinite(cl_data).all()
+    if use_cache and all_finite and not isinstance(m_pts_list, type(None)) and m_pts in m_pts_list and not isinstance(mst_linkage_core_vector, type(None)):
+        hdbscan_1 = hdbscan.HDBSCAN(gen_min_span_tree=get_DBCV, min_cluster_size=m_cls, min_samples=m_pts, cluster_selection_method=clst_sel_met, leaf_size=m_pts, algorithm='prims_kdtree')
+        # HDBSCAN can't use more neighbours than there are other points
+        these_m_pts = [min(len(cl_data)-1, int(m)) for m in m_pts_list]
+        this_m_pts = min(len(cl_data)-1, int(m_pts))
+        if data_hash not in core_dist_cache or this_m_pts not in core_dist_cache[data_hash]:
+            core_dist_cache[data_hash] = find_core_dists(cl_data, these_m_pts)
+        core_dist_cache.move_to_end(data_hash)
+        while len(core_dist_cache) > hdbscan_cache_max:
+            core_dist_cache.popitem(last=False)
+        # Mutual reachability distance is implicit in mst_linkage_core_vector
+        min_spanning_tree = mst_linkage_core_vector(cl_data, core_dist_cache[data_hash][this_m_pts], DistanceMetric.get_metric('euclidean'), 1.0)
+        min_spanning_tree = min_spanning_tree[np.argsort(min_spanning_tree.T[2]), :]
+        labels, probabilities, stabilities, condensed_tree, sl_tree = _tree_to_labels(cl_data, label(min_spanning_tree), m_cls, clst_sel_met, **find_sel_kwargs(hdbscan_1))
+        hdbscan_1._raw_data = cl_data
+        hdbscan_1._all_finite = True
+        hdbscan_1.labels_ = labels
+        hdbscan_1.probabilities_ = probabilities
+        hdbscan_1.cluster_persistence_ = stabilities
+        hdbscan_1._condensed_tree = condensed_tree
+        hdbscan_1._single_linkage_tree = sl_tree
+        if get_DBCV:
+            hdbscan_1._min_spanning_tree = min_spanning_tree
+    else:
+        hdbscan_1 = hdbscan.HDBSCAN(gen_min_span_tree=get_DBCV, min_cluster_size=m_cls, min_samples=m_pts, cluster_selection_method=clst_sel_met, leaf_size=m_pts)
+        hdbscan_1.fit_predict(cl_data)
+    if use_cache and all_finite:
+        hdbscan_cache[key] = hdbscan_1
+        while len(hdbscan_cache) > hdbscan_cache_max:
+            hdbscan_cache.popitem(last=False)
+    return hdbscan_1
+
+################################################################################
+
+def find_sel_kwargs(hdbscan_0):
+    """
+    Returns a dictionary of the cluster selection settings of an HDBSCAN object
+    that _tree_to_labels() takes in the installed version of hdbscan
+
+    hdbscan_0       An HDBSCAN object
+    """
+    sel_params = inspect.signature(_tree_to_labels).parameters
+    sel_kwargs = {}
+    for arg in ['allow_single_cluster', 'match_reference_implementation', 'cluster_selection_epsilon', 'cluster_selection_persistence', 'max_cluster_size', 'cluster_selection_epsilon_max']:
+        if arg in sel_params and hasattr(hdbscan_0, arg):
+            sel_kwargs[arg] = getattr(hdbscan_0, arg)
+    return sel_kwargs
+
+################################################################################
+
+def find_core_dists(cl_data, m_pts_list):
+    """
+    Returns a dictionary of arrays of the core distances of every point, the
+    distance to its m_pts-th nearest neighbour, keyed by each value of m_pts,
+    from one nearest neighbours query up to the largest value
+
+    cl_data         An array of the data to cluster
+    m_pts_list      A list of the values of m_pts
+    """
+    m_pts_list = sorted(set(int(m) for m in m_pts_list))
+    # The nearest neighbour of each point is itself
+    k = max(m_pts_list) + 1
+    print('\t\tFinding core distances for',len(m_pts_list),'values of m_pts')
+    tree = KDTree(cl_data)
+    core_dists = {}
+    for m in m_pts_list:
+        core_dists[m] = np.empty(len(cl_data))
+    # Query in chunks of points, only keeping the distances needed
+    chunk = max(1, int(core_dist_chunk_size // k))
+    for i in range(0, len(cl_data), chunk):
+        knn_dists = tree.query(cl_data[i:i+chunk], k=k, dualtree=True, breadth_first=True)[0]
+        for m in m_pts_list:
+            core_dists[m][i:i+chunk] = knn_dists[:, m]
+    return core_dists
+
+################################################################################
+
+def find_cached_core_dists(cl_data, m_pts):
+    """
+    Returns the core distances of every point for the given m_pts if they were
+    kept in `core_dist_cache` when the data was clustered, or None if not
+
+    cl_data         A pandas data frame or array of the clustered data
+    m_pts           An integer, 'min_samples', number of points in neighborhood for a core point
+    """
+    cl_data = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    data_hash = hashlib.md5(cl_data.tobytes()).hexdigest()
+    this_m_pts = min(len(cl_data)-1, int(m_pts))
+    if data_hash in core_dist_cache and this_m_pts in core_dist_cache[data_hash]:
+        return core_dist_cache[data_hash][this_m_pts]
+    return None
+
+################################################################################
+
+def find_DBCV(cl_data, labels, m_pts, core_dists=None):
+    """
+    Returns the density based clustering validation (DBCV) score of the given
+    cluster labels, found from the core distances of the points rather than the
+    minimum spanning tree of the whole data set that `relative_validity_` needs.
+    The density sparseness of each cluster is the largest edge in the mutual
+    reachability minimum spanning tree of just that cluster's points and the
+    density separation is the smallest mutual reachability distance between
+    nearest neighbours in different clusters
+
+    cl_data         A pandas data frame or array of the clustered data
+    labels          An array of the cluster labels of each point, -1 for noise
+    m_pts           An integer, 'min_samples', number of points in neighborhood for a core point
+    core_dists      An array of the core distances of each point, or None to find them
+    """
+    cl_data = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    labels = np.asarray(labels)
+    # Non-finite points are counted as noise
+    finite = np.isfinite(cl_data).all(axis=1)
+    total = len(labels)
+    if isinstance(core_dists, type(None)):
+        core_dists = np.full(total, np.nan)
+        if finite.sum() > 1:
+            this_m_pts = min(finite.sum()-1, int(m_pts))
+            core_dists[finite] = find_core_dists(cl_data[finite], [this_m_pts])[this_m_pts]
+    return calc_DBCV(cl_data[finite], labels[finite], core_dists[finite], total)
+
+################################################################################
+
+def find_DBCV_subsample(cl_data, labels, m_pts, n_sample=10000, n_boot=20, conf_lvl=0.95, seed=0):
+    """
+    Returns a DBCV score of the given cluster labels for ranking clusterings of
+    the same data against each other, the mean of the scores of n_boot random
+    subsamples, and the lower and upper bounds of the range that holds conf_lvl
+    of those scores. The core distances are found once from all the data so
+    each subsample keeps the density of the full data set. Each subsample's
+    clusters are sparser and further apart than in all the data, so the score
+    is not an estimate of find_DBCV() and the range is only how much it varies
+    between subsamples, not a confidence interval. Only compare scores found
+    with the same n_sample
+
+    cl_data         A pandas data frame or array of the clustered data
+    labels          An array of the cluster labels of each point, -1 for noise
+    m_pts           An integer, 'min_samples', number of points in neighborhood for a core point
+    n_sample        An integer of the number of points in each subsample
+    n_boot          An integer of the number of subsamples to score
+    conf_lvl        A float of the fraction of the subsample scores within the range
+    seed            An integer seed for choosing the subsamples
+    """
+    cl_data = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    labels = np.asarray(labels)
+    finite = np.isfinite(cl_data).all(axis=1)
+    idx = np.flatnonzero(finite)
+    # Noise points that aren't finite are kept in the score's total
+    frac_finite = len(idx) / len(labels)
+    if len(idx) < 2:
+        return 0.0, 0.0, 0.0
+    this_m_pts = min(len(idx)-1, int(m_pts))
+    core_dists = find_core_dists(cl_data[idx], [this_m_pts])[this_m_pts]
+    if len(idx) <= n_sample:
+        score = calc_DBCV(cl_data[idx], labels[idx], core_dists, len(labels))
+        return score, score, score
+    rng = np.random.default_rng(seed)
+    scores = np.zeros(n_boot)
+    for i in range(n_boot):
+        sample = rng.choice(len(idx), n_sample, replace=False)
+        scores[i] = calc_DBCV(cl_data[idx[sample]], labels[idx[sample]], core_dists[sample], int(n_sample / frac_finite))
+    lo, hi = np.quantile(scores, [(1-conf_lvl)/2, (1+conf_lvl)/2])
+    return scores.mean(), lo, hi
+
+################################################################################
+
+def calc_DBCV(cl_data, labels, core_dists, total, n_nbrs=16):
+    """
+    Returns the DBCV score from the density sparseness and separation of each
+    cluster, weighted by cluster size, following the same conventions as
+    `relative_validity_` in HDBSCAN when there is only one cluster
+
+    cl_data         An array of the finite clustered data
+    labels          An array of the cluster labels of each point, -1 for noise
+    core_dists      An array of the core distances of each point
+    total           An integer of the total number of points, including any left out
+    n_nbrs          An integer of the number of nearest neighbours to check for other clusters
+    """
+    in_clstr = labels != -1
+    clstr_ids, clstr_idx, clstr_sizes = np.unique(labels[in_clstr], return_inverse=True, return_counts=True)
+    n_clstrs = len(clstr_ids)
+    if n_clstrs == 0:
+        return 0.0
+    X = cl_data[in_clstr]
+    core = core_dists[in_clstr]
+    # Density sparseness, the largest edge of each cluster's own minimum spanning tree
+    DSC = np.zeros(n_clstrs)
+    order = np.argsort(clstr_idx, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(clstr_sizes)])
+    for i in range(n_clstrs):
+        these = order[starts[i]:starts[i+1]]
+        if len(these) > 1:
+            DSC[i] = find_mst_max_edge(X[these], core[these], n_nbrs)
+    # Density separation, the smallest mutual reachability distance between
+    #   neighbouring points of different clusters
+    DSPC = np.full(n_clstrs, np.inf)
+    if n_clstrs > 1:
+        k = min(n_nbrs+1, len(X))
+        nbr_dists, nbr_idx = KDTree(X).query(X, k=k)
+        nbr_clstr = clstr_idx[nbr_idx]
+        diff = nbr_clstr != clstr_idx[:, None]
+        mr_dists = np.maximum(nbr_dists, np.maximum(core[:, None], core[nbr_idx]))
+        np.minimum.at(DSPC, np.broadcast_to(clstr_idx[:, None], diff.shape)[diff], mr_dists[diff])
+        np.minimum.at(DSPC, nbr_clstr[diff], mr_dists[diff])
+        # For clusters with no nearby neighbours in other clusters, find the
+        #   nearest point of any other cluster
+        for i in np.flatnonzero(np.isinf(DSPC)):
+            these = order[starts[i]:starts[i+1]]
+            others = np.flatnonzero(clstr_idx != i)
+            nbr_dists, nbr_idx = KDTree(X[others]).query(X[these], k=1)
+            nbr_idx = others[nbr_idx[:, 0]]
+            DSPC[i] = np.maximum(nbr_dists[:, 0], np.maximum(core[these], core[nbr_idx])).min()
+        correction = 2 * DSC.max()
+    else:
+        # With one cluster, use its separation from the noise points
+        noise = ~in_clstr
+        if noise.any():
+            nbr_dists, nbr_idx = KDTree(cl_data[noise]).query(X, k=1)
+            mr_dists = np.maximum(nbr_dists[:, 0], np.maximum(core, core_dists[noise][nbr_idx[:, 0]]))
+            correction = 2 * mr_dists.min()
+        else:
+            correction = 2 * DSC.max()
+    # Clusters with no neighbours in another cluster get a large separation
+    DSPC[np.isinf(DSPC)] = correction
+    denom = np.maximum(DSPC, DSC)
+    V_index = np.zeros(n_clstrs)
+    V_index[denom > 0] = (DSPC - DSC)[denom > 0] / denom[denom > 0]
+    return float(np.sum(clstr_sizes * V_index / total))
+
+################################################################################
+
+def find_mst_max_edge(X, core_dists, n_nbrs=16):
+    """
+    Returns the largest edge of the mutual reachability minimum spanning tree of
+    the given points without finding the distances between every pair of them.
+    The tree is first built from the edges to each point's n_nbrs nearest
+    neighbours, joining any separate pieces by their nearest points. The
+    largest edge is then checked against the points on either side of it and,
+    if two are closer than that edge, it's swapped for the pair of them. Once
+    no pair is closer, every spanning tree has an edge at least that large, so
+    the result is the same as from the full minimum spanning tree
+
+    X               An array of the finite points
+    core_dists      An array of the core distances of each point
+    n_nbrs          An integer of the number of nearest neighbours to start from
+    """
+    n = len(X)
+    if n < 2:
+        return 0.0
+    # Zero weights would be taken as missing edges in the sparse graph
+    tiny = np.finfo(float).tiny
+    k = min(n_nbrs+1, n)
+    nbr_dists, nbr_idx = KDTree(X).query(X, k=k)
+    mr_dists = np.maximum(nbr_dists, np.maximum(core_dists[:, None], core_dists[nbr_idx]))
+    rows = np.broadcast_to(np.arange(n)[:, None], nbr_idx.shape)
+    not_self = rows != nbr_idx
+    nbr_graph = csr_matrix((np.maximum(mr_dists[not_self], tiny), (rows[not_self], nbr_idx[not_self])), shape=(n, n))
+    mst = minimum_spanning_tree(nbr_graph).tocoo()
+    e_a = list(mst.row)
+    e_b = list(mst.col)
+    e_w = list(mst.data)
+    # Join the pieces of the nearest neighbours graph, smallest first
+    n_comps, comps = connected_components(mst, directed=False)
+    while n_comps > 1:
+        this_comp = np.argmin(np.bincount(comps))
+        these = np.flatnonzero(comps == this_comp)
+        others = np.flatnonzero(comps != this_comp)
+        a, b, w = find_closest_pair(X, core_dists, these, others)
+        e_a.append(a)
+        e_b.append(b)
+        e_w.append(max(w, tiny))
+        n_comps, comps = connected_components(csr_matrix((e_w, (e_a, e_b)), shape=(n, n)), directed=False)
+    e_a = np.array(e_a)
+    e_b = np.array(e_b)
+    e_w = np.array(e_w)
+    # Swap out the largest edge until no pair across it is any closer
+    while True:
+        j = np.argmax(e_w)
+        max_edge = e_w[j]
+        rest = np.arange(len(e_w)) != j
+        comps = connected_components(csr_matrix((e_w[rest], (e_a[rest], e_b[rest])), shape=(n, n)), directed=False)[1]
+        side = comps == comps[e_a[j]]
+        if side.sum() > n/2:
+            side = ~side
+        # Only points with smaller core distances can be closer than the edge
+        these = np.flatnonzero(side & (core_dists < max_edge))
+        others = np.flatnonzero(~side & (core_dists < max_edge))
+        if len(these) == 0 or len(others) == 0:
+            break
+        a, b, w = find_closest_pair(X, core_dists, these, others)
+        if w >= max_edge:
+            break
+        e_a[j], e_b[j], e_w[j] = a, b, max(w, tiny)
+    if max_edge <= tiny:
+        return 0.0
+    return float(max_edge)
+
+################################################################################
+
+def find_closest_pair(X, core_dists, these, others):
+    """
+    Returns the indices of a point in `these` and a point in `others` and the
+    mutual reachability distance between them, from the nearest point in
+    `others` to each point in `these`. If any pair is closer than a given
+    distance, where both points have smaller core distances, this pair is too
+
+    X               An array of the finite points
+    core_dists      An array of the core distances of each point
+    these           An array of the indices of the points on one side
+    others          An array of the indices of the points on the other side
+    """
+    nbr_dists, nbr_idx = KDTree(X[others]).query(X[these], k=1)
+    nbrs = others[nbr_idx[:, 0]]
+    mr_dists = np.maximum(nbr_dists[:, 0], np.maximum(core_dists[these], core_dists[nbrs]))
+    i = np.argmin(mr_dists)
+    return these[i], nbrs[i], mr_dists[i]
+
+################################################################################
+
+def find_clstr_segments(df, by=['cluster'], keep_rows=None):
+    """
+    Groups the rows of a data frame by the given keys with a single sort so that
+    per-group reductions don't need a full scan of the data frame for each group.
+    Rows without a cluster label and noise points are left out of every group.
+    Returns a tuple (order, starts, counts) where `order` has the positions of
+    the grouped rows sorted by group, `starts` has the index in `order` where
+    each group begins, and `counts` has the number of rows in each group
+
+    df              A pandas data frame with a 'cluster' column
+    by              A list of the columns to group by, the last varying fastest
+    keep_rows       An optional boolean array, False for extra rows to leave out
+    """
+    # Find the rows which are in a cluster
+    clstr_labels = np.array(df['cluster'].values, dtype=float)
+    in_a_clstr = ~np.isnan(clstr_labels) & (clstr_labels != -1)
+    if not isinstance(keep_rows, type(None)):
+        in_a_clstr = in_a_clstr & np.array(keep_rows, dtype=bool)
+    rows = np.flatnonzero(in_a_clstr)
+    # Convert each key to integer codes, which avoids building string keys
+    key_codes = []
+    for key in by:
+        codes, uniques = pd.factorize(df[key].values[rows], sort=True)
+        key_codes.append(codes)
+    # Sort the rows by group, keeping the original order within each group
+    #   Note: np.lexsort uses the last key given as the primary key
+    sort_idx = np.lexsort(key_codes[::-1])
+    order = rows[sort_idx]
+    # Find where each new group starts
+    new_group = np.zeros(len(order), dtype=bool)
+    new_group[:1] = True
+    for codes in key_codes:
+        sorted_codes = codes[sort_idx]
+        new_group[1:] = new_group[1:] | (sorted_codes[1:] != sorted_codes[:-1])
+    starts = np.flatnonzero(new_group)
+    counts = np.diff(np.append(starts, len(order)))
+    return order, starts, counts
+
+################################################################################
+
+def calc_segment_stat(values, segments, stat='mean'):
+    """
+    Returns an array with one value of the given statistic for each group
+
+    values          An array of the values of a variable for every row
+    segments        The (order, starts, counts) tuple from find_clstr_segments()
+    stat            A string of the statistic to find, either 'mean', 'std',
+                        'min', 'max', 'span', or 'count'
+    """
+    order, starts, counts = segments
+    if stat == 'count':
+        return counts
+    if len(order) == 0:
+        return np.array([], dtype=float)
+    seg_values = np.array(values, dtype=float)[order]
+    if stat == 'mean':
+        return np.add.reduceat(seg_values, starts) / counts
+    elif stat == 'std':
+        # Population standard deviation, to match np.std()
+        seg_means = np.add.reduceat(seg_values, starts) / counts
+        seg_devs = seg_values - np.repeat(seg_means, counts)
+        return np.sqrt(np.add.reduceat(seg_devs**2, starts) / counts)
+    elif stat == 'min':
+        return np.minimum.reduceat(seg_values, starts)
+    elif stat == 'max':
+        return np.maximum.reduceat(seg_values, starts)
+    elif stat == 'span':
+        return np.maximum.reduceat(seg_values, starts) - np.minimum.reduceat(seg_values, starts)
+    else:
+        print('Error: statistic',stat,'not recognized, aborting script')
+        exit(0)
+
+################################################################################
+
+def calc_segment_dt_median(values, segments):
+    """
+    Returns a list with the median datetime, formatted as a string, for each
+    group, taking the upper middle value for groups with an even length
+
+    values          An array of the datetime values of a variable for every row
+    segments        The (order, starts, counts) tuple from find_clstr_segments()
+    """
+    order, starts, counts = segments
+    these_values = np.array(values)[order]
+    these_values = these_values.astype('datetime64', copy=False)
+    # Sort the values within each group
+    group_ids = np.repeat(np.arange(len(starts)), counts)
+    these_values = these_values[np.lexsort((these_values, group_ids))]
+    medians = these_values[starts + counts//2]
+    return [datetime.strftime(this_median.astype(datetime), '%Y-%m-%d %H:%M:%S') for this_median in medians]
+
+################################################################################
+
+def broadcast_segment_stat(seg_stat, segments, n_rows, fill_value=np.nan):
+    """
+    Returns an array of length n_rows with the value for each group put in every
+    row of that group and fill_value in all the rows not in a group
+
+    seg_stat        An array of one value per group, as from calc_segment_stat()
+    segments        The (order, starts, counts) tuple from find_clstr_segments()
+    n_rows          The number of rows in the original data frame
+    fill_value      The value to put in the rows which are not in any group
+    """
+    order, starts, counts = segments
+    seg_stat = np.array(seg_stat)
+    if seg_stat.dtype.kind in 'iuf':
+        row_stat = np.full(n_rows, fill_value, dtype=float)
+    else:
+        row_stat = np.full(n_rows, fill_value, dtype=object)
+    row_stat[order] = np.repeat(seg_stat, counts)
+    return row_stat
+
+################################################################################
+
 def calc_extra_cl_vars(df, new_cl_vars):
     """
     Takes in an already-clustered pandas data frame and a list of variables and,
@@ -6364,110 +7991,48 @@ def calc_extra_cl_vars(df, new_cl_vars):
         if prefix == 'pca':
             # Calculate the per profile cluster average version of the variable
             #   Reduces the number of points to just one per cluster per profile
-            # Make a new column with the combination of instrument and profile number
+            # Group by the combination of instrument and profile number
             #   This avoids accidentally lumping two profiles with the same number from
             #   different instruments together, which would give the incorrect result
-            df['instrmt-prof_no'] = df.instrmt.map(str) + ' ' + df.prof_no.map(str)
-            instrmt_pf_nos = np.unique(np.array(df['instrmt-prof_no'].values))
-            # Loop over each profile
-            for pf in instrmt_pf_nos:
-                # Find the data from just this profile
-                df_this_pf = df[df['instrmt-prof_no']==pf]
-                # Get a list of clusters in this profile
-                clstr_ids = np.unique(np.array(df_this_pf['cluster'].values))
-                clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-                # Remove the noise points
-                clstr_ids = clstr_ids[clstr_ids != -1]
-                # Loop over every cluster in this profile
-                for i in clstr_ids:
-                    # Find the data from this cluster
-                    df_this_pf_this_cluster = df_this_pf[df_this_pf['cluster']==i]
-                    # Find the mean of this var for this cluster for this profile
-                    pf_clstr_mean = np.mean(df_this_pf_this_cluster[var].values)
-                    # Put that value back into the original dataframe
-                    #   Need to make a mask first for some reason
-                    this_pf_this_cluster = (df['instrmt-prof_no']==pf) & (df['cluster']==i)
-                    df.loc[this_pf_this_cluster, this_var] = pf_clstr_mean
+            pf_clstr_segs = find_clstr_segments(df, by=['instrmt', 'prof_no', 'cluster'])
+            print('\t\t\t\tCalculating',this_var,'for',len(pf_clstr_segs[1]),'clusters in profiles')
+            # Find the mean of this var for each cluster for each profile
+            pf_clstr_means = calc_segment_stat(df[var].values, pf_clstr_segs, 'mean')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(pf_clstr_means, pf_clstr_segs, len(df))
         elif prefix == 'pcs':
             # Calculate the per profile cluster span version of the variable
             #   Reduces the number of points to just one per cluster per profile
-            # Make a new column with the combination of instrument and profile number
+            # Group by the combination of instrument and profile number
             #   This avoids accidentally lumping two profiles with the same number from
             #   different instruments together, which would give the incorrect result
-            df['instrmt-prof_no'] = df.instrmt.map(str) + ' ' + df.prof_no.map(str)
-            instrmt_pf_nos = np.unique(np.array(df['instrmt-prof_no'].values))
-            print('\t\t\t\tCalculating',this_var,'for',len(instrmt_pf_nos),'profiles')
-            j = 0
-            # Loop over each profile
-            for pf in instrmt_pf_nos:
-                j += 1
-                print('\t\t\t\tCalculating',this_var,'for profile',pf,'(',j,'/',len(instrmt_pf_nos),')')
-                # Find the data from just this profile
-                df_this_pf = df[df['instrmt-prof_no']==pf]
-                # Get a list of clusters in this profile
-                clstr_ids = np.unique(np.array(df_this_pf['cluster'].values))
-                clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-                # Remove the noise points
-                clstr_ids = clstr_ids[clstr_ids != -1]
-                # Loop over every cluster in this profile
-                for i in clstr_ids:
-                    # Find the data from this cluster
-                    df_this_pf_this_cluster = df_this_pf[df_this_pf['cluster']==i]
-                    # Find the span of this var for this cluster for this profile
-                    pf_clstr_span = max(df_this_pf_this_cluster[var].values) - min(df_this_pf_this_cluster[var].values)
-                    # Replace any values of zero with `None`
-                    # if pf_clstr_span == 0:
-                    #     pf_clstr_span = None
-                    # Put that value back into the original dataframe
-                    #   Need to make a mask first for some reason
-                    this_pf_this_cluster = (df['instrmt-prof_no']==pf) & (df['cluster']==i)
-                    df.loc[this_pf_this_cluster, this_var] = pf_clstr_span
+            pf_clstr_segs = find_clstr_segments(df, by=['instrmt', 'prof_no', 'cluster'])
+            print('\t\t\t\tCalculating',this_var,'for',len(pf_clstr_segs[1]),'clusters in profiles')
+            # Find the span of this var for each cluster for each profile
+            pf_clstr_spans = calc_segment_stat(df[var].values, pf_clstr_segs, 'span')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(pf_clstr_spans, pf_clstr_segs, len(df))
         elif prefix == 'cmc':
             # Calculate the cluster mean-centered version of the variable
             #   Should not change the number of points to display
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the mean of this var for this cluster
-                clstr_mean = np.mean(df_this_cluster[var].values)
-                # Calculate normalized values
-                df_this_cluster[this_var] = df_this_cluster[var] - clstr_mean
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = df_this_cluster[this_var]
+            clstr_segs = find_clstr_segments(df)
+            # Find the mean of this var for each cluster
+            clstr_means = calc_segment_stat(df[var].values, clstr_segs, 'mean')
+            # Calculate normalized values
+            df[this_var] = np.array(df[var].values, dtype=float) - broadcast_segment_stat(clstr_means, clstr_segs, len(df))
         elif prefix == 'ca':
             # Calculate the cluster average version of the variable
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the mean of this var for this cluster
-                if var in ['dt_start','dt_end']:
-                    these_values = np.array(df_this_cluster[var].values)
-                    these_values = these_values.astype('datetime64', copy=False)
-                    these_values.sort()
-                    # print('these_values:',these_values)
-                    # print('type(these_values[0]):',type(these_values[0]))
-                    clstr_mean = datetime.strftime(these_values[len(these_values)//2].astype(datetime), '%Y-%m-%d %H:%M:%S')
+            clstr_segs = find_clstr_segments(df)
+            # Find the mean of this var for each cluster
+            if var in ['dt_start','dt_end']:
+                clstr_means = calc_segment_dt_median(df[var].values, clstr_segs)
+                for clstr_mean in clstr_means:
                     print('clstr_mean:',clstr_mean)
-                    # print('type(clstr_mean):',type(clstr_mean))
-                    # exit(0)
-                else:
-                    clstr_mean = np.mean(df_this_cluster[var].values)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = clstr_mean
-                # print(str(i)+','+str(clstr_mean))
+            else:
+                clstr_means = calc_segment_stat(df[var].values, clstr_segs, 'mean')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_means, clstr_segs, len(df))
         elif prefix == 'av':
             # Calculate the average of the variable
             # Find the mean of this var for this cluster
@@ -6488,187 +8053,90 @@ def calc_extra_cl_vars(df, new_cl_vars):
         elif prefix == 'nzca':
             # Calculate the cluster average version of the variable, neglecting all zero values
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Neglect all zero values
-                df_this_cluster = df_this_cluster[df_this_cluster[var] != 0]
-                # print('\t\t- Neglected zero values for cluster',i,'new len:',len(df_this_cluster))
-                # Find the mean of this var for this cluster
-                if var in ['dt_start','dt_end']:
-                    these_values = np.array(df_this_cluster[var].values)
-                    these_values = these_values.astype('datetime64', copy=False)
-                    these_values.sort()
-                    # print('these_values:',these_values)
-                    # print('type(these_values[0]):',type(these_values[0]))
-                    clstr_mean = datetime.strftime(these_values[len(these_values)//2].astype(datetime), '%Y-%m-%d %H:%M:%S')
+            clstr_segs = find_clstr_segments(df)
+            # Neglect all zero values
+            nz_segs = find_clstr_segments(df, keep_rows=(df[var].values != 0))
+            # Find the mean of this var for each cluster
+            if var in ['dt_start','dt_end']:
+                nz_means = calc_segment_dt_median(df[var].values, nz_segs)
+                for clstr_mean in nz_means:
                     print('clstr_mean:',clstr_mean)
-                    # print('type(clstr_mean):',type(clstr_mean))
-                    # exit(0)
-                else:
-                    clstr_mean = np.mean(df_this_cluster[var].values)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = clstr_mean
-                # print(str(i)+','+str(clstr_mean))
+            else:
+                nz_means = calc_segment_stat(df[var].values, nz_segs, 'mean')
+            # Match the means back to all the clusters, including the zero values
+            nz_clstr_ids = np.array(df['cluster'].values)[nz_segs[0][nz_segs[1]]]
+            clstr_ids = np.array(df['cluster'].values)[clstr_segs[0][clstr_segs[1]]]
+            clstr_means = pd.Series(nz_means, index=nz_clstr_ids).reindex(clstr_ids).values
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_means, clstr_segs, len(df))
         elif prefix == 'cs':
             # Calculate the cluster span version of the variable
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the mean of this var for this cluster
-                clstr_span = max(df_this_cluster[var].values) - min(df_this_cluster[var].values)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = clstr_span
+            clstr_segs = find_clstr_segments(df)
+            # Find the span of this var for each cluster
+            clstr_spans = calc_segment_stat(df[var].values, clstr_segs, 'span')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_spans, clstr_segs, len(df))
         elif prefix == 'csd':
             # Calculate the cluster standard deviation of the variable
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the std of this var for this cluster
-                clstr_std = np.std(df_this_cluster[var].values)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = clstr_std
-                # print(str(i)+','+str(clstr_std))
+            clstr_segs = find_clstr_segments(df)
+            # Find the std of this var for each cluster
+            clstr_stds = calc_segment_stat(df[var].values, clstr_segs, 'std')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_stds, clstr_segs, len(df))
         elif prefix == 'cmm':
             # Find the min/max of each cluster for the variable
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the min/max of this var for this cluster
-                clstr_min = min(df_this_cluster[var].values)
-                clstr_max = max(df_this_cluster[var].values)
-                # Put those values back into the original dataframe
-                #   Won't actually use the data in `this_var` so I'll make it obvious it's to be ignored
-                df.loc[df['cluster']==i, this_var] = -999
-                df.loc[df['cluster']==i, 'cmin_'+var] = clstr_min
-                df.loc[df['cluster']==i, 'cmax_'+var] = clstr_max
+            clstr_segs = find_clstr_segments(df)
+            # Find the min/max of this var for each cluster
+            clstr_mins = calc_segment_stat(df[var].values, clstr_segs, 'min')
+            clstr_maxs = calc_segment_stat(df[var].values, clstr_segs, 'max')
+            # Put those values back into the original dataframe
+            #   Won't actually use the data in `this_var` so I'll make it obvious it's to be ignored
+            df[this_var] = broadcast_segment_stat(np.full(len(clstr_mins), -999), clstr_segs, len(df))
+            df['cmin_'+var] = broadcast_segment_stat(clstr_mins, clstr_segs, len(df))
+            df['cmax_'+var] = broadcast_segment_stat(clstr_maxs, clstr_segs, len(df))
             #
         elif prefix == 'nir':
             # Find the normalized inter-cluster range for the variable
             #   Reduces the number of points to just one per cluster, minus one
             #   because it depends on the difference between adjacent clusters
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # print('\t\t- clstr_ids without noise:',clstr_ids)
-            # Create dataframe to store means and standard deviations of each cluster
-            clstr_df = pd.DataFrame(data=clstr_ids, columns=['cluster'])
-            clstr_df['clstr_mean'] = None
-            clstr_df['clstr_rnge'] = None
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the mean and standard deviation of this var for this cluster
-                clstr_mean = np.mean(df_this_cluster[var].values)
-                clstr_min = min(df_this_cluster[var].values)
-                clstr_max = max(df_this_cluster[var].values)
-                clstr_std = np.std(df_this_cluster[var].values)
-                # print(i,',',clstr_std)
-                clstr_rnge = abs(clstr_max - clstr_min)
-                # Put those values into the cluster dataframe
-                clstr_df.loc[clstr_df['cluster']==i, 'clstr_mean'] = clstr_mean
-                clstr_df.loc[clstr_df['cluster']==i, 'clstr_rnge'] = clstr_rnge
-            # Sort the cluster dataframe by the mean values
-            sorted_clstr_df = clstr_df.sort_values(by='clstr_mean')
-            # Get a list of clusters in this dataframe
-            sorted_clstr_ids = np.unique(np.array(sorted_clstr_df['cluster'].values))
-            # print('\t\t- sorted_clstr_ids:',sorted_clstr_ids)
-            # Find normalized inter-cluster range for the first cluster in sorted order
-            clstr_id_here  = sorted_clstr_df['cluster'].values[0]
-            clstr_id_below = sorted_clstr_df['cluster'].values[1]
-            clstr_mean_here = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_mean'].values[0]
-            clstr_mean_below = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_below, 'clstr_mean'].values[0]
-            this_diff = abs(clstr_mean_below - clstr_mean_here)
-            this_rnge = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_rnge'].values[0]
-            this_nir = this_rnge / this_diff
-            # print('cluster,rnge,diff,nir,diff_below')
-            # print(clstr_id_here,',',this_rnge,',',this_diff,',',this_nir,',',this_diff)
-            # Put that value back into the original dataframe
-            df.loc[df['cluster']==clstr_id_here, this_var] = this_nir
-            # Loop over each middle cluster, finding the normalized inter-cluster ranges
-            for i in range(1,len(sorted_clstr_ids)-1):
-                # Get cluster id's of this cluster, plus those above and below
-                clstr_id_above = sorted_clstr_df['cluster'].values[i-1]
-                clstr_id_here  = sorted_clstr_df['cluster'].values[i]
-                clstr_id_below = sorted_clstr_df['cluster'].values[i+1]
-                # print('clstr_id_above:',clstr_id_above,'clstr_id_here:',clstr_id_here,'clstr_id_below:',clstr_id_below)
-                # Get the mean value for each of the three clusters for this variable
-                clstr_mean_above = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_above, 'clstr_mean'].values[0]
-                clstr_mean_here = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_mean'].values[0]
-                clstr_mean_below = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_below, 'clstr_mean'].values[0]
-                # print('clstr_mean_above:',clstr_mean_above,'clstr_mean_here:',clstr_mean_here,'clstr_mean_below:',clstr_mean_below)
-                # Find the distances from this cluster to the clusters above and below
-                diff_above = abs(clstr_mean_above - clstr_mean_here)
-                diff_below = abs(clstr_mean_below - clstr_mean_here)
-                # Find minimum of the distances above and below
-                this_diff = min(diff_above, diff_below)
-                # this_diff = np.mean([diff_above, diff_below])
-                # Calculate the normalized inter-cluster range for this cluster
-                this_rnge = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_rnge'].values[0]
-                # print('this_rnge:',this_rnge)
-                this_nir = this_rnge / this_diff
-                # print(clstr_id_here,',',this_rnge,',',this_diff,',',this_nir,',',diff_below)
-                # Put that value back into the original dataframe
-                df.loc[df['cluster']==clstr_id_here, this_var] = this_nir
-                # exit(0)
-            # Find normalized inter-cluster range for the last cluster
-            clstr_id_above  = sorted_clstr_df['cluster'].values[-2]
-            clstr_id_here = sorted_clstr_df['cluster'].values[-1]
-            clstr_mean_here = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_mean'].values[0]
-            clstr_mean_above = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_above, 'clstr_mean'].values[0]
-            this_diff = abs(clstr_mean_above - clstr_mean_here)
-            this_nir = sorted_clstr_df.loc[sorted_clstr_df['cluster']==clstr_id_here, 'clstr_rnge'].values[0] / this_diff
-            # print(clstr_id_here,',',this_rnge,',',this_diff,',',this_nir)
-            # Put that value back into the original dataframe
-            df.loc[df['cluster']==clstr_id_here, this_var] = this_nir
+            clstr_segs = find_clstr_segments(df)
+            # Find the mean and range of this var for each cluster
+            clstr_means = calc_segment_stat(df[var].values, clstr_segs, 'mean')
+            clstr_rnges = abs(calc_segment_stat(df[var].values, clstr_segs, 'span'))
+            # Sort the clusters by their mean values
+            sort_idx = np.argsort(clstr_means)
+            # Find the distances from each cluster to the clusters above and below
+            #   The first and last clusters only have one neighbor each
+            mean_diffs = abs(np.diff(clstr_means[sort_idx]))
+            diff_above = np.append(np.inf, mean_diffs)
+            diff_below = np.append(mean_diffs, np.inf)
+            # Calculate the normalized inter-cluster range, using the minimum of
+            #   the distances above and below
+            clstr_nirs = np.zeros(len(clstr_means))
+            clstr_nirs[sort_idx] = clstr_rnges[sort_idx] / np.minimum(diff_above, diff_below)
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_nirs, clstr_segs, len(df))
             #
         elif prefix == 'trd':
             # Find the trend vs. dt_start of each cluster for the variable
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
+            # Group the rows by cluster
+            order, starts, counts = find_clstr_segments(df)
+            clstr_ids = np.array(df['cluster'].values)[order[starts]]
+            clstr_trds = np.zeros(len(clstr_ids))
             print('\t- Finding trend in var:',var)
             adjustment_factor = 365.25
             per_unit = '/yr'
             # Decide what kind of regression to use
             plot_slopes = 'OLS'
             # Loop over each cluster
-            for i in clstr_ids:
+            for j in range(len(clstr_ids)):
+                i = clstr_ids[j]
                 # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
+                df_this_cluster = df.iloc[order[starts[j]:starts[j]+counts[j]]]
                 x_data = np.array(df_this_cluster['dt_start'].values)
                 x_data = mpl.dates.date2num(x_data)
                 y_data = np.array(df_this_cluster[var].values, dtype=float)
@@ -6686,9 +8154,10 @@ def calc_extra_cl_vars(df, new_cl_vars):
                     # Find the slope of the total least-squares of the points for this cluster
                     m, c, sd_m, sd_c = orthoregress(x_data, y_data)
                     print('\t\t- Slope is',m*adjustment_factor,'+/-',sd_m*adjustment_factor,per_unit) # Note, units for dt_start are in days, so use adjustment_factor to get years
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = m*adjustment_factor
+                clstr_trds[j] = m*adjustment_factor
                 # print('cluster '+str(i)+', '+str(m))
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_trds, (order, starts, counts), len(df))
             #
             # Make sure that I've calculated cRL and nir_SA as well
             if 'cRL' not in new_cl_vars:
@@ -6724,20 +8193,20 @@ def calc_extra_cl_vars(df, new_cl_vars):
         elif prefix == 'nztrd':
             # Find the trend vs. dt_start of each cluster for the variable, neglecting all zero values
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
+            # Group the rows by cluster
+            order, starts, counts = find_clstr_segments(df)
+            clstr_ids = np.array(df['cluster'].values)[order[starts]]
+            clstr_trds = np.zeros(len(clstr_ids))
             print('\t- Finding trend in var:',var)
             adjustment_factor = 365.25
             per_unit = '/yr'
             # Decide what kind of regression to use
             plot_slopes = 'OLS'
             # Loop over each cluster
-            for i in clstr_ids:
+            for j in range(len(clstr_ids)):
+                i = clstr_ids[j]
                 # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
+                df_this_cluster = df.iloc[order[starts[j]:starts[j]+counts[j]]]
                 # Remove any zero values
                 df_this_cluster = df_this_cluster[df_this_cluster[var] != 0]
                 x_data = np.array(df_this_cluster['dt_start'].values)
@@ -6757,9 +8226,10 @@ def calc_extra_cl_vars(df, new_cl_vars):
                     # Find the slope of the total least-squares of the points for this cluster
                     m, c, sd_m, sd_c = orthoregress(x_data, y_data)
                     print('\t\t- Slope is',m*adjustment_factor,'+/-',sd_m*adjustment_factor,per_unit) # Note, units for dt_start are in days, so use adjustment_factor to get years
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = m*adjustment_factor
+                clstr_trds[j] = m*adjustment_factor
                 # print('cluster '+str(i)+', '+str(m))
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_trds, (order, starts, counts), len(df))
             #
             # Make sure that I've calculated cRL and nir_SA as well
             if 'cRL' not in new_cl_vars:
@@ -6769,15 +8239,15 @@ def calc_extra_cl_vars(df, new_cl_vars):
         if this_var == 'cRL':
             # Find the lateral density ratio R_L for each cluster
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
+            # Group the rows by cluster
+            order, starts, counts = find_clstr_segments(df)
+            clstr_ids = np.array(df['cluster'].values)[order[starts]]
+            clstr_cRLs = np.zeros(len(clstr_ids))
             # Loop over each cluster
-            for i in clstr_ids:
+            for j in range(len(clstr_ids)):
+                i = clstr_ids[j]
                 # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
+                df_this_cluster = df.iloc[order[starts[j]:starts[j]+counts[j]]]
                 # Find the variables needed
                 alphas = df_this_cluster['alpha'].values
                 temps  = df_this_cluster['CT'].values
@@ -6793,25 +8263,17 @@ def calc_extra_cl_vars(df, new_cl_vars):
                 # The lateral density ratio is the inverse of the slope
                 this_cRL = 1/m
                 # print('cluster:',i,'cRL:',this_cRL)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = this_cRL
+                clstr_cRLs[j] = this_cRL
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_cRLs, (order, starts, counts), len(df))
             #
         elif this_var == 'n_points':
             # Find the number of points for each cluster
             #   Reduces the number of points to just one per cluster
-            # Get a list of clusters in this dataframe
-            clstr_ids = np.unique(np.array(df['cluster'].values))
-            clstr_ids = clstr_ids[~np.isnan(clstr_ids)]
-            # Remove the noise points
-            clstr_ids = clstr_ids[clstr_ids != -1]
-            # Loop over each cluster
-            for i in clstr_ids:
-                # Find the data from this cluster
-                df_this_cluster = df[df['cluster']==i].copy()
-                # Find the number of points for this cluster
-                this_n_points = len(df_this_cluster)
-                # Put those values back into the original dataframe
-                df.loc[df['cluster']==i, this_var] = this_n_points
+            clstr_segs = find_clstr_segments(df)
+            clstr_n_points = calc_segment_stat(None, clstr_segs, 'count')
+            # Put those values back into the original dataframe
+            df[this_var] = broadcast_segment_stat(clstr_n_points, clstr_segs, len(df))
             #
         #
     #
@@ -7452,6 +8914,40 @@ def plot_clusters(a_group, ax, pp, df, x_key, y_key, z_key, cl_x_var, cl_y_var,
 
 ################################################################################
 
+def remap_clstr_labels(labels, old_ids, new_ids):
+    """
+    Returns an array of cluster labels with each label in old_ids switched to
+    the label at the same position in new_ids, and all other labels, including
+    noise and missing values, left as they were, using one lookup into an array
+    that maps every label to its new label
+
+    labels          An array of cluster labels, as in the `cluster` column
+    old_ids         A list of the cluster labels to change
+    new_ids         A list of the labels to change them to
+    """
+    labels = np.array(labels)
+    if labels.dtype.kind not in 'iuf':
+        labels = labels.astype(float)
+    old_ids = np.array(old_ids, dtype=int)
+    new_ids = np.array(new_ids, dtype=int)
+    if len(old_ids) == 0:
+        return labels
+    # Only look up the labels that are numbers
+    if labels.dtype.kind == 'f':
+        is_label = ~np.isnan(labels)
+    else:
+        is_label = np.ones(labels.shape, dtype=bool)
+    these_labels = labels[is_label].astype(int)
+    # Offset the labels so the smallest one, probably noise, is at the start of the array
+    lo = min(these_labels.min(initial=0), old_ids.min())
+    hi = max(these_labels.max(initial=0), old_ids.max())
+    perm = np.arange(lo, hi+1)
+    perm[old_ids - lo] = new_ids
+    labels[is_label] = perm[these_labels - lo]
+    return labels
+
+################################################################################
+
 def sort_clusters(df, cluster_numbers, ax=None, order_by='SA', use_PDF=False):
     """
     Redoes the cluster labels so they are sorted in some way
@@ -7462,40 +8958,17 @@ def sort_clusters(df, cluster_numbers, ax=None, order_by='SA', use_PDF=False):
     order_by        String of the variable by which to sort clusters
     use_PDF         True/False whether to sort by the valleys in a probability distribution function
     """
-    n_clusters = int(len(cluster_numbers))
     s_key = order_by
     if use_PDF == False:
         print('\t- Sorting clusters by',order_by)
         ## Figure out the order
-        sorting_arr = []
-        # Loop through each cluster
-        for i in cluster_numbers:
-            # Find the data from this cluster
-            df_this_cluster = df[df['cluster']==i]
-            # Get relevant data for sorting
-            s_data = df_this_cluster[s_key] 
-            s_mean = np.mean(s_data)
-            # Change cluster id to temp number in the original dataframe
-            #   Need to make a mask first for some reason
-            this_cluster_mask = (df['cluster']==i)
-            temp_i = int(i - (n_clusters+2))
-            df.loc[this_cluster_mask, 'cluster'] = temp_i
-            # Add cluster to the sorting array
-            sorting_arr.append((temp_i, s_mean))
+        # Find the mean of the sorting variable in every cluster at once
+        s_means = df.groupby('cluster')[s_key].mean().reindex(cluster_numbers)
         # Make the sorting array into a pandas dataframe
-        sorting_df = pd.DataFrame(sorting_arr, columns=['temp_i','s_mean']).sort_values(by=['s_mean'])
+        sorting_df = pd.DataFrame({'old_i':np.array(cluster_numbers, dtype=int), 's_mean':s_means.values}).sort_values(by=['s_mean'])
         # print(sorting_df)
         ## Re-assign cluster labels based on sorted order
-        # Loop through each cluster
-        i = 0
-        for temp_i in sorting_df['temp_i']:
-            # Make a mask to locate the rows in the dataframe to change
-            this_cluster_mask = (df['cluster']==temp_i)
-            # Replace the cluster id
-            df.loc[this_cluster_mask, 'cluster'] = i
-            # Increment i
-            i += 1
-        #
+        df['cluster'] = remap_clstr_labels(df['cluster'].values, sorting_df['old_i'].values, np.arange(len(sorting_df)))
     if use_PDF:
         # Find the gaps in the valleys of the histogram and order clusters that way
         #   Following Lu et al. 2022
@@ -7582,27 +9055,10 @@ def relabel_clusters(df, cluster_numbers, relab_these=None):
         if i not in cluster_numbers:
             print('Error: Cluster number',i,'not found, aborting script')
             exit(0)
-    # Prepare second dictionary 
-    relab_these2 = {}
-    # Loop through each cluster in the keys of relab_these
     for i in relab_these.keys():
         print('\t\t- Changing cluster',i,'to be cluster',relab_these[i])
-        if i not in cluster_numbers:
-            print('This cluster label is not available')
-            continue
-        # Change cluster id to a temp number in the original dataframe
-        #   Need to make a mask first for some reason
-        this_cluster_mask = (df['cluster']==i)
-        temp_i = int(-i - 2)
-        df.loc[this_cluster_mask, 'cluster'] = temp_i
-        # Change the key in relab_these to the temp number
-        relab_these2.update({temp_i:relab_these[i]})
-    # Loop through the temp cluster labels now in the keys of relab_these
-    for i in relab_these2.keys():
-        # Change cluster id to the value of this dictionary key
-        #   Need to make a mask first for some reason
-        this_cluster_mask = (df['cluster']==i)
-        df.loc[this_cluster_mask, 'cluster'] = relab_these2[i]
+    # Make all the swaps at once, so a label that is changed isn't changed again
+    df['cluster'] = remap_clstr_labels(df['cluster'].values, list(relab_these.keys()), list(relab_these.values()))
     # Find the cluster labels that exist in the dataframe
     cluster_numbers = np.unique(np.array(df['cluster'].values, dtype=int))
     #   Delete the noise point label "-1"
@@ -7642,11 +9098,170 @@ def filter_to_these_clstrs(df, cluster_numbers, clstrs_to_plot=[]):
 
 ################################################################################
 
+def plan_clstr_sweep(sweep_vals, n_lhs=None, seed=0):
+    """
+    Returns a list of the points in a clustering parameter sweep, each a
+    dictionary with the keys 'BGR', 'ell_size', 'n_pfs', 'm_pts', and 'm_cls',
+    without duplicates and ordered so that points which share precomputed
+    results are next to each other: by BGR period, which sets the data to load,
+    then ell_size, which sets the moving average to take, then n_pfs, which
+    sets the rows to cluster, then m_pts, largest first, which sets the core
+    distances and the single linkage tree, then m_cls
+
+    sweep_vals      A dictionary of lists of the values to sweep for each key.
+                        Missing keys use [None] for 'BGR' and 'ell_size', where
+                        None for 'ell_size' means the window already in the data,
+                        ['all'] for 'n_pfs', and ['auto'] for 'm_cls', which is
+                        the same as m_pts. 'm_pts' must be given
+    n_lhs           None to use every combination of the values, or an integer
+                        number of points to choose by Latin hypercube sampling,
+                        which spreads the points evenly over the range of each key
+    seed            An integer seed for the Latin hypercube sampling
+    """
+    keys = ['BGR', 'ell_size', 'n_pfs', 'm_pts', 'm_cls']
+    defaults = {'BGR':[None], 'ell_size':[None], 'n_pfs':['all'], 'm_cls':['auto']}
+    vals = {}
+    for key in keys:
+        if key in sweep_vals.keys():
+            vals[key] = list(sweep_vals[key])
+        else:
+            vals[key] = defaults[key]
+    # Make the index of each point into the list of values of each key
+    if isinstance(n_lhs, type(None)):
+        idxs = np.stack(np.meshgrid(*[np.arange(len(vals[key])) for key in keys], indexing='ij'), axis=-1).reshape(-1, len(keys))
+    else:
+        # Put one point in each of n_lhs equal strata of each key, with the
+        #   strata shuffled independently for each key
+        rng = np.random.default_rng(seed)
+        idxs = np.zeros((n_lhs, len(keys)), dtype=int)
+        for j, key in enumerate(keys):
+            strata = (rng.permutation(n_lhs) + rng.uniform(size=n_lhs)) / n_lhs
+            idxs[:, j] = np.minimum((strata * len(vals[key])).astype(int), len(vals[key])-1)
+    # Remove duplicates, m_cls='auto' is the same point as m_cls=m_pts
+    plan = []
+    found = set()
+    for idx in idxs:
+        pt = {key:vals[key][i] for key, i in zip(keys, idx)}
+        for key in ['n_pfs', 'm_pts', 'm_cls']:
+            if isinstance(pt[key], (int, np.integer)):
+                pt[key] = int(pt[key])
+        if pt['m_cls'] == 'auto':
+            pt['m_cls'] = pt['m_pts']
+        pt_key = tuple(str(pt[key]) for key in keys)
+        if pt_key not in found:
+            found.add(pt_key)
+            plan.append((idx, pt))
+    # Order by the position of each value in its list, but with m_pts largest first
+    order = {key:j for j, key in enumerate(keys)}
+    plan.sort(key=lambda item: (item[0][order['BGR']], item[0][order['ell_size']], item[0][order['n_pfs']], -item[1]['m_pts'], -1 if isinstance(item[1]['m_cls'], type(None)) else item[1]['m_cls']))
+    return [pt for idx, pt in plan]
+
+################################################################################
+
+def search_m_pts(cl_data, m_pts_range, m_cls='auto', n_coarse=8, tol_m_pts=None, tol_DBCV=0.005, DBCV_method='relative_validity', clst_sel_met='leaf', sweep_results=None, ell_size=None):
+    """
+    Returns the value of m_pts with the highest DBCV score for the given data
+    and a dictionary of the DBCV score of each value of m_pts that was run.
+    Starts with a coarse sweep of n_coarse values spaced evenly in log(m_pts),
+    then narrows in on the highest one with a golden-section search, stopping
+    when the bracket around the peak is no wider than tol_m_pts or the scores
+    in it differ by no more than tol_DBCV
+
+    cl_data         A pandas data frame or array of the data to cluster
+    m_pts_range     A list of the smallest and largest values of m_pts to try
+    m_cls           An integer, 'min_cluster_size', or 'auto' to use m_pts
+    n_coarse        An integer number of values of m_pts in the coarse sweep
+    tol_m_pts       An integer of the narrowest bracket to search, None for 1%
+                        of the largest value of m_pts
+    tol_DBCV        A float of the smallest difference in DBCV that matters
+    DBCV_method     A string of how to score the clustering, see get_DBCV_method()
+    clst_sel_met    A string of the cluster selection method, 'leaf' or 'eom'
+    sweep_results   A Sweep_Results object to reuse and record the points in, or None
+    ell_size        The moving average window of the data, to record the points
+    """
+    cl_data = np.ascontiguousarray(np.array(cl_data, dtype=float))
+    m_lo = int(m_pts_range[0])
+    m_hi = min(int(m_pts_range[1]), len(cl_data)-1)
+    if isinstance(tol_m_pts, type(None)):
+        tol_m_pts = max(1, int(0.01*m_hi))
+    coarse = [int(m) for m in np.unique(np.round(np.geomspace(m_lo, m_hi, n_coarse)))]
+    # The DBCV score for each m_pts
+    scores = {}
+    def run_m_pts(m_pts, m_pts_list=None):
+        if m_pts in scores:
+            return scores[m_pts]
+        if m_cls == 'auto':
+            this_m_cls = m_pts
+        else:
+            this_m_cls = m_cls
+        if not isinstance(sweep_results, type(None)):
+            row = sweep_results.get_point(m_pts, this_m_cls, ell_size)
+            if not isinstance(row, type(None)):
+                scores[m_pts] = float(row['DBCV'])
+                return scores[m_pts]
+        reset_peak_RSS()
+        tic = time.perf_counter()
+        hdbscan_1 = fit_HDBSCAN(cl_data, m_pts, this_m_cls, clst_sel_met, DBCV_method == 'relative_validity', use_cache=True, m_pts_list=m_pts_list)
+        if DBCV_method == 'subsample':
+            # The range of the subsample scores isn't the uncertainty of the
+            #   score, so only the score itself is used to compare values
+            scores[m_pts] = find_DBCV_subsample(cl_data, hdbscan_1.labels_, m_pts)[0]
+        elif DBCV_method == 'core_dists':
+            scores[m_pts] = find_DBCV(cl_data, hdbscan_1.labels_, m_pts, core_dists=find_cached_core_dists(cl_data, m_pts))
+        else:
+            scores[m_pts] = hdbscan_1.relative_validity_
+        print('\t\tm_pts:',m_pts,'DBCV:',scores[m_pts])
+        if not isinstance(sweep_results, type(None)):
+            sweep_results.add_point(m_pts, ell_size, hdbscan_1.labels_.max()+1, scores[m_pts], this_m_cls, 'all', round(time.perf_counter()-tic, 3), find_peak_RSS())
+        return scores[m_pts]
+    def is_flat(these_m_pts):
+        # Whether the scores at these values of m_pts are all within tol_DBCV
+        these_scores = [scores[m] for m in these_m_pts]
+        return max(these_scores) - min(these_scores) <= tol_DBCV
+    ## Coarse sweep
+    print('\tCoarse sweep of m_pts:',coarse)
+    for m_pts in coarse:
+        run_m_pts(m_pts, m_pts_list=coarse)
+    # Bracket the highest score with its neighbours in the coarse sweep
+    i_max = int(np.argmax([scores[m] for m in coarse]))
+    a = coarse[max(i_max-1, 0)]
+    b = coarse[min(i_max+1, len(coarse)-1)]
+    ## Golden-section search within the bracket
+    inv_phi = (np.sqrt(5) - 1) / 2
+    while b - a > tol_m_pts:
+        c = int(round(b - inv_phi*(b - a)))
+        d = int(round(a + inv_phi*(b - a)))
+        if not a < c < d < b:
+            # Too narrow to split, run what's left
+            for m_pts in range(a+1, b):
+                run_m_pts(m_pts)
+            break
+        run_m_pts(c)
+        run_m_pts(d)
+        # Stop if there's no peak to find, just a plateau within tol_DBCV
+        if is_flat([m for m in [a, c, d, b] if m in scores]):
+            print('\tDBCV is flat within tol_DBCV between m_pts',a,'and',b)
+            break
+        if scores[c] >= scores[d]:
+            b = d
+        else:
+            a = c
+    # Pick the best value that was run
+    best_m_pts = max(scores.keys(), key=lambda m: scores[m])
+    print('\tHighest DBCV:',scores[best_m_pts],'at m_pts:',best_m_pts,'after',len(scores),'runs')
+    return best_m_pts, {m:scores[m] for m in sorted(scores.keys())}
+
+################################################################################
+
 def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
     """
     Plots the DBCV and number of clusters found by HDBSCAN vs. either n_pfs, 
     m_pts, m_cls, or ell_size
 
+    Each point is recorded in `outputs/<plt_title>_ps.csv` as soon as it's done.
+    To skip the points already in that file from an earlier run, add
+    {'ps_resume':True} to extra_args
+
     ax              The axis on which to plot
     tw_ax_x         The twin x axis on which to plot
     a_group         An Analysis_Group object containing the info to create this subplot
@@ -7686,11 +9301,11 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
         z_list = [0]
     # Open a text file to record values from the parameter sweep
     sweep_txt_file = 'outputs/'+plt_title+'_ps.csv'
-    f = open(sweep_txt_file,'w')
-    f.write('Parameter Sweep for '+plt_title+'\n')
-    f.write(datetime.now().strftime("%I:%M%p on %B %d, %Y")+'\n')
-    f.write('m_pts,ell_size,n_clusters,DBCV,m_cls\n')
-    f.close()
+    try:
+        ps_resume = cluster_plt_dict['ps_resume']
+    except:
+        ps_resume = False
+    sweep_results = Sweep_Results(sweep_txt_file, plt_title, resume=ps_resume)
     # If limiting the number of pfs, find total number of pfs in the given df
     #   In the multi-index of df, level 0 is 'Time'
     if x_key == 'n_pfs':
@@ -7710,31 +9325,53 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
         print('\tPlotting these z values of',z_key,':',z_list)
     z_len = len(z_list)
     x_len = len(x_var_array)
+    # If sweeping ell_size, make the data frames once with the smallest window
+    #   and switch in the moving averages for the other windows from the cache
+    if x_key == 'ell_size' or z_key == 'ell_size':
+        if x_key == 'ell_size':
+            ell_list = x_var_array
+        else:
+            ell_list = z_list
+        ell_pfs = copy.copy(a_group.profile_filters)
+        ell_pfs.m_avg_win = min(ell_list)
+        ell_group = Analysis_Group(copy_data_set(a_group.data_set), ell_pfs, a_group.plt_params)
+    # If sweeping m_pts, find the core distances for all values at once
+    if x_key == 'm_pts':
+        m_pts_list = x_var_array
+    elif z_key == 'm_pts':
+        m_pts_list = z_list
+    else:
+        m_pts_list = None
     for i in range(z_len):
         y_var_array = []
         tw_y_var_array = []
-        lines = []
         # Divide the runs among the processes
         # x_var_array = comm.scatter(x_var_array, root=0)
         for x in x_var_array:
             # Set initial values for some variables
             zlabel = None
             this_df = df.copy()
+            # Check whether this point was already done in an earlier run
+            pt_vals = {'m_pts':m_pts, 'm_cls':m_cls, 'ell_size':None, 'n_pfs':'all'}
+            pt_vals[x_key] = x
+            if z_key:
+                pt_vals[z_key] = z_list[i]
+            if isinstance(pt_vals['ell_size'], type(None)):
+                pt_vals['ell_size'] = find_ell_size(a_group.data_set.arr_of_ds)
+            row = sweep_results.get_point(pt_vals['m_pts'], pt_vals['m_cls'], pt_vals['ell_size'], pt_vals['n_pfs'])
             # Set parameters based on variables selected
             #   NOTE: need to run `ell_size` BEFORE `n_pfs`
             if x_key == 'ell_size':
                 # Need to apply moving average window to original data, before
-                #   the data filters were applied, so make a new Analysis_Group
-                a_group.profile_filters.m_avg_win = x
-                new_a_group = Analysis_Group(a_group.data_set, a_group.profile_filters, a_group.plt_params)
-                this_df = pd.concat(new_a_group.data_frames)
+                #   the data filters were applied
+                if isinstance(row, type(None)):
+                    this_df = pd.concat(apply_m_avg_win(ell_group, x))
                 xlabel = r'$\ell$ (dbar)'
             if z_key == 'ell_size':
                 # Need to apply moving average window to original data, before
-                #   the data filters were applied, so make a new Analysis_Group
-                a_group.profile_filters.m_avg_win = z_list[i]
-                new_a_group = Analysis_Group(a_group.data_set, a_group.profile_filters, a_group.plt_params)
-                this_df = pd.concat(new_a_group.data_frames)
+                #   the data filters were applied
+                if isinstance(row, type(None)):
+                    this_df = pd.concat(apply_m_avg_win(ell_group, z_list[i]))
                 zlabel = r'$\ell=$'+str(z_list[i])+' dbar'
             if x_key == 'n_pfs':
                 this_df = this_df[this_df['prof_no'] <= pf_nos[x-1]].copy()
@@ -7764,20 +9401,29 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
                 else:
                     m_cls = z_list[i]
                 zlabel = r'$m_{cls}=$'+str(m_cls)
-            # Run the HDBSCAN algorithm on the provided dataframe
-            try:
-                new_df, rel_val, m_pts_out, m_cls_out, ell = HDBSCAN_(a_group.data_set.arr_of_ds, this_df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, param_sweep=True)
-            except:
-                break
+            if not isinstance(row, type(None)):
+                # Use the results from the earlier run
+                n_clusters = int(float(row['n_clusters']))
+                rel_val = float(row['DBCV'])
+            else:
+                # Run the HDBSCAN algorithm on the provided dataframe
+                reset_peak_RSS()
+                tic = time.perf_counter()
+                try:
+                    new_df, rel_val, m_pts_out, m_cls_out, ell = HDBSCAN_(a_group.data_set.arr_of_ds, this_df, cl_x_var, cl_y_var, cl_z_var, m_pts, m_cls=m_cls, param_sweep=True, m_pts_list=m_pts_list, DBCV_method=get_DBCV_method(pp), ell_size=pt_vals['ell_size'])
+                except:
+                    break
+                # Clusters are labeled starting from 0, so total number of clusters is
+                #   the largest label plus 1
+                n_clusters = int(np.nanmax(new_df['cluster']+1))
+                sweep_results.add_point(m_pts_out, ell, n_clusters, rel_val, m_cls_out, pt_vals['n_pfs'], round(time.perf_counter()-tic, 3), find_peak_RSS())
             # Record outputs to plot
             if y_key == 'DBCV':
                 # relative_validity_ is a rough measure of DBCV
                 y_var_array.append(rel_val)
                 ylabel = 'DBCV'
             elif y_key == 'n_clusters':
-                # Clusters are labeled starting from 0, so total number of clusters is
-                #   the largest label plus 1
-                y_var_array.append(int(np.nanmax(new_df['cluster']+1)))
+                y_var_array.append(n_clusters)
                 ylabel = 'Number of clusters'
             if tw_y_key:
                 if tw_y_key == 'DBCV':
@@ -7785,13 +9431,10 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
                     tw_y_var_array.append(rel_val)
                     tw_ylabel = 'DBCV'
                 elif tw_y_key == 'n_clusters':
-                    # Clusters are labeled starting from 0, so total number of clusters is
-                    #   the largest label plus 1
-                    tw_y_var_array.append(int(np.nanmax(new_df['cluster']+1)))
+                    tw_y_var_array.append(n_clusters)
                     tw_ylabel = 'Number of clusters'
                 #
             #
-            lines.append(str(m_pts_out)+','+str(ell)+','+str(int(np.nanmax(new_df['cluster']+1)))+','+str(rel_val)+','+str(m_cls_out)+'\n')
         # Plot the data
         if True:
             ax.plot(x_var_array, y_var_array, color=std_clr, linestyle=l_styles[i], label=zlabel)
@@ -7809,10 +9452,6 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
                 tw_ax_x.tick_params(axis='y', colors=alt_std_clr)
                 # Add gridlines
                 # tw_ax_x.grid(color=alt_std_clr, linestyle='--', alpha=grid_alpha+0.3, axis='y')
-        # Gather the data from all the processes
-        f = open(sweep_txt_file,'a')
-        f.write(''.join(lines))
-        f.close()
     if z_key:
         ax.legend()
     return xlabel, ylabel
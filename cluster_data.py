@@ -434,6 +434,11 @@ for clstr_dict in [BGR04_clstr_dict]:
         my_nc = clstr_dict['netcdf_file']
     except:
         my_nc = False
+    # Whether to re-run the clustering or only add new profiles to it
+    try:
+        re_run_clstr = clstr_dict['re_run_clstr']
+    except:
+        re_run_clstr = True
     # Make new netcdf to store clustering results
     if my_nc != False:
         print('Preparing to write to',my_nc)
@@ -441,7 +446,12 @@ for clstr_dict in [BGR04_clstr_dict]:
         ds_var_info = {}
         # ds_coord_info = {}
         # Create data set object
-        ds_object = ahf.Data_Set(clstr_dict['sources_dict'], clstr_dict['data_filters'])
+        ds_object = None
+        if re_run_clstr == 'incremental':
+            # Start from the clustered netcdf, adding just the profiles it doesn't have
+            ds_object = ahf.make_incr_data_set(my_nc, clstr_dict['sources_dict'], clstr_dict['data_filters'])
+        if isinstance(ds_object, type(None)):
+            ds_object = ahf.Data_Set(clstr_dict['sources_dict'], clstr_dict['data_filters'])
         # print('Before:')
         # Copy down the global attributes to put into the new netcdf later
         #   Loop through each dataset (one for each instrument)
@@ -488,7 +498,7 @@ for clstr_dict in [BGR04_clstr_dict]:
         else:
             # keep_these_vars = ['la_CT', 'entry', 'prof_no', 'CT', 'SA']
             keep_these_vars = ['entry', 'prof_no', 'BL_yn', 'dt_start', 'dt_end', 'lon', 'lat', 'region', 'up_cast', 'press_max', 'press_min', 'CT_TC_max', 'CT_TC_min', 'press_TC_max', 'press_TC_min', 'SA_TC_max', 'SA_TC_min', 'sig_TC_max', 'sig_TC_min', 'R_rho', 'press', 'depth', 'iT', 'CT', 'PT', 'SP', 'SA', 'sigma', 'alpha', 'beta', 'aCT', 'BSA', 'ss_mask', 'ma_iT', 'ma_CT', 'ma_PT', 'ma_SP', 'ma_SA', 'ma_sigma', 'la_iT', 'la_CT', 'la_PT', 'la_SP', 'la_SA', 'la_sigma']
-            pp_clstr = ahf.Plot_Parameters(x_vars=[clstr_dict['cl_x_var']], y_vars=[clstr_dict['cl_y_var']], clr_map='cluster', extra_args={'b_a_w_plt':True, 'cl_x_var':clstr_dict['cl_x_var'], 'cl_y_var':clstr_dict['cl_y_var'], 'm_pts':clstr_dict['m_pts'], 'm_cls':clstr_dict['m_cls'], 'extra_vars_to_keep':keep_these_vars, 'relab_these':clstr_dict['relab_these']}, legend=True)
+            pp_clstr = ahf.Plot_Parameters(x_vars=[clstr_dict['cl_x_var']], y_vars=[clstr_dict['cl_y_var']], clr_map='cluster', extra_args={'b_a_w_plt':True, 'cl_x_var':clstr_dict['cl_x_var'], 'cl_y_var':clstr_dict['cl_y_var'], 'm_pts':clstr_dict['m_pts'], 'm_cls':clstr_dict['m_cls'], 'extra_vars_to_keep':keep_these_vars, 'relab_these':clstr_dict['relab_these'], 're_run_clstr':re_run_clstr}, legend=True)
             # pp_clstr = ahf.Plot_Parameters(x_vars=['dt_start'], y_vars=['SA'], clr_map='cluster', extra_args={'b_a_w_plt':True, 'cl_x_var':clstr_dict['cl_x_var'], 'cl_y_var':clstr_dict['cl_y_var'], 'm_pts':clstr_dict['m_pts'], 'm_cls':clstr_dict['m_cls'], 'extra_vars_to_keep':keep_these_vars, 'relab_these':clstr_dict['relab_these']}, legend=True)
         # Create analysis group
         print('Creating analysis group')
@@ -524,40 +534,9 @@ for clstr_dict in [BGR04_clstr_dict]:
         # print('Duplicated indices')
         # print(new_df.index[new_df.index.duplicated()].unique())
         # exit(0)
-        # Convert back to xarray dataset
-        ds = new_df.to_xarray()
-        # print('Before:')
-        # print(ds)
-        # print('')
-        # ds = ds.where(np.isnan(ds.entry), drop=True)
         pf_vars = ahf.pf_vars + ['instrmt', 'source', 'notes', 'SA_CT_max', 'press_max']
-        # Get the values of the dimensions
-        time_vals, vert_vals = ds.indexes.values()
-        # Loop across the Time dimension
-        for this_time in time_vals:
-            for var in ds.variables:
-                if var in pf_vars:
-                    # print('Adjusting this var:',var)
-                    # Get the array of values for this var for this Time
-                    these_vals = ds[var].sel(Time=this_time)
-                    if var in ['dt_start', 'dt_end', 'region', 'instrmt', 'source', 'notes']:
-                        these_vals1 = [x for x in np.array(these_vals) if not isinstance(x, float)]
-                    else:
-                        these_vals1 = np.unique(these_vals[~np.isnan(these_vals)])
-                    if len(these_vals1) > 0:
-                        this_val = these_vals1[0]
-                    else:
-                        this_val = np.nan
-                    # print('\tthis_val:',this_val)
-                    # Copy this value to all `Vertical` entries for this variable
-                    ds[var].loc[dict(Time=this_time)] = this_val
-                #
-            #
-        # Drop the Vertical dimension for variables which vary in Time only
-        for var in ds.variables:
-            if var in pf_vars:
-                # print('Dropping Vertical dimension for this var:',var)
-                ds[var] = ds[var].isel(Vertical=0, drop=True)
+        # Convert back to xarray dataset, with the per-profile variables along `Time` only
+        ds = ahf.dataframe_to_ds(new_df, pf_vars)
         # print('After:')
         # print(ds)
         # exit(0)
@@ -576,13 +555,14 @@ for clstr_dict in [BGR04_clstr_dict]:
         ds.attrs['Clustering m_pts'] = group_test_clstr.data_set.arr_of_ds[0].attrs['Clustering m_pts']
         ds.attrs['Clustering filters'] = ahf.print_profile_filters(clstr_dict['pfs_object'])
         ds.attrs['Clustering DBCV'] = group_test_clstr.data_set.arr_of_ds[0].attrs['Clustering DBCV']
+        ds.attrs['Clustering model'] = ahf.save_clstr_model(my_nc)
         # Add the variable attributes back in
         for var in ds.variables:
             if var in ds_var_info.keys():
                 ds.variables[var].attrs = ds_var_info[var]
         # Write out to netcdf
         print('Writing data to',my_nc)
-        ds.to_netcdf(my_nc, 'w')
+        ahf.write_netcdf(ds, my_nc)
         # Load in with xarray
         ds2 = xr.load_dataset(my_nc)
         # See the variables after
@@ -620,7 +600,7 @@ for clstr_dict in [BGR04_clstr_dict]:
         # Create profile filter object
         pfs_object = clstr_dict['pfs_object']
         # Create plot parameters object
-        pp_clstr = ahf.Plot_Parameters(x_vars=[clstr_dict['cl_x_var']], y_vars=[clstr_dict['cl_y_var']], clr_map='cluster', extra_args={'b_a_w_plt':False, 'cl_x_var':clstr_dict['cl_x_var'], 'cl_y_var':clstr_dict['cl_y_var'], 'm_pts':clstr_dict['m_pts']}, legend=False)
+        pp_clstr = ahf.Plot_Parameters(x_vars=[clstr_dict['cl_x_var']], y_vars=[clstr_dict['cl_y_var']], clr_map='cluster', extra_args={'b_a_w_plt':False, 'cl_x_var':clstr_dict['cl_x_var'], 'cl_y_var':clstr_dict['cl_y_var'], 'm_pts':clstr_dict['m_pts'], 're_run_clstr':re_run_clstr}, legend=False)
         # Create analysis group
         group_test_clstr = ahf.Analysis_Group(ds_object, pfs_object, pp_clstr)
         # Make a figure to run clustering algorithm and check results
@@ -643,13 +623,13 @@ for clstr_dict in [BGR04_clstr_dict]:
         ds.attrs['Clustering m_pts'] = clstr_dict['m_pts']
         ds.attrs['Clustering filters'] = ahf.print_profile_filters(clstr_dict['pfs_object'])
         ds.attrs['Clustering DBCV'] = group_test_clstr.data_set.arr_of_ds[0].attrs['Clustering DBCV']
-        # Write out to netcdf
+        ds.attrs['Clustering model'] = ahf.save_clstr_model(my_nc)
+        # Write out just the clustering variables to netcdf
         print('Writing data to',my_nc)
-        ds.to_netcdf(my_nc, 'w')
-        # Load in with xarray
-        ds2 = xr.load_dataset(my_nc)
+        ahf.update_netcdf(my_nc, ds, ['cluster', 'clst_prob'])
         # See the variables after
+        ds2_attrs = ahf.read_netcdf_attrs(my_nc)
         for attr in gattrs_to_print:
-            print('\t',attr+':',ds2.attrs[attr])
+            print('\t',attr+':',ds2_attrs[attr])
 
 
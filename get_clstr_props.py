@@ -92,7 +92,7 @@ if calc_pcs_vars:
     # df_copy = ahf.calc_extra_cl_vars(df_copy, calc_vars)
     df_copy = ahf.calc_extra_cl_vars(df_copy, ['pcs_press'])
     # Drop duplicates to get one row per cluster per profile
-    df_per_pf = df_copy.drop_duplicates(subset=['cluster','instrmt-prof_no'])
+    df_per_pf = df_copy.drop_duplicates(subset=['cluster','instrmt','prof_no'])
     print(df_per_pf.columns)
 
     # Pickle the data frame to a file
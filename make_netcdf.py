@@ -40,6 +40,10 @@ import xarray as xr
 from datetime import datetime
 # For searching and listing directories
 import os
+# For recording which data files have already been read
+import json
+# For reading data files in parallel
+import multiprocessing
 # For reading the ITP `cormat` files
 import mat73
 from scipy import io
@@ -50,6 +54,8 @@ import re
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
 # For converting from depth to pressure
 import gsw
+# For writing netcdfs with the shared encoding
+import analysis_helper_functions as ahf
 
 # For test plots
 import matplotlib.pyplot as plt
@@ -73,7 +79,7 @@ np_float_type = np.float32
 
 ################################################################################
 
-def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
+def read_instrmt(source, instrmt_name, instrmt_dir, out_file, ragged=False, n_procs=1, incremental=True):
     """
     Reads in all the data for the specified instrument and formats it into a
     single netcdf
@@ -82,6 +88,16 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
     instrmt_name        string of the name of this instrmt
     instrmt_dir         string of a file path to this instrmt's directory
     out_file            string of the file path in which to save the netcdf
+    ragged              True/False whether to store the vertical data as CF
+                            contiguous ragged arrays along an `obs` dimension,
+                            with the number of points in each profile in
+                            `row_size`, instead of padding every profile to
+                            the length of the longest one along `Vertical`
+    n_procs             integer number of processes with which to read data files
+    incremental         True/False whether to only read the data files that are
+                            new or changed since out_file was last made, going by
+                            the sizes and modified times recorded in its manifest,
+                            and combine them with the profiles already in out_file
     """
     print('Reading',source,instrmt_name)
     # Select the corresponding read function for the provided data source
@@ -142,61 +158,127 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
         print('Did not find any files for',instrmt_name)
         exit(0)
     else:
+        data_files = [file for file in data_files if os.path.isfile(instrmt_dir+'/'+file)]
+        # Record the size and modified time of each data file
+        manifest_file = out_file.replace('.nc', '_manifest.json')
+        manifest = {'ragged':ragged, 'files':{}}
+        for file in data_files:
+            file_stat = os.stat(instrmt_dir+'/'+file)
+            manifest['files'][file] = {'size':file_stat.st_size, 'mtime':file_stat.st_mtime, 'prof_no':None}
+        # Find which data files are new or changed since the last time
+        old_manifest = None
+        if incremental and os.path.isfile(out_file) and os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                old_manifest = json.load(f)
+            # Start over if the storage format has changed
+            if old_manifest['ragged'] != ragged:
+                old_manifest = None
+        if isinstance(old_manifest, type(None)):
+            files_to_read = data_files
+            pfs_to_drop = []
+        else:
+            files_to_read = []
+            for file in data_files:
+                old_entry = old_manifest['files'].get(file)
+                if isinstance(old_entry, type(None)) or old_entry['size'] != manifest['files'][file]['size'] or old_entry['mtime'] != manifest['files'][file]['mtime']:
+                    files_to_read.append(file)
+                else:
+                    manifest['files'][file]['prof_no'] = old_entry['prof_no']
+            # Drop the profiles of files that changed or were removed
+            pfs_to_drop = [entry['prof_no'] for file, entry in old_manifest['files'].items() if (file in files_to_read or file not in manifest['files']) and not isinstance(entry['prof_no'], type(None))]
+            print('\t',len(files_to_read),'new or changed data files,',len(pfs_to_drop),'profiles to replace or remove')
+            if len(files_to_read) == 0 and len(pfs_to_drop) == 0:
+                print('\t',out_file,'is up to date')
+                return
+        # Read in the data files, in parallel if applicable
+        if n_procs > 1 and len(files_to_read) > 1:
+            # Fork so the workers don't re-run this script when they start
+            with multiprocessing.get_context('fork').Pool(n_procs) as pool:
+                out_dicts = pool.starmap(read_data_file, [(instrmt_dir, file, instrmt_name) for file in files_to_read])
+        else:
+            out_dicts = [read_data_file(instrmt_dir, file, instrmt_name) for file in files_to_read]
         # Keep track of the entry number with i
         i = 0
-        for file in data_files:
-            if os.path.isfile(instrmt_dir+'/'+file):
-                # Read in the data file for this profile
-                # print('\t\tReading',file)
-                out_dict = read_data_file(instrmt_dir, file, instrmt_name)
-                if not isinstance(out_dict, type(None)):
-                    # Append that data
-                    list_of_entries.append(i)
-                    list_of_pf_nos.append(out_dict['prof_no'])
-                    list_of_black_list.append(out_dict['black_list'])
-                    list_of_datetimes_start.append(out_dict['dt_start'])
-                    list_of_datetimes_end.append(out_dict['dt_end'])
-                    list_of_lons.append(out_dict['lon'])
-                    list_of_lats.append(out_dict['lat'])
-                    list_of_regs.append(out_dict['region'])
-                    list_of_up_casts.append(out_dict['up_cast'])
-                    list_of_press_maxs.append(out_dict['press_max'])
-                    list_of_press_mins.append(out_dict['press_min'])
-                    list_of_CT_TC_maxs.append(out_dict['CT_TC_max'])
-                    list_of_CT_TC_mins.append(out_dict['CT_TC_min'])
-                    list_of_press_TC_maxs.append(out_dict['press_TC_max'])
-                    list_of_press_TC_mins.append(out_dict['press_TC_min'])
-                    list_of_SA_TC_maxs.append(out_dict['SA_TC_max'])
-                    list_of_SA_TC_mins.append(out_dict['SA_TC_min'])
-                    list_of_press_arrs.append(out_dict['press'])
-                    list_of_depth_arrs.append(out_dict['depth'])
-                    list_of_iT_arrs.append(out_dict['iT'])
-                    list_of_CT_arrs.append(out_dict['CT'])
-                    list_of_PT_arrs.append(out_dict['PT'])
-                    list_of_SP_arrs.append(out_dict['SP'])
-                    list_of_SA_arrs.append(out_dict['SA'])
-                    # Check for a new maximum vertical dimension length
-                    max_vert_count = max(max_vert_count, len(out_dict['depth']))
-                    # Increase entry number
-                    i += 1
-                #
+        for file, out_dict in zip(files_to_read, out_dicts):
+            # print('\t\tReading',file)
+            if not isinstance(out_dict, type(None)):
+                # Record which profile is in this file
+                if isinstance(out_dict['prof_no'], np.generic):
+                    manifest['files'][file]['prof_no'] = out_dict['prof_no'].item()
+                else:
+                    manifest['files'][file]['prof_no'] = out_dict['prof_no']
+                # Append that data
+                list_of_entries.append(i)
+                list_of_pf_nos.append(out_dict['prof_no'])
+                list_of_black_list.append(out_dict['black_list'])
+                list_of_datetimes_start.append(out_dict['dt_start'])
+                list_of_datetimes_end.append(out_dict['dt_end'])
+                list_of_lons.append(out_dict['lon'])
+                list_of_lats.append(out_dict['lat'])
+                list_of_regs.append(out_dict['region'])
+                list_of_up_casts.append(out_dict['up_cast'])
+                list_of_press_maxs.append(out_dict['press_max'])
+                list_of_press_mins.append(out_dict['press_min'])
+                list_of_CT_TC_maxs.append(out_dict['CT_TC_max'])
+                list_of_CT_TC_mins.append(out_dict['CT_TC_min'])
+                list_of_press_TC_maxs.append(out_dict['press_TC_max'])
+                list_of_press_TC_mins.append(out_dict['press_TC_min'])
+                list_of_SA_TC_maxs.append(out_dict['SA_TC_max'])
+                list_of_SA_TC_mins.append(out_dict['SA_TC_min'])
+                list_of_press_arrs.append(out_dict['press'])
+                list_of_depth_arrs.append(out_dict['depth'])
+                list_of_iT_arrs.append(out_dict['iT'])
+                list_of_CT_arrs.append(out_dict['CT'])
+                list_of_PT_arrs.append(out_dict['PT'])
+                list_of_SP_arrs.append(out_dict['SP'])
+                list_of_SA_arrs.append(out_dict['SA'])
+                # Check for a new maximum vertical dimension length
+                max_vert_count = max(max_vert_count, len(out_dict['depth']))
+                # Increase entry number
+                i += 1
             #
         # Print out total files found
         print('\tRead',i,'data files')
     #
-    # Make sure the vertical data are all the same length lists
-    for i in range(len(list_of_depth_arrs)):
-        list_of_press_arrs[i] = list(list_of_press_arrs[i]) +[None]*(max_vert_count - len(list_of_press_arrs[i]))
-        list_of_depth_arrs[i] = list(list_of_depth_arrs[i]) +[None]*(max_vert_count - len(list_of_depth_arrs[i]))
-        list_of_iT_arrs[i] = list(list_of_iT_arrs[i]) + [None]*(max_vert_count - len(list_of_iT_arrs[i]))
-        list_of_SP_arrs[i] = list(list_of_SP_arrs[i]) + [None]*(max_vert_count - len(list_of_SP_arrs[i]))
-        list_of_CT_arrs[i] = list(list_of_CT_arrs[i]) + [None]*(max_vert_count - len(list_of_CT_arrs[i]))
-        list_of_PT_arrs[i] = list(list_of_PT_arrs[i]) + [None]*(max_vert_count - len(list_of_PT_arrs[i]))
-        list_of_SA_arrs[i] = list(list_of_SA_arrs[i]) + [None]*(max_vert_count - len(list_of_SA_arrs[i]))
+    # If no profiles were added, just remove the ones that changed or were removed
+    if i == 0 and not isinstance(old_manifest, type(None)):
+        ds = combine_with_netcdf(out_file, None, pfs_to_drop)
+        print('Writing data to',out_file)
+        ahf.write_netcdf(ds, out_file)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f)
+        return
+    if ragged:
+        # Record the number of vertical measurements in each profile
+        list_of_row_sizes = [len(arr) for arr in list_of_depth_arrs]
+        n_obs = sum(list_of_row_sizes)
+        # Put the vertical data of all the profiles end to end
+        list_of_press_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_press_arrs])
+        list_of_depth_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_depth_arrs])
+        list_of_iT_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_iT_arrs])
+        list_of_SP_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_SP_arrs])
+        list_of_CT_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_CT_arrs])
+        list_of_PT_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_PT_arrs])
+        list_of_SA_arrs = np.concatenate([np.array(arr, dtype=float) for arr in list_of_SA_arrs])
+        vert_dims = ['obs']
+    else:
+        # Make sure the vertical data are all the same length lists
+        for i in range(len(list_of_depth_arrs)):
+            list_of_press_arrs[i] = list(list_of_press_arrs[i]) +[None]*(max_vert_count - len(list_of_press_arrs[i]))
+            list_of_depth_arrs[i] = list(list_of_depth_arrs[i]) +[None]*(max_vert_count - len(list_of_depth_arrs[i]))
+            list_of_iT_arrs[i] = list(list_of_iT_arrs[i]) + [None]*(max_vert_count - len(list_of_iT_arrs[i]))
+            list_of_SP_arrs[i] = list(list_of_SP_arrs[i]) + [None]*(max_vert_count - len(list_of_SP_arrs[i]))
+            list_of_CT_arrs[i] = list(list_of_CT_arrs[i]) + [None]*(max_vert_count - len(list_of_CT_arrs[i]))
+            list_of_PT_arrs[i] = list(list_of_PT_arrs[i]) + [None]*(max_vert_count - len(list_of_PT_arrs[i]))
+            list_of_SA_arrs[i] = list(list_of_SA_arrs[i]) + [None]*(max_vert_count - len(list_of_SA_arrs[i]))
+        vert_dims = ['Time','Vertical']
     #
     # Make a blank array for each dimension
     Time_blank = [None]*len(list_of_datetimes_start)
-    Vertical_blank = [[None]*max_vert_count]*len(list_of_datetimes_start)
+    if ragged:
+        Vertical_blank = [None]*n_obs
+    else:
+        Vertical_blank = [[None]*max_vert_count]*len(list_of_datetimes_start)
     # Make arrays for the source and instrument names
     list_of_sources  = [source]*len(list_of_datetimes_start)
     list_of_instrmts = [instrmt_name]*len(list_of_datetimes_start)
@@ -417,7 +499,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'press':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_press_arrs, dtype=np_float_type),
                         {
                             'units':'dbar',
@@ -427,7 +509,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'depth':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_depth_arrs, dtype=np_float_type),
                         {
                             'units':'m',
@@ -437,7 +519,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'iT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_iT_arrs, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -447,7 +529,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'CT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_CT_arrs, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -457,7 +539,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'PT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_PT_arrs, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -467,7 +549,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'SP':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_SP_arrs, dtype=np_float_type),
                         {
                             'units':'g/kg',
@@ -477,7 +559,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'SA':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(list_of_SA_arrs, dtype=np_float_type),
                         {
                             'units':'g/kg',
@@ -487,7 +569,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'sigma':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.sigma1(list_of_SA_arrs, list_of_CT_arrs), dtype=np_float_type),
                         {
                             'units':'kg/m^3',
@@ -497,7 +579,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'alpha':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.alpha(list_of_SA_arrs, list_of_CT_arrs, list_of_press_arrs), dtype=np_float_type),
                         {
                             'units':'1/(degrees Celcius)',
@@ -507,7 +589,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'alpha_PT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.alpha(list_of_SA_arrs, list_of_PT_arrs, list_of_press_arrs), dtype=np_float_type),
                         {
                             'units':'1/(degrees Celcius)',
@@ -517,7 +599,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'alpha_iT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.alpha_wrt_t_exact(list_of_SA_arrs, list_of_iT_arrs, list_of_press_arrs), dtype=np_float_type),
                         {
                             'units':'1/(degrees Celcius)',
@@ -527,7 +609,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'beta':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.beta(list_of_SA_arrs, list_of_CT_arrs, list_of_press_arrs), dtype=np_float_type),
                         {
                             'units':'1/(g/kg)',
@@ -537,7 +619,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'beta_PT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(gsw.beta(list_of_SA_arrs, list_of_PT_arrs, list_of_press_arrs), dtype=np_float_type),
                         {
                             'units':'1/(g/kg)',
@@ -547,7 +629,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ss_mask':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'N/A',
@@ -557,7 +639,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_iT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -567,7 +649,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_CT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -577,7 +659,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_PT':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'degrees Celcius',
@@ -587,7 +669,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_SP':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'g/kg',
@@ -597,7 +679,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_SA':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'g/kg',
@@ -607,7 +689,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'ma_sigma':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'kg/m^3',
@@ -617,7 +699,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'cluster':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         Vertical_blank,
                         {
                             'units':'N/A',
@@ -627,7 +709,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 ),
                 'clst_prob':(
-                        ['Time','Vertical'],
+                        vert_dims,
                         np.array(Vertical_blank, dtype=np_float_type),
                         {
                             'units':'N/A',
@@ -669,6 +751,20 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                         }
                 )
     }
+    if ragged:
+        # Replace the `Vertical` index with the number of points in each profile
+        del nc_coords['Vertical']
+        nc_vars['row_size'] = (
+                        ['Time'],
+                        np.array(list_of_row_sizes, dtype=np.int32),
+                        {
+                            'units':'N/A',
+                            'label':'Number of points',
+                            'long_name':'Number of vertical measurements in this profile',
+                            'sample_dimension':'obs',
+                            'dtype':'int32'
+                        }
+                )
     #
     # Define global attributes
     nc_attrs = {        # Note: can't store datetime objects in netcdfs
@@ -699,9 +795,68 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
 
     # Convert into a dataset
     ds = xr.Dataset(data_vars=nc_vars, coords=nc_coords, attrs=nc_attrs)
+    # Add in the profiles that were already in the netcdf
+    if not isinstance(old_manifest, type(None)):
+        ds = combine_with_netcdf(out_file, ds, pfs_to_drop)
     # Write out to netcdf
     print('Writing data to',out_file)
-    ds.to_netcdf(out_file, 'w')
+    ahf.write_netcdf(ds, out_file)
+    # Record which data files are now in the netcdf
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+
+################################################################################
+
+def combine_with_netcdf(out_file, ds_new, pfs_to_drop):
+    """
+    Returns a dataset of the profiles already in a netcdf, minus the ones to drop,
+    combined with the new profiles, ordered by profile number
+
+    out_file            string of the file path of the existing netcdf
+    ds_new              an xarray of the new profiles, as made by read_instrmt(), or None
+    pfs_to_drop         a list of the profile numbers to drop from the existing netcdf
+    """
+    ds_old = xr.load_dataset(out_file)
+    ragged = 'row_size' in ds_old.keys()
+    # Drop the profiles from data files that changed or were removed
+    keep_pfs = ~np.isin(ds_old['prof_no'].values, pfs_to_drop)
+    if ragged:
+        ds_old = ds_old.isel(Time=keep_pfs, obs=np.repeat(keep_pfs, ds_old['row_size'].values))
+    else:
+        ds_old = ds_old.isel(Time=keep_pfs)
+    if isinstance(ds_new, type(None)):
+        ds = ds_old
+    else:
+        # Match the variables in the existing netcdf, which may have been added to
+        #   or filled in since it was made
+        for var in list(ds_old.keys()):
+            if var not in ds_new.keys():
+                dims = ds_old[var].dims
+                ds_new[var] = (dims, np.full([ds_new.sizes[dim] for dim in dims], np.nan), ds_old[var].attrs)
+            if ds_new[var].dtype == object and ds_old[var].dtype.kind == 'f':
+                ds_new[var] = ds_new[var].astype(ds_old[var].dtype)
+        if ragged:
+            # The per-profile and vertical variables are along different dimensions
+            time_vars = [var for var in ds_old.keys() if 'obs' not in ds_old[var].dims]
+            obs_vars = [var for var in ds_old.keys() if 'obs' in ds_old[var].dims]
+            ds = xr.merge([xr.concat([ds_old[time_vars], ds_new[time_vars]], dim='Time'), xr.concat([ds_old[obs_vars], ds_new[obs_vars]], dim='obs')], combine_attrs='override')
+        else:
+            ds = xr.concat([ds_old, ds_new], dim='Time', combine_attrs='override')
+    # Put the profiles in order
+    pf_order = np.argsort(ds['prof_no'].values, kind='stable')
+    if ragged:
+        row_size = ds['row_size'].values
+        starts = np.cumsum(row_size) - row_size
+        obs_order = np.concatenate([np.arange(starts[j], starts[j]+row_size[j]) for j in pf_order]+[np.array([], dtype=int)])
+        ds = ds.isel(Time=pf_order, obs=obs_order)
+    else:
+        ds = ds.isel(Time=pf_order)
+    ds['entry'] = (['Time'], np.arange(ds.sizes['Time'], dtype=np.int32), ds['entry'].attrs)
+    # Update the global attributes
+    ds.attrs = ds_old.attrs
+    ds.attrs['Last modified'] = str(datetime.now())
+    ds.attrs['Last modification'] = 'Updated profiles from new or changed data files'
+    return ds
 
 ################################################################################
 
@@ -737,13 +892,19 @@ def list_data_files(file_path):
 # ITP functions
 ################################################################################
 
-def make_all_ITP_netcdfs(science_data_file_path, format='cormat'):
+def make_all_ITP_netcdfs(science_data_file_path, format='cormat', ragged=False, n_procs=1, incremental=True):
     """
     Finds ITP data files for all instruments available and formats them into netcdfs
 
     science_data_file_path      string of the filepath where the data is stored
     format                      which version of the data files to use
                                     either 'cormat' or 'final'
+    ragged                      True/False whether to store the vertical data as
+                                    contiguous ragged arrays, see read_instrmt()
+    n_procs                     integer number of processes with which to read
+                                    the instruments, one instrument per process
+    incremental                 True/False whether to only read new or changed
+                                    data files, see read_instrmt()
     """
     # Declare file path
     main_dir = science_data_file_path+'ITPs/'
@@ -756,13 +917,21 @@ def make_all_ITP_netcdfs(science_data_file_path, format='cormat'):
         print(main_dir, " is not a directory")
         exit(0)
     # Read in data for all ITPs available
+    instrmt_args = []
     for itp in ITP_dirs:
         if 'itp' in itp:
             # Get just the number for the itp
             itp_number = ''.join(filter(str.isdigit, itp))
-            read_instrmt('ITP', itp_number, main_dir+itp+'/'+itp+format, 'netcdfs/ITP_'+itp_number.zfill(3)+'.nc')
+            instrmt_args.append(('ITP', itp_number, main_dir+itp+'/'+itp+format, 'netcdfs/ITP_'+itp_number.zfill(3)+'.nc', ragged, 1, incremental))
         #
     #
+    if n_procs > 1:
+        # Fork so the workers don't re-run this script when they start
+        with multiprocessing.get_context('fork').Pool(n_procs) as pool:
+            pool.starmap(read_instrmt, instrmt_args)
+    else:
+        for args in instrmt_args:
+            read_instrmt(*args)
 
 ################################################################################
 
@@ -1689,7 +1858,8 @@ if False:
 # read_instrmt('ITP', '3', science_data_file_path+'ITPs/itp3/itp3cormat', 'netcdfs/ITP_003.nc')
 
 ## This will make all the netcdfs for ITPs (takes a long time)
-# make_all_ITP_netcdfs(science_data_file_path)
+##      Re-running only reads the data files that are new or changed
+# make_all_ITP_netcdfs(science_data_file_path, n_procs=4)
 
 ## This will make all the netcdfs for SHEBA
 # make_SHEBA_netcdfs(science_data_file_path)
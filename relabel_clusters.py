@@ -21,6 +21,8 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from datetime import datetime
+# For relabeling netcdfs in parallel
+import multiprocessing
 
 import analysis_helper_functions as ahf
 import BGR_params as bps
@@ -30,43 +32,35 @@ import matplotlib.pyplot as plt
 
 # Select the relabeling scheme
 relab_scheme = 'SA_divs'
+# The number of netcdfs to relabel at once, in separate processes
+n_procs = 1
 
 ################################################################################
 
-def relabel_clusters_SA_divs(df):
+def relabel_clusters_SA_divs(SA, cluster):
     """
-    Relabel the clusters based on the SA divisions
+    Relabel the clusters based on the SA divisions, returning an integer array
+    of the new cluster IDs, where noise stays -1 and points without a cluster
+    ID get the fill value `cluster` is stored with in the netcdfs
 
-    df: pandas DataFrame to relabel
+    SA: numpy array of SA values
+    cluster: numpy array of cluster IDs, the same shape as SA
     """
     print('\t\t- Relabeling clusters based on SA divisions')
-    # Check to make sure there is a 'cluster' column
-    if 'cluster' not in df.columns:
-        raise ValueError('`df` must have a column named "cluster"')
-    # Get the SA divider values
-    SA_divs = bps.BGR_HPC_SA_divs
-    ## For the first divider
-    # Find all the rows with SA values less than the first divider and are not noise
-    df_this_div = df[(df['SA'] < SA_divs[0]) & (df['cluster'] != -1)]
-    # Relabel the cluster IDs
-    df.loc[df_this_div.index, 'cluster'] = 0
-    ## For the middle dividers
-    # Loop through the dividers
-    for i in range(1,len(SA_divs)):
-        # Find all the rows with SA values less than the divider and greater than the previous divider
-        df_this_div = df[(df['SA'] < SA_divs[i]) & (df['SA'] >= SA_divs[i-1]) & (df['cluster'] != -1)]
-        # Relabel the cluster IDs
-        df.loc[df_this_div.index, 'cluster'] = i
-    ## For the last divider
-    # Find all the rows with SA values greater than the last divider
-    df_this_div = df[(df['SA'] >= SA_divs[-1]) & (df['cluster'] != -1)]
-    # Relabel the cluster IDs
-    df.loc[df_this_div.index, 'cluster'] = len(SA_divs)
+    # Get the SA divider values, which are in increasing order
+    SA_divs = np.array(bps.BGR_HPC_SA_divs)
+    # Find all the points that are not noise and have an SA value
+    to_relab = (cluster != -1) & ~np.isnan(SA)
+    # Relabel the cluster IDs with the number of dividers at or below each SA value
+    #   so below the first divider is 0 and above the last is len(SA_divs)
+    clstr_fill = np.iinfo(ahf.nc_int_vars['cluster']).min
+    new_cluster = np.where(np.isnan(cluster), clstr_fill, cluster).astype(int)
+    new_cluster[to_relab] = np.searchsorted(SA_divs, SA[to_relab], side='right')
 
     # Make a test plot
     if False:
         # Find the list of cluster ids 
-        clstr_ids  = np.unique(np.array(df['cluster'].values, dtype=int)).tolist()
+        clstr_ids  = np.unique(new_cluster[new_cluster != clstr_fill]).tolist()
         # Remove the noise cluster id
         if -1 in clstr_ids: 
             clstr_ids.remove(-1)
@@ -74,15 +68,15 @@ def relabel_clusters_SA_divs(df):
         fig, ax = plt.subplots()
         # Loop through each cluster
         for i in clstr_ids:
-            # Get just the rows for this cluster
-            this_df_clstr = df[df['cluster']==i]
+            # Get just the SA values for this cluster
+            this_SA_clstr = SA[new_cluster==i]
             # Check to see whether the cluster is empty
-            if len(this_df_clstr) == 0:
+            if len(this_SA_clstr) == 0:
                 continue
             # Decide on the color and symbol, don't go off the end of the arrays
             my_clr = ahf.distinct_clrs[i%len(ahf.distinct_clrs)]
             # Plot the histogram
-            n, bins, patches = ax.hist(this_df_clstr['SA'], bins=100, color=my_clr, alpha=0.5)
+            n, bins, patches = ax.hist(this_SA_clstr, bins=100, color=my_clr, alpha=0.5)
             # Find the maximum value for this histogram
             h_max = n.max()
             # Find where that max value occured
@@ -100,7 +94,47 @@ def relabel_clusters_SA_divs(df):
         for div in SA_divs:
             ax.axvline(div, color='b', linestyle=':')
         plt.show()
-    return df
+    return new_cluster
+
+################################################################################
+
+def relabel_netcdf(my_nc, new_nc_name):
+    """
+    Writes a copy of a netcdf with the cluster IDs relabeled by the relabeling
+    scheme, only reading the variables needed
+
+    my_nc: string of the path of the netcdf to relabel
+    new_nc_name: string of the path of the netcdf to write
+    """
+    print('- Reading',my_nc)
+    # Load in just the variables needed with xarray
+    with xr.open_dataset(my_nc) as ds:
+        ds = ds[['SA','cluster']].load()
+
+    # Define global attributes to print
+    gattrs_to_print = ['Last modified', 'Last modification']
+    print('')
+    for attr in gattrs_to_print:
+        print('\t',attr+':',ds.attrs[attr])
+
+    print('\t- Making changes')
+
+    # Apply the relabeling scheme
+    if relab_scheme == 'SA_divs':
+        ds['cluster'].values = relabel_clusters_SA_divs(ds['SA'].values, ds['cluster'].values)
+
+    # Update the global variables:
+    ds.attrs['Last modified'] = str(datetime.now())
+    ds.attrs['Last modification'] = 'Relabeled cluster IDs with '+relab_scheme+' scheme'
+
+    # Write out to a copy of the netcdf with just the cluster IDs changed
+    print('Writing data to',new_nc_name)
+    ahf.update_netcdf(new_nc_name, ds, ['cluster'], from_nc=my_nc)
+
+    # See the variables after
+    ds2_attrs = ahf.read_netcdf_attrs(new_nc_name)
+    for attr in gattrs_to_print:
+        print('\t',attr+':',ds2_attrs[attr])
 
 ################################################################################
 # Main execution
@@ -130,48 +164,11 @@ for this_BGR in    ['BGR0506',
     new_nc_names.append('netcdfs/HPC_'+this_BGR+'_clstrd_'+relab_scheme+'.nc')
 
 print('- Relabeling scheme:',relab_scheme)
-# Loop through the netcdfs to modify
-for i in range(len(ncs_to_modify)):
-    my_nc = ncs_to_modify[i]
-    new_nc_name = new_nc_names[i]
-    print('- Reading',my_nc)
-    # Load in with xarray
-    ds = xr.load_dataset(my_nc)
-
-    # Define global attributes to print
-    gattrs_to_print = ['Last modified', 'Last modification']
-    print('')
-    for attr in gattrs_to_print:
-        print('\t',attr+':',ds.attrs[attr])
-
-    print('\t- Making changes')
-
-    ## Get the moving average profiles
-    # Convert a subset of the dataset to a dataframe
-    df = ds[['SA','prof_no','cluster']].squeeze().to_dataframe()
-    # Get the original dimensions of the data to reshape the arrays later
-    len0 = len(df.index.get_level_values(0).unique())
-        # Had issues with ITP11, so I had to add `prof_no` to the dataframe and count
-        #   the unique values
-    # len0 = len(list(set(df['prof_no'].values)))
-    len1 = len(df.index.get_level_values(1).unique())
-    # Apply the relabeling scheme
-    if relab_scheme == 'SA_divs':
-        df = relabel_clusters_SA_divs(df)
-    # Put the new cluster ID values back into the dataset
-    ds['cluster'].values = df['cluster'].values.reshape((len0, len1))
-
-    # Update the global variables:
-    ds.attrs['Last modified'] = str(datetime.now())
-    ds.attrs['Last modification'] = 'Relabeled cluster IDs with '+relab_scheme+' scheme'
-
-    # Write out to netcdf
-    print('Writing data to',new_nc_name)
-    ds.to_netcdf(new_nc_name, 'w')
-
-    # Load in with xarray
-    ds2 = xr.load_dataset(new_nc_name)
-
-    # See the variables after
-    for attr in gattrs_to_print:
-        print('\t',attr+':',ds2.attrs[attr])
+if n_procs > 1:
+    # Relabel each netcdf in its own process, forking so the workers don't re-run this script
+    with multiprocessing.get_context('fork').Pool(n_procs) as pool:
+        pool.starmap(relabel_netcdf, zip(ncs_to_modify, new_nc_names))
+else:
+    # Loop through the netcdfs to modify
+    for i in range(len(ncs_to_modify)):
+        relabel_netcdf(ncs_to_modify[i], new_nc_names[i])
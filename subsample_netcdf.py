@@ -24,6 +24,8 @@ from datetime import datetime
 
 import scipy.ndimage as ndimage
 from scipy import interpolate
+# For writing just the subsample mask back to the netcdfs
+import analysis_helper_functions as ahf
 
 ################################################################################
 
@@ -220,15 +222,13 @@ for my_nc in ncs_to_modify:
     ds.attrs['Last modification'] = 'Modified sub-sample scheme'
     ds.attrs['Sub-sample scheme'] = ss_scheme_str
 
-    # Write out to netcdf
+    # Write out just the subsample mask to netcdf
     print('Writing data to',my_nc)
-    ds.to_netcdf(my_nc, 'w')
-
-    # Load in with xarray
-    ds2 = xr.load_dataset(my_nc)
-    # print('ds2[ss_mask]:',ds2['ss_mask'].values)
+    ahf.update_netcdf(my_nc, ds, ['ss_mask'])
 
+    # See the variables after
+    ds2_attrs = ahf.read_netcdf_attrs(my_nc)
     for attr in gattrs_to_print:
-        print('\t',attr+':',ds2.attrs[attr])
+        print('\t',attr+':',ds2_attrs[attr])
     print('\t ss_mask:')
-    print('\t',ds2.where(ds2.prof_no==7, drop=True).squeeze().ss_mask.values)
+    print('\t',ds.where(ds.prof_no==7, drop=True).squeeze().ss_mask.values)
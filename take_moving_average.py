@@ -30,6 +30,8 @@ from scipy import interpolate
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
 # For calculating density anomaly
 import gsw
+# For taking the moving average of each profile
+import analysis_helper_functions as ahf
 
 # The moving average window in dbar
 c3 = 10
@@ -174,26 +176,9 @@ for my_nc in ncs_to_modify:
     print('making changes')
 
     ## Get the moving average profiles
-    # Convert a subset of the dataset to a dataframe
-    df = ds[['press','iT','CT','PT','SP','SA','prof_no']].squeeze().to_dataframe()
-    # Get the original dimensions of the data to reshape the arrays later
-    len0 = len(df.index.get_level_values(0).unique())
-        # Had issues with ITP11, so I had to add `prof_no` to the dataframe and count
-        #   the unique values
-    len0 = len(list(set(df['prof_no'].values)))
-    len1 = len(df.index.get_level_values(1).unique())
-    # Use the pandas `rolling` function to get the moving average
-    #   center=True makes the first and last window/2 of the profiles are masked
-    #   win_type='boxcar' uses a rectangular window shape
-    #   on='press' means it will take `press` as the index column
-    #   .mean() takes the average of the rolling
-    df1 = df.rolling(window=c3, center=True, win_type='boxcar', on='press').mean()
-    # Put the moving average profiles for temperature, salinity, and density into the dataset
-    ds['ma_iT'].values = df1['iT'].values.reshape((len0, len1))
-    ds['ma_CT'].values = df1['CT'].values.reshape((len0, len1))
-    ds['ma_PT'].values = df1['PT'].values.reshape((len0, len1))
-    ds['ma_SP'].values = df1['SP'].values.reshape((len0, len1))
-    ds['ma_SA'].values = df1['SA'].values.reshape((len0, len1))
+    # Take the moving average of each profile along the `Vertical` dimension
+    #   Windows are kept within each profile and any window with missing data is masked
+    ds = ahf.take_m_avg(ds, c3, ['iT','CT','PT','SP','SA'])
     ds['ma_sigma'].values= gsw.sigma1(ds['ma_SP'], ds['ma_CT'])
 
     # Update the global variables:
@@ -201,13 +186,11 @@ for my_nc in ncs_to_modify:
     ds.attrs['Last modification'] = 'Added moving averages with '+str(c3)+' dbar window'
     ds.attrs['Moving average window'] = str(c3)+' dbar'
 
-    # Write out to netcdf
+    # Write out just the moving averages to netcdf
     print('Writing data to',my_nc)
-    ds.to_netcdf(my_nc, 'w')
-
-    # Load in with xarray
-    ds2 = xr.load_dataset(my_nc)
+    ahf.update_netcdf(my_nc, ds, ['ma_'+var for var in ['iT','CT','PT','SP','SA','sigma']])
 
     # See the variables after
+    ds2_attrs = ahf.read_netcdf_attrs(my_nc)
     for attr in gattrs_to_print:
-        print('\t',attr+':',ds2.attrs[attr])
+        print('\t',attr+':',ds2_attrs[attr])